@@ -0,0 +1,98 @@
+##############################################################################
+#
+# Copyright (c) 2008 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""
+Internal helpers shared by the middleware, the registries and the event
+queue: text conversion, fork handling and background worker threads.
+"""
+
+import os
+import string
+import threading
+import weakref
+
+if str is bytes: # pragma: no cover Python 2
+    def _native(value):
+        return value
+
+    def _latin1(value):
+        return value
+
+    _maketrans = string.maketrans
+else: # pragma: no cover Python 3
+    def _native(value):
+        return value.decode('latin-1')
+
+    def _latin1(value):
+        return value.encode('latin-1')
+
+    _maketrans = bytes.maketrans
+
+
+def _getpid():
+    try:
+        return os.getpid()
+    except AttributeError: # pragma: no cover
+        # no getpid in Jython
+        return 1
+
+_PID = _getpid()
+_FORK_SENSITIVE = weakref.WeakSet()
+_FORK_HOOKS = []
+
+def _after_fork():
+    """
+    Restore per-process state in a freshly forked child: a preforking
+    server which loads the application before forking would otherwise
+    hand every worker the parent's pid, pools, queues, connections and
+    threads.  The functions in ``_FORK_HOOKS`` are called first, then
+    the ``_after_fork`` method of every object in ``_FORK_SENSITIVE``.
+    """
+    global _PID
+    _PID = _getpid()
+    for hook in _FORK_HOOKS:
+        hook()
+    for obj in list(_FORK_SENSITIVE):
+        obj._after_fork()
+
+if hasattr(os, 'register_at_fork'): # pragma: no cover Python >= 3.7
+    os.register_at_fork(after_in_child=_after_fork)
+
+    def _check_fork():
+        pass
+else: # pragma: no cover Python < 3.7
+    def _check_fork():
+        """ Notice a fork lazily when the platform can't report it. """
+        if _getpid() != _PID:
+            _after_fork()
+
+
+class _BackgroundWorker(object):
+    """ Base class of the objects whose ``_run`` method is run by a
+    daemon thread, started by :meth:`_start` when first needed.
+    Subclasses call :meth:`_reset_worker` from ``_after_fork``, as a
+    forked child has none of its parent's threads. """
+    def _reset_worker(self):
+        self._thread_lock = threading.Lock()
+        self._thread = None
+
+    def _start(self):
+        self._thread_lock.acquire()
+        try:
+            if self._thread is None:
+                thread = threading.Thread(target=self._run)
+                thread.daemon = True
+                thread.start()
+                self._thread = thread
+        finally:
+            self._thread_lock.release()
@@ -0,0 +1,129 @@
+##############################################################################
+#
+# Copyright (c) 2008 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+import json
+
+from repoze.browserid._util import _check_fork
+from repoze.browserid._util import _latin1
+from repoze.browserid._util import _native
+from repoze.browserid.middleware import BrowserIdMiddleware
+from repoze.browserid.middleware import LazyBrowserId
+
+
+class BrowserIdASGIMiddleware(BrowserIdMiddleware):
+    """
+    ASGI counterpart of :class:`repoze.browserid.middleware.BrowserIdMiddleware`.
+
+    It accepts the same arguments, with ``app`` being an ASGI 3
+    application, and verifies and mints browser ids with the same
+    machinery.  The browser id is set as ``repoze.browserid`` in a copy
+    of the connection scope.
+
+    When a Set-Cookie header is needed it is added to the
+    ``http.response.start`` message on its way to the server, leaving
+    the response body untouched.  Verifying and minting never block, so
+    the middleware runs directly on the event loop, without a thread
+    pool.  Requests for ``metrics_path`` are answered with a JSON
+    snapshot of ``metrics``.
+
+    In lazy mode the scope's ``repoze.browserid`` is a
+    :class:`repoze.browserid.middleware.LazyBrowserId`, and the cookie
+    is set only if the application called it before starting the
+    response.
+
+    This module requires Python 3.5 or later.
+    """
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        _check_fork()
+        if (self.metrics_path is not None and
+            scope.get('path') == self.metrics_path):
+            await self._send_metrics(send)
+            return
+        environ = scope_to_environ(scope)
+        matcher = self.matcher
+        if matcher is not None and matcher.excluded(environ):
+            if self.metrics is not None:
+                self.metrics.incr('excluded')
+            await self.app(scope, receive, send)
+            return
+        scope = dict(scope)
+        if self.lazy:
+            browser_id, set_cookie = self._verify(environ)
+            lazy = LazyBrowserId(lambda: self._mint(environ), browser_id,
+                                 set_cookie)
+            scope['repoze.browserid'] = lazy
+            if browser_id is not None and set_cookie is None:
+                await self.app(scope, receive, send)
+                return
+            get_set_cookie = lambda: lazy.set_cookie
+        else:
+            browser_id, set_cookie = self._identify(environ)
+            scope['repoze.browserid'] = browser_id
+            if set_cookie is None:
+                await self.app(scope, receive, send)
+                return
+            get_set_cookie = lambda: set_cookie
+
+        async def wrapped_send(message):
+            if message['type'] == 'http.response.start':
+                set_cookie = get_set_cookie()
+                if set_cookie is not None:
+                    message = dict(message)
+                    headers = list(message.get('headers', ()))
+                    headers.append((b'set-cookie', _latin1(set_cookie)))
+                    message['headers'] = headers
+            await send(message)
+
+        await self.app(scope, receive, wrapped_send)
+
+    async def _send_metrics(self, send):
+        body = json.dumps(self.metrics.snapshot(),
+                          sort_keys=True).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': 200,
+                    'headers': [(b'content-type', b'application/json'),
+                                (b'content-length', _latin1(str(len(body)))),
+                                (b'cache-control', b'no-cache')]})
+        await send({'type': 'http.response.body', 'body': body})
+
+
+def scope_to_environ(scope):
+    """
+    Return a WSGI-style environ dictionary holding the request headers
+    (as ``HTTP_*`` keys), ``REQUEST_METHOD``, ``PATH_INFO``,
+    ``QUERY_STRING`` and ``REMOTE_ADDR`` of an ASGI HTTP ``scope``, so
+    that cookie lookup and ``vary`` work as they do under WSGI.
+    Repeated Cookie headers are joined with ``; ``.
+    """
+    environ = {
+        'REQUEST_METHOD': scope.get('method', 'GET'),
+        'PATH_INFO': scope.get('path', ''),
+        'QUERY_STRING': _native(scope.get('query_string', b'')),
+        }
+    client = scope.get('client')
+    if client:
+        environ['REMOTE_ADDR'] = client[0]
+    for name, value in scope.get('headers', ()):
+        key = 'HTTP_' + _native(name).upper().replace('-', '_')
+        value = _native(value)
+        if key in environ:
+            if key == 'HTTP_COOKIE':
+                value = environ[key] + '; ' + value
+            else:
+                value = environ[key] + ',' + value
+        environ[key] = value
+    return environ
@@ -0,0 +1,853 @@
+##############################################################################
+#
+# Copyright (c) 2008 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""
+Benchmarks for the browser id middleware.
+
+Run ``python -m repoze.browserid.bench --help`` for usage.  Each
+benchmark reports the best of several runs in microseconds per
+operation; threaded benchmarks report operations per second across all
+threads, and latency benchmarks percentiles of calls timed one by one.
+``--forked`` instead checks that browser ids minted across forked
+worker processes are unique.  Results can be saved as a baseline and later runs compared
+against it, failing when any benchmark slowed down by more than a
+tolerance.  The interpreter is named at the top of the report, and a
+baseline saved under one interpreter (e.g. CPython) can be compared
+against a run under another (e.g. PyPy).
+"""
+
+import json
+import optparse
+import platform
+import sys
+import threading
+import timeit
+
+from paste.request import get_cookies
+
+from repoze.browserid.middleware import BrowserIdMiddleware
+from repoze.browserid.middleware import CompactIdGenerator
+from repoze.browserid.middleware import CounterIdGenerator
+from repoze.browserid.middleware import Metrics
+from repoze.browserid.middleware import RandomIdGenerator
+from repoze.browserid.middleware import RateLimiter
+from repoze.browserid.middleware import RequestMatcher
+from repoze.browserid.middleware import StartResponseWrapper
+from repoze.browserid.middleware import UserAgentClassifier
+from repoze.browserid._util import _latin1
+from repoze.browserid.middleware import _get_digestmod
+
+SECRET = 'bench-secret-key'
+COOKIE_NAME = 'bid'
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) '
+              'AppleWebKit/537.36 (KHTML, like Gecko) '
+              'Chrome/120.0.0.0 Safari/537.36 Edg/120.0.2210.91')
+# the kind of User-Agent sent by embedded browsers and in-app webviews
+LONG_USER_AGENT = ('Mozilla/5.0 (Linux; Android 14; SM-S918B Build/UP1A.231005.007; '
+                   'wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 '
+                   'Chrome/120.0.6099.193 Mobile Safari/537.36 '
+                   '[FB_IAB/FB4A;FBAV/444.0.0.33.118;FBBV/543547945;'
+                   'FBDM/{density=3.0,width=1080,height=2340};FBLC/en_US;'
+                   'FBRV/0;FBCR/T-Mobile;FBMF/samsung;FBBD/samsung;'
+                   'FBPN/com.facebook.katana;FBDV/SM-S918B;FBSV/14;'
+                   'FBOP/1;FBCA/arm64-v8a:;] (Instagram 312.0.0.32.112 '
+                   'Android; 480dpi; 1080x2340; samsung; SM-S918B; dm3q)')
+# cookieless requests as seen in the access log of a public site: about
+# half come from crawlers, link previewers, monitors and HTTP libraries
+USER_AGENT_MIX = (
+    [ USER_AGENT,
+      LONG_USER_AGENT,
+      'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1_2 like Mac OS X) '
+      'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1.2 '
+      'Mobile/15E148 Safari/604.1',
+      'Mozilla/5.0 (Linux; Android 10; K) AppleWebKit/537.36 (KHTML, '
+      'like Gecko) Chrome/120.0.0.0 Mobile Safari/537.36',
+      'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) '
+      'Gecko/20100101 Firefox/121.0',
+      'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+      '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36' ] * 2 +
+    [ 'Mozilla/5.0 (compatible; Googlebot/2.1; '
+      '+http://www.google.com/bot.html)',
+      'Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko; compatible; '
+      'bingbot/2.0; +http://www.bing.com/bingbot.htm) Chrome/116.0.1938.76 '
+      'Safari/537.36',
+      'Mozilla/5.0 (compatible; AhrefsBot/7.0; +http://ahrefs.com/robot/)',
+      'Mozilla/5.0 (Linux; Android 5.0) AppleWebKit/537.36 (KHTML, like '
+      'Gecko) Mobile Safari/537.36 (compatible; Bytespider; '
+      'spider-feedback@bytedance.com)',
+      'facebookexternalhit/1.1 (+http://www.facebook.com/externalhit_uatext.php)',
+      'Pingdom.com_bot_version_1.4_(http://www.pingdom.com/)',
+      'kube-probe/1.28',
+      'python-requests/2.31.0',
+      'Go-http-client/2.0',
+      'curl/8.4.0',
+      'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like '
+      'Gecko) HeadlessChrome/120.0.0.0 Safari/537.36',
+      '' ])
+# thirty cookies of the kind analytics and consent scripts leave behind
+OTHER_COOKIES = '; '.join(
+    [ '_ga_%s=GS1.1.%d.%d.1.%d.0.0.0' % (chr(65 + x % 26) * 6, 1700000000 + x,
+                                         x * 7919, 1700000000 + x * 3)
+      for x in range(30) ])
+
+_benchmarks = []
+_threaded_benchmarks = []
+_latency_benchmarks = []
+
+
+def benchmark(name):
+    """ Register a benchmark.  The decorated function is called once to
+    set up and returns the zero-argument callable being timed. """
+    def decorator(setup):
+        _benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+def threaded_benchmark(name):
+    """ Register a multi-threaded benchmark, set up like those
+    registered with :func:`benchmark`; the callable is run concurrently
+    from several threads. """
+    def decorator(setup):
+        _threaded_benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+def latency_benchmark(name):
+    """ Register a benchmark, set up like those registered with
+    :func:`benchmark`, whose calls are timed one by one and reported as
+    latency percentiles. """
+    def decorator(setup):
+        _latency_benchmarks.append((name, setup))
+        return setup
+    return decorator
+
+
+def _app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return ['ok']
+
+def _start_response(status, headers, exc_info=None):
+    return _write
+
+def _write(data):
+    pass
+
+def _middleware(**kw):
+    return BrowserIdMiddleware(_app, SECRET, COOKIE_NAME, **kw)
+
+def _cookie_header(middleware, environ=None):
+    cookie_value = middleware.to_cookieval(environ or {},
+                                           middleware.new(0))
+    return '%s; %s=%s' % (OTHER_COOKIES, COOKIE_NAME, cookie_value)
+
+def _call(middleware, environ):
+    def run():
+        middleware(environ.copy(), _start_response)
+    return run
+
+_GENERATORS = {
+    'legacy': None,
+    'random': RandomIdGenerator,
+    'counter': CounterIdGenerator,
+    'compact': CompactIdGenerator,
+    }
+
+def _new(generator):
+    def setup():
+        factory = _GENERATORS[generator]
+        middleware = _middleware(id_generator=factory and factory())
+        time = middleware.time
+        return lambda: middleware.new(time())
+    return setup
+
+for _name in ('legacy', 'random', 'counter', 'compact'):
+    benchmark('new.%s' % _name)(_new(_name))
+    threaded_benchmark('threads.new.%s' % _name)(_new(_name))
+
+
+def _digests():
+    digests = ['md5', 'sha1', 'sha256']
+    try:
+        _get_digestmod('blake2b')
+    except ValueError: # pragma: no cover no blake2b in hashlib
+        pass
+    else:
+        digests.append('blake2b')
+    return digests
+
+def _to_cookieval(**kw):
+    def setup():
+        middleware = _middleware(**kw)
+        browser_id = middleware.new(0)
+        return lambda: middleware.to_cookieval({}, browser_id)
+    return setup
+
+def _from_cookieval(**kw):
+    def setup():
+        middleware = _middleware(**kw)
+        cookie_value = middleware.to_cookieval({}, middleware.new(0))
+        return lambda: middleware.from_cookieval({}, cookie_value)
+    return setup
+
+for _digest in _digests():
+    benchmark('to_cookieval.%s' % _digest)(_to_cookieval(digest=_digest))
+    benchmark('from_cookieval.%s' % _digest)(_from_cookieval(digest=_digest))
+benchmark('from_cookieval.sha256-16-base64')(
+    _from_cookieval(digest='sha256', digest_size=16,
+                    cookie_encoding='base64'))
+benchmark('from_cookieval.cached')(_from_cookieval(verified_cache_size=1000))
+
+def _from_cookieval_keyring(size):
+    def setup():
+        old_keys = [ ('k%d' % x, '%s-%d' % (SECRET, x)) for x in range(size) ]
+        signer = BrowserIdMiddleware(_app, old_keys[0][1], COOKIE_NAME,
+                                     key_id='k0')
+        cookie_value = signer.to_cookieval({}, signer.new(0))
+        middleware = _middleware(key_id='current', old_keys=old_keys)
+        return lambda: middleware.from_cookieval({}, cookie_value)
+    return setup
+
+# verifying a cookie signed with the oldest key costs the same however
+# many keys are kept
+for _size in (1, 10, 1000):
+    benchmark('from_cookieval.keyring.%d' % _size)(
+        _from_cookieval_keyring(_size))
+
+def _hmac(prekeyed, vary=()):
+    def setup():
+        import hmac
+        middleware = _middleware(vary=vary)
+        environ = {'REMOTE_ADDR': '10.1.2.3', 'HTTP_USER_AGENT': USER_AGENT}
+        vary_values = middleware._get_vary_values(environ)
+        message = _latin1(middleware.new(0))
+        digestmod = _get_digestmod('md5')
+        if prekeyed:
+            def run():
+                h = middleware._new_hmac(SECRET, vary_values)
+                h.update(message)
+                return h.hexdigest()
+        else:
+            # as earlier releases did: the vary values are appended to
+            # the key, which is padded and hashed on every call
+            key = _latin1(SECRET + ''.join(vary_values))
+            def run():
+                return hmac.new(key, message, digestmod).hexdigest()
+        return run
+    return setup
+
+# keying an HMAC per call, as earlier releases did, against copying a
+# pre-keyed prototype
+benchmark('hmac.rekeyed')(_hmac(False))
+benchmark('hmac.prekeyed')(_hmac(True))
+benchmark('hmac.vary.rekeyed')(_hmac(False, ('REMOTE_ADDR', 'HTTP_USER_AGENT')))
+benchmark('hmac.vary.prekeyed')(_hmac(True, ('REMOTE_ADDR', 'HTTP_USER_AGENT')))
+
+
+@benchmark('cookie.scan')
+def cookie_scan():
+    middleware = _middleware()
+    environ = {'HTTP_COOKIE': _cookie_header(middleware)}
+    return lambda: middleware._get_cookie_value(environ)
+
+@benchmark('cookie.full_parse')
+def cookie_full_parse():
+    header = _cookie_header(_middleware())
+    return lambda: get_cookies({'HTTP_COOKIE': header})
+
+
+@benchmark('set_cookie.expires')
+def set_cookie_expires():
+    middleware = _middleware(cookie_lifetime=86400, cookie_domain='repoze.org')
+    return lambda: middleware._mint_set_cookie({})
+
+@benchmark('set_cookie.max_age')
+def set_cookie_max_age():
+    middleware = _middleware(cookie_lifetime=86400, cookie_domain='repoze.org',
+                             cookie_expiry='max-age')
+    return lambda: middleware._mint_set_cookie({})
+
+
+def _wsgi(with_cookie, tampered=False, user_agent=USER_AGENT, **kw):
+    def setup():
+        middleware = _middleware(**kw)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/',
+                   'REMOTE_ADDR': '10.1.2.3', 'HTTP_USER_AGENT': user_agent}
+        if with_cookie:
+            header = _cookie_header(middleware, environ)
+            if tampered:
+                header = header[:-1] + (header[-1] == '0' and '1' or '0')
+            environ['HTTP_COOKIE'] = header
+        else:
+            environ['HTTP_COOKIE'] = OTHER_COOKIES
+        return _call(middleware, environ)
+    return setup
+
+benchmark('wsgi.cookie_present')(_wsgi(True))
+benchmark('wsgi.cookie_present.cached')(_wsgi(True, verified_cache_size=1000))
+benchmark('wsgi.cookie_present.metrics')(_wsgi(True, metrics=Metrics()))
+benchmark('wsgi.cookie_present.metrics_timings')(
+    _wsgi(True, metrics=Metrics(timings=True)))
+benchmark('wsgi.cookie_present.refresh')(
+    _wsgi(True, cookie_lifetime=86400, cookie_refresh=3600))
+benchmark('wsgi.cookie_present.refresh.cached')(
+    _wsgi(True, cookie_lifetime=86400, cookie_refresh=3600,
+          verified_cache_size=1000))
+benchmark('wsgi.cookie_absent')(_wsgi(False))
+benchmark('wsgi.cookie_absent.random')(
+    _wsgi(False, id_generator=RandomIdGenerator()))
+benchmark('wsgi.cookie_absent.lazy')(_wsgi(False, lazy=True))
+benchmark('wsgi.tampered')(_wsgi(True, tampered=True))
+benchmark('wsgi.vary')(_wsgi(True, vary=('REMOTE_ADDR', 'HTTP_USER_AGENT')))
+benchmark('wsgi.vary.cookie_absent')(
+    _wsgi(False, vary=('REMOTE_ADDR', 'HTTP_USER_AGENT')))
+benchmark('wsgi.vary.long_user_agent')(
+    _wsgi(True, vary=('REMOTE_ADDR', 'HTTP_USER_AGENT'),
+          user_agent=LONG_USER_AGENT))
+benchmark('wsgi.vary.long_user_agent.cookie_absent')(
+    _wsgi(False, vary=('REMOTE_ADDR', 'HTTP_USER_AGENT'),
+          user_agent=LONG_USER_AGENT, id_generator=RandomIdGenerator()))
+
+def _temp_path(suffix):
+    import atexit
+    import os
+    import tempfile
+    fd, path = tempfile.mkstemp(suffix)
+    os.close(fd)
+    atexit.register(os.remove, path)
+    return path
+
+def _sqlite_registry():
+    from repoze.browserid.registry import SQLiteRegistry
+    return SQLiteRegistry(_temp_path('.db'))
+
+@benchmark('wsgi.cookie_present.registry.sqlite')
+def wsgi_cookie_present_registry():
+    return _wsgi(True, registry=_sqlite_registry())()
+
+@benchmark('wsgi.cookie_absent.registry.sqlite')
+def wsgi_cookie_absent_registry():
+    return _wsgi(False, registry=_sqlite_registry(),
+                 id_generator=RandomIdGenerator())()
+
+def _events(sink):
+    from repoze.browserid.events import EventQueue
+    from repoze.browserid.events import JSONLinesSink
+    from repoze.browserid.events import SQLiteSink
+    if sink == 'jsonl':
+        sink = JSONLinesSink(_temp_path('.jsonl'))
+    else:
+        sink = SQLiteSink(_temp_path('.db'))
+    # big enough that nothing is dropped during a default run
+    return EventQueue(sink, maxsize=1000000)
+
+def _wsgi_events(sink):
+    def setup():
+        return _wsgi(False, id_generator=RandomIdGenerator(),
+                     vary=('REMOTE_ADDR',), events=_events(sink))()
+    return setup
+
+# compare with wsgi.cookie_absent.random, which records nothing
+for _sink in ('jsonl', 'sqlite'):
+    benchmark('wsgi.cookie_absent.events.%s' % _sink)(_wsgi_events(_sink))
+
+@benchmark('events.put')
+def events_put():
+    events = _events('jsonl')
+    event = {'browser_id': 'x' * 40, 'time': 0, 'pid': 1, 'vary': {}}
+    return lambda: events.put(event)
+
+def _wsgi_hosts(host):
+    def setup():
+        from repoze.browserid.hosts import HostBrowserIdMiddleware
+        hosts = {}
+        for x in range(100):
+            hosts['www.site%d.example' % x] = {
+                'secret_key': '%s-%d' % (SECRET, x)}
+            hosts['*.tenant%d.example' % x] = {
+                'secret_key': '%s-%d' % (SECRET, x),
+                'cookie_domain': '.tenant%d.example' % x}
+        middleware = HostBrowserIdMiddleware(_app, hosts,
+                                             cookie_name=COOKIE_NAME)
+        environ = {'HTTP_HOST': host}
+        environ['HTTP_COOKIE'] = _cookie_header(middleware.resolve(environ))
+        return _call(middleware, environ)
+    return setup
+
+# 200 hosts; compare with wsgi.cookie_present
+benchmark('wsgi.hosts.exact')(_wsgi_hosts('www.site42.example'))
+benchmark('wsgi.hosts.port')(_wsgi_hosts('WWW.site42.example:8080'))
+benchmark('wsgi.hosts.wildcard')(_wsgi_hosts('shop.eu.tenant42.example'))
+
+def _cycle(function, arguments):
+    import itertools
+    arguments = itertools.cycle(arguments)
+    def run():
+        function(next(arguments))
+    return run
+
+@benchmark('classify.mix')
+def classify_mix():
+    return _cycle(UserAgentClassifier().is_bot, USER_AGENT_MIX)
+
+@benchmark('classify.mix.uncached')
+def classify_mix_uncached():
+    return _cycle(UserAgentClassifier(cache_size=0).is_bot, USER_AGENT_MIX)
+
+def _wsgi_mix(**kw):
+    def setup():
+        middleware = _middleware(id_generator=RandomIdGenerator(), **kw)
+        environs = [ {'HTTP_USER_AGENT': user_agent,
+                      'HTTP_COOKIE': OTHER_COOKIES}
+                     for user_agent in USER_AGENT_MIX ]
+        return _cycle(lambda environ: middleware(environ.copy(),
+                                                 _start_response),
+                      environs)
+    return setup
+
+benchmark('wsgi.cookie_absent.mix')(_wsgi_mix())
+benchmark('wsgi.cookie_absent.mix.bots')(
+    _wsgi_mix(bot_classifier=UserAgentClassifier()))
+benchmark('wsgi.cookie_absent.mix.bots.sentinel')(
+    _wsgi_mix(bot_classifier=UserAgentClassifier(), bot_browser_id='bot'))
+
+# a client sending the same bad cookie over and over; the random
+# generator keeps the cost of minting small next to that of the check
+for _vary in ((), ('REMOTE_ADDR', 'HTTP_USER_AGENT')):
+    _name = 'wsgi.tampered.random' + (_vary and '.vary' or '')
+    benchmark(_name)(_wsgi(True, tampered=True, vary=_vary,
+                           id_generator=RandomIdGenerator()))
+    benchmark(_name + '.rejected_cache')(
+        _wsgi(True, tampered=True, vary=_vary,
+              id_generator=RandomIdGenerator(), rejected_cache_size=1000))
+# a client minting far beyond its allowance; compare with
+# wsgi.cookie_absent.random
+benchmark('wsgi.cookie_absent.throttled')(
+    _wsgi(False, id_generator=RandomIdGenerator(),
+          mint_limiter=RateLimiter(0.001, 1)))
+
+def _rate_limiter():
+    limiter = RateLimiter(1000000, 1000000)
+    environs = [ {'REMOTE_ADDR': '10.0.%d.%d' % (x // 256, x % 256)}
+                 for x in range(1000) ]
+    return _cycle(limiter.allow, environs)
+
+# 1000 clients
+benchmark('rate_limiter.allow')(_rate_limiter)
+threaded_benchmark('threads.rate_limiter.allow')(_rate_limiter)
+
+# every request is a first visit; the pool starts empty, so it is
+# drained and refilled by its thread while the requests are timed
+latency_benchmark('latency.first_visit')(_wsgi(False))
+latency_benchmark('latency.first_visit.random')(
+    _wsgi(False, id_generator=RandomIdGenerator()))
+latency_benchmark('latency.first_visit.pool')(
+    _wsgi(False, id_generator=RandomIdGenerator(), pool_high_watermark=1000))
+latency_benchmark('latency.cookie_present')(_wsgi(True))
+
+@benchmark('wsgi.cookie_absent.pool')
+def wsgi_cookie_absent_pool():
+    middleware = _middleware(id_generator=RandomIdGenerator(),
+                             pool_high_watermark=100000)
+    middleware.id_pool.refill()
+    return _call(middleware, {'HTTP_COOKIE': OTHER_COOKIES})
+
+@benchmark('wsgi.excluded')
+def wsgi_excluded():
+    middleware = _middleware(exclude_paths=('/static/', '/healthz', '*.ico'),
+                             exclude_methods=('HEAD',))
+    return _call(middleware, {'REQUEST_METHOD': 'GET',
+                              'PATH_INFO': '/static/css/site.css'})
+
+# the requests behind one page view of a typical site, plus the probes
+# and preflights it receives: most never use the browser id
+ROUTE_MIX = (
+    ('GET', '/'),
+    ('GET', '/products/shoes/running/men'),
+    ('POST', '/api/v2/cart/items'),
+    ('GET', '/api/v2/recommendations'),
+    ('GET', '/static/css/site.3f9a2c.css'),
+    ('GET', '/static/js/vendor.81bd0e.js'),
+    ('GET', '/static/js/app.c44f12.js'),
+    ('GET', '/static/img/logo.svg'),
+    ('GET', '/media/products/4711/large.webp'),
+    ('GET', '/media/products/4712/large.webp'),
+    ('GET', '/fonts/inter-var.woff2'),
+    ('GET', '/favicon.ico'),
+    ('GET', '/robots.txt'),
+    ('GET', '/healthz'),
+    ('HEAD', '/'),
+    ('OPTIONS', '/api/v2/cart/items'),
+    )
+ROUTE_RULES = {
+    'exclude_paths': ('/static/', '/media/', '/fonts/', '/healthz',
+                      '*.ico', '/robots.txt'),
+    'exclude_methods': ('HEAD', 'OPTIONS'),
+    }
+
+def _route_environs():
+    return [ {'REQUEST_METHOD': method, 'PATH_INFO': path,
+              'HTTP_USER_AGENT': USER_AGENT}
+             for method, path in ROUTE_MIX ]
+
+@benchmark('match.route_mix')
+def match_route_mix():
+    matcher = RequestMatcher(ROUTE_RULES['exclude_paths'], (),
+                             ROUTE_RULES['exclude_methods'])
+    return _cycle(matcher.excluded, _route_environs())
+
+def _wsgi_route_mix(**kw):
+    def setup():
+        middleware = _middleware(**kw)
+        environs = _route_environs()
+        header = _cookie_header(middleware)
+        for environ in environs:
+            environ['HTTP_COOKIE'] = header
+        return _cycle(lambda environ: middleware(environ.copy(),
+                                                 _start_response),
+                      environs)
+    return setup
+
+# a returning browser loading a page; compare with wsgi.cookie_present
+benchmark('wsgi.route_mix')(_wsgi_route_mix(**ROUTE_RULES))
+benchmark('wsgi.route_mix.no_rules')(_wsgi_route_mix())
+
+
+_BODY_CHUNK = b'x' * 65536
+_BODY_CHUNKS = 128 # 8MB
+
+def _writing_app(environ, start_response):
+    write = start_response('200 OK', [('Content-Type', 'text/plain')])
+    for x in range(_BODY_CHUNKS):
+        write(_BODY_CHUNK)
+    return []
+
+@benchmark('stream.first_byte')
+def stream_first_byte():
+    """ Time until the first byte of an 8MB body written with ``write()``
+    reaches the server. """
+    middleware = BrowserIdMiddleware(_writing_app, SECRET, COOKIE_NAME)
+    class FirstByte(Exception):
+        pass
+    def start_response(status, headers, exc_info=None):
+        def write(data):
+            raise FirstByte
+        return write
+    def run():
+        try:
+            middleware({}, start_response)
+        except FirstByte:
+            pass
+    return run
+
+@benchmark('stream.first_byte.buffered')
+def stream_first_byte_buffered():
+    """ The same, buffering the response as earlier releases did. """
+    class FirstByte(Exception):
+        pass
+    def start_response(status, headers, exc_info=None):
+        def write(data):
+            raise FirstByte
+        return write
+    def run():
+        wrapper = StartResponseWrapper(start_response)
+        _writing_app({}, wrapper.wrap_start_response)
+        try:
+            wrapper.finish_response([('Set-Cookie', 'x')])
+        except FirstByte:
+            pass
+    return run
+
+
+def cookie_sizes():
+    """ Return the length of the Set-Cookie value and of the cookie value
+    sent back on every request, for several digest and encoding
+    settings. """
+    configs = [('md5/hex', {}),
+               ('md5/base64', {'cookie_encoding': 'base64'}),
+               ('sha256/hex', {'digest': 'sha256'}),
+               ('sha256-16/base64', {'digest': 'sha256', 'digest_size': 16,
+                                     'cookie_encoding': 'base64'}),
+               ('compact/sha256-16/base64',
+                {'digest': 'sha256', 'digest_size': 16,
+                 'cookie_encoding': 'base64',
+                 'id_generator': CompactIdGenerator()})]
+    sizes = []
+    for name, kw in configs:
+        middleware = _middleware(**kw)
+        browser_id, set_cookie = middleware._mint_set_cookie({})
+        cookie_value = middleware.to_cookieval({}, browser_id)
+        sizes.append((name, len(set_cookie), len(COOKIE_NAME) + 1 +
+                      len(cookie_value)))
+    return sizes
+
+
+def stream_memory():
+    """ Return a list of ``(name, bytes)`` tuples giving the peak
+    memory allocated while an 8MB body written with ``write()`` passes
+    through the middleware, and through ``StartResponseWrapper`` as in
+    earlier releases, or an empty list if ``tracemalloc`` is missing
+    (Python 2). """
+    try:
+        import tracemalloc
+    except ImportError: # pragma: no cover Python 2
+        return []
+    def streamed():
+        middleware = BrowserIdMiddleware(_writing_app, SECRET, COOKIE_NAME)
+        middleware({}, _start_response)
+    def buffered():
+        wrapper = StartResponseWrapper(_start_response)
+        _writing_app({}, wrapper.wrap_start_response)
+        wrapper.finish_response([('Set-Cookie', 'x')])
+    peaks = []
+    for name, func in (('streamed', streamed), ('buffered', buffered)):
+        tracemalloc.start()
+        try:
+            func()
+            peaks.append((name, tracemalloc.get_traced_memory()[1]))
+        finally:
+            tracemalloc.stop()
+    return peaks
+
+def run_forked(generator, workers=4, count=250000):
+    """ Mint ``count`` browser ids with ``generator`` (a name, e.g.
+    ``legacy``) in each of ``workers`` processes forked after the
+    middleware was created, as under a preforking server, and return a
+    tuple of the number of ids minted, the number of distinct ones and
+    the number minted per second across the workers. """
+    import os
+    import shutil
+    import tempfile
+    factory = _GENERATORS[generator]
+    middleware = _middleware(id_generator=factory and factory())
+    # the parent has served requests before forking
+    middleware.new(middleware.time())
+    tempdir = tempfile.mkdtemp()
+    try:
+        paths = [ os.path.join(tempdir, str(x)) for x in range(workers) ]
+        started = timeit.default_timer()
+        pids = []
+        for path in paths:
+            pid = os.fork()
+            if pid == 0: # pragma: no cover (child)
+                try:
+                    new = middleware.new
+                    time = middleware.time
+                    f = open(path, 'w')
+                    for x in range(count):
+                        f.write(new(time()) + '\n')
+                    f.close()
+                finally:
+                    os._exit(0)
+            pids.append(pid)
+        for pid in pids:
+            os.waitpid(pid, 0)
+        elapsed = timeit.default_timer() - started
+        minted = 0
+        distinct = set()
+        for path in paths:
+            f = open(path)
+            for line in f:
+                minted += 1
+                distinct.add(line)
+            f.close()
+    finally:
+        shutil.rmtree(tempdir)
+    return minted, len(distinct), minted / elapsed
+
+PERCENTILES = (50, 99, 99.9)
+
+def _percentile_name(name, percentile):
+    return '%s.p%s' % (name, ('%g' % percentile).replace('.', ''))
+
+def run_latency_benchmark(setup, number):
+    """ Return a dictionary mapping each of :data:`PERCENTILES` to
+    that percentile of the latencies, in microseconds, of ``number``
+    calls timed one by one. """
+    func = setup()
+    timer = timeit.default_timer
+    latencies = []
+    for x in range(number):
+        started = timer()
+        func()
+        latencies.append(timer() - started)
+    latencies.sort()
+    last = len(latencies) - 1
+    return dict([ (percentile,
+                   latencies[min(int(len(latencies) * percentile / 100),
+                                 last)] * 1000000)
+                  for percentile in PERCENTILES ])
+
+def run_benchmark(setup, number, repeat):
+    """ Return the best time, in microseconds per call, of ``repeat``
+    runs of ``number`` calls each. """
+    timer = timeit.Timer(setup())
+    return min(timer.repeat(repeat, number)) / number * 1000000
+
+def run_threaded_benchmark(setup, number, threads):
+    """ Return the number of calls per second achieved by ``threads``
+    threads each making ``number`` calls. """
+    func = setup()
+    barrier = threading.Event()
+    def work():
+        barrier.wait()
+        for x in range(number):
+            func()
+    workers = [ threading.Thread(target=work) for x in range(threads) ]
+    for worker in workers:
+        worker.start()
+    started = timeit.default_timer()
+    barrier.set()
+    for worker in workers:
+        worker.join()
+    elapsed = timeit.default_timer() - started
+    return number * threads / elapsed
+
+def run(names=None, number=10000, repeat=3, threads=(1, 2, 4, 8)):
+    """ Run the benchmarks whose names contain any of ``names`` (all of
+    them by default) and return a dictionary of results. """
+    def selected(name):
+        return not names or [ x for x in names if x in name ]
+    results = {}
+    for name, setup in _benchmarks:
+        if selected(name):
+            results[name] = run_benchmark(setup, number, repeat)
+    for name, setup in _threaded_benchmarks:
+        for count in threads:
+            threaded_name = '%s.%d' % (name, count)
+            if selected(threaded_name):
+                results[threaded_name] = run_threaded_benchmark(
+                    setup, max(number // count, 1), count)
+    for name, setup in _latency_benchmarks:
+        if [ x for x in PERCENTILES
+             if selected(_percentile_name(name, x)) ]:
+            latencies = run_latency_benchmark(setup, number)
+            for percentile in PERCENTILES:
+                results[_percentile_name(name, percentile)] = \
+                    latencies[percentile]
+    return results
+
+def compare(results, baseline, tolerance):
+    """ Return a list of ``(name, result, baseline)`` tuples for the
+    benchmarks in ``results`` which regressed by more than ``tolerance``
+    (a fraction) relative to ``baseline``.  Threaded results are rates,
+    so for them lower is worse. """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        result, base = results[name], baseline[name]
+        if name.startswith('threads.'):
+            regressed = result < base * (1 - tolerance)
+        else:
+            regressed = result > base * (1 + tolerance)
+        if regressed:
+            regressions.append((name, result, base))
+    return regressions
+
+def main(argv=sys.argv, out=sys.stdout):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [name-substring ...]')
+    parser.add_option('-n', '--number', type='int', default=10000,
+                      help='calls per run (default %default)')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='runs per benchmark; the best is kept '
+                           '(default %default)')
+    parser.add_option('-t', '--threads', default='1,2,4,8',
+                      help='comma-separated thread counts for threaded '
+                           'benchmarks (default %default)')
+    parser.add_option('-s', '--save', metavar='FILE',
+                      help='save the results as a JSON baseline')
+    parser.add_option('-c', '--compare', metavar='FILE',
+                      help='compare the results against a saved baseline')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='fraction by which a benchmark may regress '
+                           'before --compare fails (default %default)')
+    parser.add_option('--forked', type='int', metavar='IDS',
+                      help='instead of benchmarking, mint IDS browser ids '
+                           'with each generator across forked workers '
+                           'and fail if any was minted twice')
+    parser.add_option('-w', '--workers', type='int', default=4,
+                      help='worker processes for --forked '
+                           '(default %default)')
+    options, names = parser.parse_args(argv[1:])
+    if options.forked:
+        return main_forked(options.forked, options.workers, names, out)
+    threads = [ int(x) for x in options.threads.split(',') if x ]
+    results = run(names, options.number, options.repeat, threads)
+    baseline = {}
+    if options.compare:
+        f = open(options.compare)
+        try:
+            baseline = json.load(f)
+        finally:
+            f.close()
+    out.write('%s %s\n' % (platform.python_implementation(),
+                           platform.python_version()))
+    for name in sorted(results):
+        if name.startswith('threads.'):
+            unit = 'ops/s'
+        elif name.startswith('latency.'):
+            unit = 'usec'
+        else:
+            unit = 'usec/op'
+        line = '%-45s %12.2f %s' % (name, results[name], unit)
+        if name in baseline:
+            line += '  (baseline %.2f)' % baseline[name]
+        out.write(line + '\n')
+    if not names:
+        out.write('\n%-45s %12s %12s\n' % ('cookie size (bytes)',
+                                           'Set-Cookie', 'Cookie'))
+        for name, set_cookie, cookie in cookie_sizes():
+            out.write('%-45s %12d %12d\n' % (name, set_cookie, cookie))
+        peaks = stream_memory()
+        if peaks:
+            out.write('\n%-45s %12s\n' % ('peak memory, 8MB body (bytes)',
+                                           'allocated'))
+            for name, peak in peaks:
+                out.write('%-45s %12d\n' % (name, peak))
+    if options.save:
+        f = open(options.save, 'w')
+        try:
+            json.dump(results, f, indent=1, sort_keys=True)
+        finally:
+            f.close()
+    if options.compare:
+        regressions = compare(results, baseline, options.tolerance)
+        for name, result, base in regressions:
+            out.write('REGRESSION %s: %.2f (baseline %.2f)\n' %
+                      (name, result, base))
+        if regressions:
+            return 1
+    return 0
+
+def main_forked(count, workers, names, out):
+    """ Report the outcome of :func:`run_forked` for each generator
+    whose ``forked.new.<name>`` contains any of ``names``; return 1 if
+    any generator minted a browser id twice. """
+    out.write('%s %s, %d workers\n' % (platform.python_implementation(),
+                                        platform.python_version(), workers))
+    status = 0
+    for generator in sorted(_GENERATORS):
+        name = 'forked.new.%s' % generator
+        if names and not [ x for x in names if x in name ]:
+            continue
+        minted, distinct, rate = run_forked(generator, workers,
+                                            max(count // workers, 1))
+        out.write('%-45s %12.2f ids/s  %d ids, %d duplicates\n' %
+                  (name, rate, minted, minted - distinct))
+        if distinct != minted:
+            status = 1
+    return status
+
+if __name__ == '__main__': # pragma: no cover
+    sys.exit(main())
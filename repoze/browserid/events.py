@@ -0,0 +1,212 @@
+##############################################################################
+#
+# Copyright (c) 2008 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""
+Recording of the browser ids handed out by the middleware.
+
+Each time the middleware hands out a new browser id it puts an event, a
+dictionary with ``browser_id``, ``time``, ``pid`` and ``vary`` (the
+values of the ``vary`` environ keys) keys, on an :class:`EventQueue`.
+A background thread takes the events off the queue and writes them to
+a sink in batches, so the request never waits for the write.
+"""
+
+import atexit
+import collections
+import json
+import threading
+
+from repoze.browserid._util import _BackgroundWorker
+from repoze.browserid._util import _FORK_SENSITIVE
+
+
+class EventQueue(_BackgroundWorker):
+    """ A bounded queue of events written to ``sink`` in batches.
+
+    A background thread wakes when events are queued and writes them
+    in batches of up to ``batch_size`` once a batch is full or
+    ``flush_interval`` seconds have passed.  Once
+    ``maxsize`` events are waiting, the ``policy`` decides what
+    :meth:`put` does: ``drop`` (the default) discards the event,
+    counting it in ``dropped``, so requests never wait; ``block`` waits
+    for room.  Events the sink failed to write are counted in
+    ``errors``.  Waiting events are written when the interpreter exits.
+    In a forked child the queue starts empty, the waiting events being
+    the parent's to write.
+
+    Like :class:`repoze.browserid.middleware.IdPool`, the queue is a
+    deque whose appends and pops need no lock, so queueing an event
+    costs the request little more than a list append; the bound is
+    therefore approximate under concurrency.
+    """
+    def __init__(self, sink, maxsize=10000, policy='drop', batch_size=100,
+                 flush_interval=1.0):
+        if policy not in ('drop', 'block'):
+            raise ValueError('Unknown policy %r' % policy)
+        self.sink = sink
+        self.maxsize = maxsize
+        self.policy = policy
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+        atexit.register(self.flush)
+
+    def _after_fork(self):
+        self._events = collections.deque()
+        self._wakeup = threading.Event()
+        self._full = threading.Event()
+        self._room = threading.Event()
+        self._write_lock = threading.Lock()
+        self._reset_worker()
+
+    def __len__(self):
+        return len(self._events)
+
+    def put(self, event):
+        events = self._events
+        if len(events) >= self.maxsize:
+            if self.policy == 'drop':
+                self.dropped += 1
+                return
+            while len(events) >= self.maxsize:
+                self._room.clear()
+                self._full.set()
+                self._room.wait(self.flush_interval)
+        events.append(event)
+        if not self._wakeup.is_set():
+            if self._thread is None:
+                self._start()
+            self._wakeup.set()
+        if len(events) >= self.batch_size and not self._full.is_set():
+            self._full.set()
+
+    def flush(self):
+        """ Write the waiting events now. """
+        events = self._events
+        while events:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(events.popleft())
+            except IndexError:
+                pass
+            self._write(batch)
+            self._room.set()
+
+    def _write(self, batch):
+        self._write_lock.acquire()
+        try:
+            try:
+                self.sink.write(batch)
+            except Exception:
+                # the worker must survive a failing sink
+                self.errors += len(batch)
+            else:
+                self.written += len(batch)
+        finally:
+            self._write_lock.release()
+
+    def _run(self):
+        wakeup = self._wakeup
+        full = self._full
+        while 1:
+            wakeup.wait()
+            wakeup.clear()
+            if len(self._events) < self.batch_size:
+                full.wait(self.flush_interval)
+            full.clear()
+            self.flush()
+
+
+class JSONLinesSink(object):
+    """ Appends each event, as a line of JSON, to the file at ``path``,
+    which several processes may share. """
+    def __init__(self, path):
+        self.path = path
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        self._file = None
+
+    def write(self, events):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        lines = [ json.dumps(event) + '\n'
+                  for event in events ]
+        # one write per batch, so that the lines of processes sharing
+        # the file don't interleave
+        self._file.write(''.join(lines))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class SQLiteSink(object):
+    """ Inserts events into ``table`` of the SQLite database at
+    ``path``, one transaction per batch. """
+    def __init__(self, path, table='browserid_events', timeout=5.0):
+        self.path = path
+        self.table = table
+        self.timeout = timeout
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        self._connection = None
+
+    def write(self, events):
+        connection = self._connection
+        if connection is None:
+            import sqlite3
+            # only the writing thread uses the connection, but that
+            # may be the thread flushing at exit
+            connection = sqlite3.connect(self.path, timeout=self.timeout,
+                                         check_same_thread=False)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s ('
+                'browser_id TEXT NOT NULL, '
+                'time REAL NOT NULL, '
+                'pid INTEGER NOT NULL, '
+                'vary TEXT NOT NULL)' % self.table)
+            self._connection = connection
+        connection.executemany(
+            'INSERT INTO %s VALUES (?, ?, ?, ?)' % self.table,
+            [ (event['browser_id'], event['time'], event['pid'],
+               json.dumps(event['vary']))
+              for event in events ])
+        connection.commit()
+
+    def close(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+
+def sink_from_url(url):
+    """ Return a sink described by ``url``: ``jsonl:<path>`` or
+    ``sqlite:<path>``. """
+    scheme, sep, path = url.partition(':')
+    if path:
+        if scheme == 'jsonl':
+            return JSONLinesSink(path)
+        if scheme == 'sqlite':
+            return SQLiteSink(path)
+    raise ValueError('Unknown event sink %r' % url)
@@ -0,0 +1,185 @@
+##############################################################################
+#
+# Copyright (c) 2008 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""
+Browser ids for many hostnames served by one application.
+
+Each host pattern gets its own cookie name, domain, secret key, vary
+settings and so on, held by a :class:`BrowserIdMiddleware` built for it
+when the table is loaded, so every host's Set-Cookie template and HMAC
+keys are compiled once.  Requests are handed to the middleware of their
+host.
+"""
+
+from repoze.browserid.middleware import BrowserIdMiddleware
+from repoze.browserid.middleware import LRUCache
+from repoze.browserid.middleware import _make_shared
+from repoze.browserid.middleware import make_middleware
+
+
+class HostBrowserIdMiddleware(object):
+    """ Dispatches each request to the browser id middleware configured
+    for the host it was sent to.
+
+    ``hosts`` maps host patterns to either a dictionary of
+    :class:`repoze.browserid.middleware.BrowserIdMiddleware` keyword
+    arguments, combined with the keyword arguments common to every host
+    given as ``defaults``, or an already constructed middleware wrapping
+    ``app``.  A pattern is a hostname (``www.example.com``), a wildcard
+    matching every subdomain of a domain (``*.example.com``, which does
+    not match ``example.com`` itself) or ``*``, matching any host.  The
+    most specific pattern wins.  Requests to a host matching no pattern
+    are passed to ``app`` untouched, without a browser id.
+
+    The host is taken from the Host header, or ``SERVER_NAME`` in its
+    absence, ignoring case, any port and a trailing dot.  A request for
+    a host named exactly as configured costs a single dict lookup.
+    Other Host header values are resolved (one lookup per label of the
+    hostname for wildcards) and the outcome is remembered in an
+    :class:`repoze.browserid.middleware.LRUCache` of ``cache_size``
+    entries, bounded because clients choose the Host header.
+    """
+    def __init__(self, app, hosts, factory=BrowserIdMiddleware,
+                 cache_size=1024, **defaults):
+        self.app = app
+        self.exact = {}
+        self.wildcards = {}
+        self.default = app
+        self.resolved_cache = LRUCache(cache_size)
+        for pattern, config in hosts.items():
+            if isinstance(config, dict):
+                kw = dict(defaults)
+                kw.update(config)
+                config = factory(app, **kw)
+            pattern = _normalize_host(pattern)
+            if pattern == '*':
+                self.default = config
+            elif pattern.startswith('*.'):
+                self.wildcards[pattern[1:]] = config
+            else:
+                self.exact[pattern] = config
+
+    def __call__(self, environ, start_response):
+        return self.resolve(environ)(environ, start_response)
+
+    def resolve(self, environ):
+        """ Return the middleware serving the request described by
+        ``environ``, or the application if no pattern matches. """
+        host = environ.get('HTTP_HOST') or environ.get('SERVER_NAME', '')
+        middleware = self.exact.get(host)
+        if middleware is not None:
+            return middleware
+        cache = self.resolved_cache
+        middleware = cache.get(host)
+        if middleware is None:
+            middleware = self._lookup(_normalize_host(host))
+            cache.set(host, middleware)
+        return middleware
+
+    def _lookup(self, host):
+        middleware = self.exact.get(host)
+        if middleware is not None:
+            return middleware
+        wildcards = self.wildcards
+        if wildcards:
+            pos = host.find('.')
+            while pos != -1:
+                middleware = wildcards.get(host[pos:])
+                if middleware is not None:
+                    return middleware
+                pos = host.find('.', pos + 1)
+        return self.default
+
+def _normalize_host(host):
+    """ Return ``host`` lowercased, without a port or trailing dot. """
+    host = host.lower()
+    if host.startswith('['):
+        # an IPv6 address
+        return host[:host.find(']') + 1]
+    return host.partition(':')[0].rstrip('.')
+
+def load_hosts_file(path):
+    """
+    Return the host table held in the INI-style file at ``path`` as a
+    dictionary mapping each section name, a host pattern, to a
+    dictionary of its options.  Options of the ``DEFAULT`` section apply
+    to every host.
+    """
+    try:
+        from configparser import RawConfigParser
+    except ImportError: # pragma: no cover Python 2
+        from ConfigParser import RawConfigParser
+    parser = RawConfigParser()
+    if not parser.read(path):
+        raise ValueError('Cannot read hosts file %r' % path)
+    return dict([ (section, dict(parser.items(section)))
+                  for section in parser.sections() ])
+
+# the objects shared by the hosts, each named after its option and
+# followed by the other options it is built from
+_SHARED_GROUPS = (
+    ('id_generator',),
+    ('metrics', 'metrics_timings'),
+    ('registry',),
+    ('events', 'events_queue_size', 'events_policy'),
+    ('mint_limiter', 'mint_rate', 'mint_burst', 'mint_limit_keys'),
+    )
+_SHARED_OPTIONS = ('metrics_path',) + sum(_SHARED_GROUPS, ())
+
+def make_host_middleware(app, global_conf, hosts_file=None, **local_conf):
+    """
+    Return a :class:`HostBrowserIdMiddleware`.  Usually used as a
+    PasteDeploy filter_app_factory callback.
+
+    Options accepted by
+    :func:`repoze.browserid.middleware.make_middleware` apply to every
+    host.  An option may be given for a single host pattern by suffixing
+    its name with ``@`` and the pattern, e.g. ``secret_key@example.com``
+    or ``cookie_domain@*.example.org``.
+
+    ``hosts_file``
+       The path of an INI-style file with a section per host pattern
+       holding that host's options, read in addition to the ``@``
+       options.
+
+    The id generator, metrics, registry, event queue and minting rate
+    limiter are built once and shared by every host which doesn't
+    configure its own; a host setting any of the options an object is
+    built from (e.g. ``events_policy@example.com``) gets its own.
+    """
+    common = {}
+    hosts = {}
+    if hosts_file:
+        hosts.update(load_hosts_file(hosts_file))
+    for name, value in local_conf.items():
+        name, sep, pattern = name.partition('@')
+        if sep:
+            hosts.setdefault(pattern.strip(), {})[name.strip()] = value
+        else:
+            common[name] = value
+    if not hosts:
+        raise ValueError('No hosts configured')
+    shared = _make_shared(**dict([ (name, common[name])
+                                   for name in _SHARED_OPTIONS
+                                   if name in common ]))
+    middlewares = {}
+    for pattern, options in hosts.items():
+        kw = dict(common)
+        for group in _SHARED_GROUPS:
+            if not [ name for name in group if name in options ]:
+                kw[group[0]] = shared[group[0]]
+        kw.update(options)
+        if 'secret_key' not in kw:
+            raise ValueError('No secret_key for host %r' % pattern)
+        middlewares[pattern] = make_middleware(app, global_conf, **kw)
+    return HostBrowserIdMiddleware(app, middlewares)
@@ -12,26 +12,96 @@
 #
 ##############################################################################
 
+import base64
+import binascii
+import collections
 import hmac
+import io
+import itertools
+import json
 import os
 import random
-import StringIO
+import re
+import string
+import struct
 import time
 import threading
+import weakref
+from timeit import default_timer
 try:
+    import hashlib
     from hashlib import sha1 as sha
 except ImportError: #pragma NO COVER Python < 2.5
+    hashlib = None
     from sha import new as sha
+try:
+    from hmac import compare_digest
+except ImportError: #pragma NO COVER Python < 2.7.7
+    def compare_digest(a, b):
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
 
 from paste.request import get_cookies
 
+from repoze.browserid._util import _BackgroundWorker
+from repoze.browserid._util import _FORK_HOOKS
+from repoze.browserid._util import _FORK_SENSITIVE
+from repoze.browserid._util import _after_fork
+from repoze.browserid._util import _check_fork
+from repoze.browserid._util import _getpid
+from repoze.browserid._util import _latin1
+from repoze.browserid._util import _maketrans
+from repoze.browserid._util import _native
+
+def _key_bytes(secret_key):
+    """ Return ``secret_key`` as bytes; text is encoded as UTF-8. """
+    if isinstance(secret_key, bytes):
+        return secret_key
+    return secret_key.encode('utf-8')
+
+# key ids travel in the cookie value, between '!' separators
+_KEY_ID = re.compile(r'[A-Za-z0-9_.-]*\Z')
+
+def _compare_mac(expected, provided):
+    """ Compare two MACs in constant time.  ``provided`` comes from
+    the browser and, under Python 3, may hold non-ASCII text, which
+    ``compare_digest`` refuses. """
+    try:
+        return compare_digest(expected, provided)
+    except TypeError: # pragma: no cover Python 3
+        return False
+
 _RANDS = []
 _CURRENT_PERIOD = None
 _LOCK = threading.Lock()
 
 
+def _reset_legacy_state():
+    """
+    Restore the state of the legacy id generator in a forked child,
+    which would otherwise share the parent's random state and
+    recently-issued randoms.  The global lock is replaced too, as
+    another thread may have held it at the time of the fork.
+    """
+    global _CURRENT_PERIOD, _LOCK
+    _RANDS[:] = []
+    _CURRENT_PERIOD = None
+    _LOCK = threading.Lock()
+    random.seed()
+
+_FORK_HOOKS.append(_reset_legacy_state)
+
+
 class BrowserIdMiddleware(object):
 
+    # the number of HMAC objects kept, having absorbed distinct vary
+    # values, when varying
+    hmac_cache_size = 1024
+
     def __init__(self, app,
                  secret_key,
                  cookie_name,
@@ -40,6 +110,32 @@ class BrowserIdMiddleware(object):
                  cookie_lifetime=None,
                  cookie_secure=False,
                  vary=(),
+                 id_generator=None,
+                 cookie_expiry='expires',
+                 verified_cache_size=0,
+                 verified_cache_ttl=None,
+                 digest='md5',
+                 digest_size=None,
+                 cookie_encoding='hex',
+                 pool_high_watermark=0,
+                 pool_low_watermark=None,
+                 lazy=False,
+                 exclude_paths=(),
+                 include_paths=(),
+                 exclude_methods=(),
+                 exclude_user_agents=(),
+                 metrics=None,
+                 metrics_path=None,
+                 key_id=None,
+                 old_keys=(),
+                 registry=None,
+                 events=None,
+                 cookie_refresh=None,
+                 bot_classifier=None,
+                 bot_browser_id=None,
+                 mint_limiter=None,
+                 rejected_cache_size=0,
+                 rejected_cache_ttl=60,
                  ):
         """
         Construct an object suitable for use as WSGI middleware that
@@ -75,23 +171,240 @@ class BrowserIdMiddleware(object):
 
         ``vary``
            A sequence of string header names on which to vary.
+
+        ``id_generator``
+           A callable accepting the current time and returning a new
+           browser id, e.g. an instance of :class:`RandomIdGenerator` or
+           :class:`CounterIdGenerator`.  Defaults to ``None``, meaning
+           use the legacy random/time/pid scheme implemented by
+           :meth:`new`.
+
+        ``cookie_expiry``
+           Which attribute(s) express ``cookie_lifetime`` in the
+           Set-Cookie header: ``expires`` (the default; an Expires
+           date), ``max-age`` (a Max-Age attribute, which needs no date
+           formatting) or ``both``.
+
+        ``verified_cache_size``
+           The number of verified cookie values to remember so that
+           returning browsers skip the HMAC computation.  Defaults to
+           ``0``, meaning don't cache.
+
+        ``verified_cache_ttl``
+           An integer number of seconds after which a remembered
+           cookie value is verified again.  Defaults to ``None``,
+           meaning entries only leave the cache when evicted.
+
+        ``digest``
+           The name of the ``hashlib`` hash used for the cookie HMAC,
+           e.g. ``sha256`` or ``blake2b``.  Defaults to ``md5``.
+
+        ``digest_size``
+           An integer number of bytes to which the HMAC is truncated,
+           at least 10 and at least half the size of the digest (e.g. 16
+           for ``sha256``), as RFC 2104 advises.  Defaults to ``None``,
+           meaning use the full digest.
+
+        ``cookie_encoding``
+           ``hex`` (the default) or ``base64``.  With ``base64`` the
+           HMAC, and browser ids which are 40-character hex strings,
+           are sent in the more compact URL-safe base64 alphabet.
+           Cookie values in either encoding are accepted.
+
+        ``pool_high_watermark``
+           If nonzero, keep a pool of up to this many pre-minted
+           browser ids (with their cookie values, unless varying),
+           refilled by a background thread, so that requests from new
+           browsers don't pay for minting.  Defaults to ``0`` (no pool).
+
+        ``pool_low_watermark``
+           The pool size below which the background thread starts
+           refilling the pool.  Defaults to half of
+           ``pool_high_watermark``.
+
+        ``lazy``
+           Boolean.  If ``True``, ``repoze.browserid`` in the environ is
+           a :class:`LazyBrowserId`, which must be called to obtain the
+           browser id; a browser id is only minted, and a Set-Cookie
+           header only sent, if the downstream application calls it
+           before calling ``start_response``.
+
+        ``exclude_paths``
+           A sequence of path prefixes (e.g. ``/static/``) or glob
+           patterns (containing ``*``, ``?`` or ``[``) matched against
+           ``PATH_INFO``.  Matching requests bypass the middleware
+           entirely: no cookie is read or set.
+
+        ``include_paths``
+           A sequence of path prefixes or glob patterns which are
+           handled even though they match ``exclude_paths``.
+
+        ``exclude_methods``
+           A sequence of request methods (e.g. ``HEAD``) which bypass
+           the middleware.
+
+        ``exclude_user_agents``
+           A sequence of glob patterns matched against the User-Agent
+           header; matching requests bypass the middleware.
+
+        ``metrics``
+           A :class:`Metrics` instance counting what the middleware
+           does.  Defaults to ``None``, meaning don't count.
+
+        ``metrics_path``
+           If set (e.g. ``/_browserid/metrics``), requests for this
+           exact ``PATH_INFO`` are answered by the middleware with a
+           JSON snapshot of ``metrics``, which is created if not given.
+
+        ``key_id``
+           A short name for ``secret_key``, made of letters, digits,
+           ``_``, ``.`` and ``-``, embedded in the cookie values it
+           signs so that the key can later be rotated.  Defaults to ``None``, meaning
+           cookie values carry no key id.
+
+        ``old_keys``
+           A mapping or sequence of ``(key_id, secret_key)`` pairs of
+           retired keys whose cookies are still accepted.  A browser
+           presenting such a cookie keeps its browser id and is sent the
+           cookie re-signed with ``secret_key``.  Cookie values carrying
+           no key id are checked against the key whose id is the empty
+           string.
+
+        ``registry``
+           A registry (see :mod:`repoze.browserid.registry`) recording
+           the browser ids handed out; cookies carrying a browser id
+           revoked in the registry are rejected.  Defaults to ``None``.
+
+        ``events``
+           A :class:`repoze.browserid.events.EventQueue` receiving an
+           event for each browser id handed out.  Defaults to ``None``.
+
+        ``cookie_refresh``
+           An integer number of seconds.  If set, ``cookie_lifetime``
+           must be set too: cookie values then carry the time they were
+           issued, cookies older than ``cookie_lifetime`` are rejected,
+           and a cookie due to expire within ``cookie_refresh`` seconds
+           is sent again with a fresh lifetime, so that browsers in use
+           keep their browser id.  Defaults to ``None``, meaning cookies
+           are never refreshed.
+
+        ``bot_classifier``
+           A :class:`UserAgentClassifier` (or any object with an
+           ``is_bot(user_agent)`` method).  Requests from bots which
+           hold no valid cookie are not given a new browser id: no id
+           is minted and no Set-Cookie header is sent.  Defaults to
+           ``None``, meaning every browser is given an id.
+
+        ``bot_browser_id``
+           The browser id set in the environ for bots, and for requests
+           refused by ``mint_limiter``, which hold no valid cookie,
+           shared by all of them.  Defaults to ``None``.
+
+        ``mint_limiter``
+           A :class:`RateLimiter` (or any object with an
+           ``allow(environ)`` method) consulted before minting a browser
+           id.  Requests it refuses are treated like bots: no id is
+           minted and no Set-Cookie header is sent, so a client sending
+           request after request without a cookie can't make the
+           middleware mint (and record) an id for each of them.
+           Defaults to ``None``, meaning minting isn't limited.
+
+        ``rejected_cache_size``
+           The number of cookie values which failed the tamper check to
+           remember, so that a client sending the same bad cookie over
+           and over is turned away without computing an HMAC.  Defaults
+           to ``0``, meaning don't cache.
+
+        ``rejected_cache_ttl``
+           An integer number of seconds for which a rejected cookie
+           value is remembered.  Defaults to ``60``.
         """
 
         self.app = app
         self.secret_key = secret_key
+        self.key_id = key_id = key_id or ''
+        self.keyring = dict(old_keys)
+        if key_id in self.keyring:
+            raise ValueError('Duplicate key id %r' % key_id)
+        self.keyring[key_id] = secret_key
+        for name in self.keyring:
+            if not _KEY_ID.match(name):
+                raise ValueError('Invalid key id %r' % name)
         self.cookie_name = cookie_name
         self.cookie_path = cookie_path
         self.cookie_domain = cookie_domain
         self.cookie_lifetime = cookie_lifetime
+        if cookie_refresh is not None and not cookie_lifetime:
+            raise ValueError('cookie_refresh requires cookie_lifetime')
+        self.cookie_refresh = cookie_refresh
         self.cookie_secure = cookie_secure
         self.vary = vary
+        self.lazy = lazy
+        if metrics_path and metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.metrics_path = metrics_path
+        self.registry = registry
+        self.events = events
+        self.bot_classifier = bot_classifier
+        self.bot_browser_id = bot_browser_id
+        self.mint_limiter = mint_limiter
+        if exclude_paths or exclude_methods or exclude_user_agents:
+            self.matcher = RequestMatcher(exclude_paths, include_paths,
+                                          exclude_methods,
+                                          exclude_user_agents)
+        else:
+            self.matcher = None
+        self.id_generator = id_generator
+        if cookie_expiry not in ('expires', 'max-age', 'both'):
+            raise ValueError('Unknown cookie_expiry %r' % cookie_expiry)
+        self.cookie_expiry = cookie_expiry
+        self.digest = digest
+        self._digestmod = _get_digestmod(digest)
+        self._hmac_prototype = hmac.new(_key_bytes(secret_key),
+                                        digestmod=self._digestmod)
+        self._key_prototypes = dict(
+            [ (key, hmac.new(_key_bytes(key), digestmod=self._digestmod))
+              for key in self.keyring.values() ])
+        self._key_prototypes[secret_key] = self._hmac_prototype
+        native_size = self._hmac_prototype.digest_size
+        # RFC 2104 advises keeping at least 80 bits and at least half
+        # of the digest; shorter MACs can be forged by trial and error
+        min_size = max(10, native_size // 2)
+        if digest_size and not min_size <= digest_size <= native_size:
+            raise ValueError('digest_size must be between %d and %d' %
+                             (min_size, native_size))
+        self.digest_size = digest_size or native_size
+        self._hex_mac_length = self.digest_size * 2
+        if cookie_encoding not in ('hex', 'base64'):
+            raise ValueError('Unknown cookie_encoding %r' % cookie_encoding)
+        self.cookie_encoding = cookie_encoding
+        if verified_cache_size:
+            self.verified_cache = LRUCache(verified_cache_size,
+                                           verified_cache_ttl)
+        else:
+            self.verified_cache = None
+        if rejected_cache_size:
+            self.rejected_cache = LRUCache(rejected_cache_size,
+                                           rejected_cache_ttl)
+        else:
+            self.rejected_cache = None
         self.randint = random.randint # tests override
         self.time = time.time # tests override
-        try:
-            self.pid = os.getpid()
-        except AttributeError: # pragma: no cover
-            # no getpid in Jython
-            self.pid = 1
+        self.pid = _getpid()
+        _FORK_SENSITIVE.add(self)
+        self._set_cookie_template = self._compile_set_cookie_template()
+        self._hmac_prototypes = LRUCache(self.hmac_cache_size)
+        self._set_cookie_expires = bool(cookie_lifetime and
+                                        cookie_expiry != 'max-age')
+        self._expires_cache = (None, None)
+        if pool_high_watermark:
+            if pool_low_watermark is None:
+                pool_low_watermark = pool_high_watermark // 2
+            self.id_pool = IdPool(self._premint, pool_low_watermark,
+                                  pool_high_watermark)
+        else:
+            self.id_pool = None
 
     def __call__(self, environ, start_response):
         """
@@ -106,80 +419,441 @@ class BrowserIdMiddleware(object):
         set a Set-Cookie header with the value+hmac so we can retrieve
         it next time around.
 
-        We use the secret key and the values in self.vary to compose
-        the 'tamper key' when creating a browser id, which is used as
-        the hmac key.  This allows a configurer to vary the tamper key
-        on, e.g. 'REMOTE_ADDR' if he believes that the same browser id
-        should always be sent from the same IP address, or
+        We use the secret key and the values in self.vary to compute
+        the hmac of a browser id.  This allows a configurer to vary
+        the hmac on, e.g. 'REMOTE_ADDR' if he believes that the same
+        browser id should always be sent from the same IP address, or
         'HTTP_USER_AGENT' if he believes it should always come from
         the same user agent, or some arbitrary combination thereof
         made out of environ keys.
-        """
-        cookies = get_cookies(environ)
-        cookie = cookies.get(self.cookie_name)
-        if cookie is not None:
-            # this browser returned a cookie value that claims to be
-            # a browser id
-            browser_id = self.from_cookieval(environ, cookie.value)
-            if browser_id is not None:
-                # cookie hasn't been tampered with
-                environ['repoze.browserid'] = browser_id
-                return self.app(environ, start_response)
 
-        # no browser id cookie or cookie value was tampered with
-        now = self.time()
-        browser_id = self.new(now)
+        The Set-Cookie header is added at the moment the downstream
+        application calls ``start_response``; neither the ``write``
+        callable nor the application iterator is buffered.
+
+        In lazy mode no browser id is created unless the downstream
+        application asks for one.
+
+        Requests matching the exclusion rules are passed straight to
+        the downstream application.
+        """
+        # before the registry, the rate limiter or the pool is used
+        _check_fork()
+        if (self.metrics_path is not None and
+            environ.get('PATH_INFO') == self.metrics_path):
+            return self._serve_metrics(environ, start_response)
+        matcher = self.matcher
+        if matcher is not None and matcher.excluded(environ):
+            if self.metrics is not None:
+                self.metrics.incr('excluded')
+            return self.app(environ, start_response)
+        if self.lazy:
+            return self._call_lazy(environ, start_response)
+        browser_id, set_cookie = self._identify(environ)
         environ['repoze.browserid'] = browser_id
-        wrapper = StartResponseWrapper(start_response)
-        app_iter = self.app(environ, wrapper.wrap_start_response)
+        if set_cookie is None:
+            return self.app(environ, start_response)
+        extra_headers = [('Set-Cookie', set_cookie)]
+
+        def wrapped_start_response(status, headers, exc_info=None):
+            return start_response(status, headers + extra_headers, exc_info)
+
+        return self.app(environ, wrapped_start_response)
+
+    def _serve_metrics(self, environ, start_response):
+        body = json.dumps(self.metrics.snapshot(),
+                          sort_keys=True).encode('utf-8')
+        start_response('200 OK', [('Content-Type', 'application/json'),
+                                  ('Content-Length', str(len(body))),
+                                  ('Cache-Control', 'no-cache')])
+        return [body]
+
+    def _call_lazy(self, environ, start_response):
+        browser_id, set_cookie = self._verify(environ)
+        lazy = LazyBrowserId(lambda: self._mint(environ), browser_id,
+                             set_cookie)
+        environ['repoze.browserid'] = lazy
+        if browser_id is not None and set_cookie is None:
+            return self.app(environ, start_response)
+
+        def wrapped_start_response(status, headers, exc_info=None):
+            if lazy.set_cookie is not None:
+                headers = headers + [('Set-Cookie', lazy.set_cookie)]
+            return start_response(status, headers, exc_info)
+
+        return self.app(environ, wrapped_start_response)
+
+    def _identify(self, environ):
+        """
+        Return a tuple of the browser id for the request described by
+        ``environ`` and the Set-Cookie header value to send back, which
+        is ``None`` if the browser already holds a valid cookie signed
+        with the current key.
+        """
+        browser_id, set_cookie = self._verify(environ)
+        if browser_id is not None:
+            return browser_id, set_cookie
+        return self._mint(environ)
+
+    def _verify(self, environ):
+        """
+        Return a tuple of the browser id held in the browser's cookie,
+        or ``None`` if it sent no cookie or the cookie was tampered
+        with, and the Set-Cookie header value sending the cookie again,
+        signed with the current key, if it was signed with an old one
+        or is due to be refreshed, or ``None``.
+        """
+        cookie_value = self._get_cookie_value(environ)
+        metrics = self.metrics
+        if cookie_value is None:
+            if metrics is not None:
+                metrics.incr('no_cookie')
+            return None, None
+        # this browser returned a cookie value that claims to be a
+        # browser id
+        if metrics is None:
+            browser_id, key_id, issued = self._check_cookieval(environ,
+                                                               cookie_value)
+        else:
+            started = metrics.start()
+            browser_id, key_id, issued = self._check_cookieval(environ,
+                                                               cookie_value)
+            metrics.stop('verify', started)
+            if browser_id is None:
+                metrics.incr('tampered')
+            else:
+                metrics.incr('verified')
+        if browser_id is None:
+            return None, None
+        refresh = self.cookie_refresh
+        if key_id == self.key_id:
+            if refresh is None:
+                return browser_id, None
+            if (issued is not None and
+                issued + self.cookie_lifetime - self.time() > refresh):
+                return browser_id, None
+            if metrics is not None:
+                metrics.incr('refreshed')
+        elif metrics is not None:
+            metrics.incr('resigned')
         cookie_value = self.to_cookieval(environ, browser_id)
-        set_cookie = '%s=%s; ' % (self.cookie_name, cookie_value)
+        return browser_id, self._format_set_cookie(cookie_value, self.time())
+
+    def _mint(self, environ):
+        """
+        Return a tuple of a new browser id and the Set-Cookie header
+        value which hands it to the browser, or of ``bot_browser_id`` and
+        ``None`` if the browser is a bot or is minting too fast.
+        """
+        metrics = self.metrics
+        classifier = self.bot_classifier
+        if (classifier is not None and
+            classifier.is_bot(environ.get('HTTP_USER_AGENT', ''))):
+            if metrics is not None:
+                metrics.incr('bots')
+            return self.bot_browser_id, None
+        limiter = self.mint_limiter
+        if limiter is not None and not limiter.allow(environ):
+            if metrics is not None:
+                metrics.incr('throttled')
+            return self.bot_browser_id, None
+        if metrics is None:
+            return self._mint_set_cookie(environ)
+        started = metrics.start()
+        result = self._mint_set_cookie(environ)
+        metrics.stop('mint', started)
+        metrics.incr('minted')
+        return result
+
+    def _mint_set_cookie(self, environ):
+        now = self.time()
+        entry = None
+        if self.id_pool is not None:
+            entry = self.id_pool.get()
+        if entry is None:
+            browser_id = self.new(now)
+            cookie_value = self.to_cookieval(environ, browser_id)
+        else:
+            browser_id, cookie_value = entry
+            if cookie_value is None:
+                cookie_value = self.to_cookieval(environ, browser_id)
+        if self.registry is not None:
+            self.registry.register(browser_id)
+        if self.events is not None:
+            vary = dict([ (name, environ.get(name, '')) for name in self.vary ])
+            self.events.put({'browser_id': browser_id, 'time': now,
+                             'pid': self.pid, 'vary': vary})
+        return browser_id, self._format_set_cookie(cookie_value, now)
+
+    def _format_set_cookie(self, cookie_value, now):
+        if self._set_cookie_expires:
+            expires = self._get_expires(now)
+            return self._set_cookie_template % (cookie_value, expires)
+        return self._set_cookie_template % cookie_value
+
+    def _premint(self):
+        """
+        Mint a browser id for the pool, along with its cookie value if
+        that doesn't depend on the request.
+        """
+        browser_id = self.new(self.time())
+        if self.vary or self.cookie_refresh is not None:
+            return browser_id, None
+        return browser_id, self.to_cookieval({}, browser_id)
+
+    def _get_cookie_value(self, environ):
+        """
+        Return the value of the browser id cookie sent by the browser,
+        or ``None`` if it sent none.
+
+        Rather than parsing every cookie in the Cookie header, scan the
+        header backwards for the configured cookie name (the last
+        occurrence wins, as with a full parse).  Quoted values, which
+        need unescaping, are handed to the full parser.
+        """
+        header = environ.get('HTTP_COOKIE')
+        if not header:
+            return None
+        needle = self.cookie_name + '='
+        end = len(header)
+        while 1:
+            pos = header.rfind(needle, 0, end)
+            if pos == -1:
+                return None
+            if pos == 0 or header[pos - 1] in '; \t':
+                break
+            end = pos + len(needle) - 1
+        start = pos + len(needle)
+        stop = header.find(';', start)
+        if stop == -1:
+            stop = len(header)
+        value = header[start:stop].strip()
+        if value.startswith('"'):
+            cookie = get_cookies(environ).get(self.cookie_name)
+            if cookie is None:
+                return None
+            return cookie.value
+        return value
+
+    def _compile_set_cookie_template(self):
+        """
+        Return a format string for the Set-Cookie header value with
+        the static cookie attributes already filled in.  It takes the
+        cookie value and, when ``cookie_lifetime`` is set, the
+        formatted Expires date.
+        """
+        def quote(value):
+            return value.replace('%', '%%')
+        template = quote(self.cookie_name) + '=%s; '
         if self.cookie_path:
-            set_cookie += 'Path=%s; ' % self.cookie_path
+            template += 'Path=%s; ' % quote(self.cookie_path)
         if self.cookie_domain:
-            set_cookie += 'Domain=%s; ' % self.cookie_domain
+            template += 'Domain=%s; ' % quote(self.cookie_domain)
         if self.cookie_lifetime:
-            expires = time.gmtime(now + self.cookie_lifetime)
-            expires = time.strftime('%a %d-%b-%Y %H:%M:%S GMT', expires)
-            set_cookie += 'Expires=%s; ' % expires
+            if self.cookie_expiry != 'max-age':
+                template += 'Expires=%s; '
+            if self.cookie_expiry != 'expires':
+                template += 'Max-Age=%d; ' % self.cookie_lifetime
         if self.cookie_secure:
-            set_cookie += 'Secure;'
-        wrapper.finish_response([('Set-Cookie', set_cookie)])
-        return app_iter
+            template += 'Secure;'
+        return template
+
+    def _get_expires(self, now):
+        """
+        Return the formatted Expires date for a cookie set at ``now``.
+        The date only changes once a second, so the most recently
+        formatted value is cached along with the second it is good for.
+        The cache is a single tuple replaced wholesale, so concurrent
+        readers never see a torn entry and no lock is needed.
+        """
+        when = int(now + self.cookie_lifetime)
+        cached_when, expires = self._expires_cache
+        if cached_when != when:
+            expires = time.strftime('%a %d-%b-%Y %H:%M:%S GMT',
+                                    time.gmtime(when))
+            self._expires_cache = (when, expires)
+        return expires
 
     def from_cookieval(self, environ, cookie_value):
-        try:
-            browser_id, provided_hmac = cookie_value.split('!')
-        except ValueError:
-            return None
-        key = self._get_tamper_key(environ)
-        computed_hmac = hmac.new(key, browser_id).hexdigest()
-        if computed_hmac != provided_hmac:
+        return self._check_cookieval(environ, cookie_value)[0]
+
+    def _check_cookieval(self, environ, cookie_value):
+        """
+        Return a tuple of the browser id held in ``cookie_value``, or
+        ``None`` if it was tampered with, has expired or was revoked,
+        the id of the key which signed it and the time it was issued
+        (``None`` if the cookie value doesn't say).
+        """
+        browser_id, key_id, issued = self._check_signature(environ,
+                                                           cookie_value)
+        if browser_id is None:
+            return None, key_id, None
+        if issued is not None:
+            issued = int(issued, 16)
+            if (self.cookie_refresh is not None and
+                issued + self.cookie_lifetime <= self.time()):
+                if self.metrics is not None:
+                    self.metrics.incr('expired')
+                return None, key_id, issued
+        registry = self.registry
+        if registry is not None and registry.is_revoked(browser_id):
+            if self.metrics is not None:
+                self.metrics.incr('revoked')
+            return None, key_id, issued
+        return browser_id, key_id, issued
+
+    def _check_signature(self, environ, cookie_value):
+        """
+        Return a tuple of the browser id held in ``cookie_value``, or
+        ``None`` if it was tampered with, the id of the key which signed
+        it and the hex timestamp of when it was issued, or ``None``.
+
+        The key id, and the timestamp when present, travel in the cookie
+        value between the payload and the HMAC, and are covered by the
+        HMAC, so the signing key is found with a single dict lookup
+        however many old keys are kept.
+
+        Cookie values failing the check are remembered, with the vary
+        values they were checked against, in the rejected cache if
+        there is one, and turned away without an HMAC when sent again.
+        """
+        signed, sep, provided_hmac = cookie_value.rpartition('!')
+        if not sep:
+            return None, None, None
+        payload, sep, key_id = signed.partition('!')
+        issued = None
+        if '!' in key_id:
+            key_id, sep, issued = key_id.partition('!')
+        secret_key = self.keyring.get(key_id)
+        if secret_key is None:
+            return None, None, None
+        vary_values = self._get_vary_values(environ)
+        cache = self.verified_cache
+        if cache is not None:
+            browser_id = cache.get((cookie_value, vary_values))
+            if browser_id is not None:
+                return browser_id, key_id, issued
+        rejected = self.rejected_cache
+        if rejected is not None:
+            if rejected.get((cookie_value, vary_values)) is not None:
+                if self.metrics is not None:
+                    self.metrics.incr('rejected_cached')
+                return None, key_id, None
+        if len(provided_hmac) == self._hex_mac_length:
+            encoding = 'hex'
+        else:
+            encoding = 'base64'
+        h = self._new_hmac(secret_key, vary_values)
+        h.update(_latin1(signed))
+        if not _compare_mac(self._encode_mac(h, encoding), provided_hmac):
+            if vary_values:
+                browser_id = self._check_legacy_vary(environ, secret_key,
+                                                     signed, payload,
+                                                     provided_hmac, encoding)
+                if browser_id is not None:
+                    return browser_id, None, None
+            if rejected is not None:
+                rejected.set((cookie_value, vary_values), True)
+            return None, key_id, None
+        browser_id = _unpack_browser_id(payload)
+        if cache is not None:
+            cache.set((cookie_value, vary_values), browser_id)
+        return browser_id, key_id, issued
+
+    def _check_legacy_vary(self, environ, secret_key, signed, payload,
+                           provided_hmac, encoding):
+        """
+        Return the browser id held in a cookie value signed, as by
+        earlier versions, with the secret key concatenated with the
+        vary values as the HMAC key, or ``None``.  Such cookies are
+        re-signed, so this path is only taken during a transition and
+        for tampered cookies.
+        """
+        key = _key_bytes(secret_key)
+        for name in self.vary:
+            key = key + _latin1(environ.get(name, ''))
+        h = hmac.new(key, _latin1(signed), self._digestmod)
+        if not _compare_mac(self._encode_mac(h, encoding), provided_hmac):
             return None
-        return browser_id
+        return _unpack_browser_id(payload)
 
     def to_cookieval(self, environ, browser_id):
-        key = self._get_tamper_key(environ)
-        h = hmac.new(key, browser_id).hexdigest()
-        val = '%s!%s' % (browser_id, h)
+        if self.cookie_encoding == 'base64':
+            signed = _pack_browser_id(browser_id)
+        else:
+            signed = browser_id
+        if self.cookie_refresh is not None:
+            signed = '%s!%s!%x' % (signed, self.key_id, int(self.time()))
+        elif self.key_id:
+            signed = '%s!%s' % (signed, self.key_id)
+        h = self._new_hmac(self.secret_key, self._get_vary_values(environ))
+        h.update(_latin1(signed))
+        val = '%s!%s' % (signed, self._encode_mac(h, self.cookie_encoding))
         return val
 
-    def _get_tamper_key(self, environ):
-        key = self.secret_key
-        for name in self.vary:
-            key = key + environ.get(name, '')
-        return key
+    def _encode_mac(self, h, encoding):
+        if encoding == 'hex':
+            # a native string under both Python 2 and 3
+            return h.hexdigest()[:self._hex_mac_length]
+        mac = h.digest()[:self.digest_size]
+        return _native(base64.urlsafe_b64encode(mac).rstrip(b'='))
+
+    def _new_hmac(self, secret_key, vary_values=()):
+        """
+        Return a fresh HMAC object keyed with ``secret_key`` which has
+        already absorbed the sequence of ``vary_values``, each prefixed
+        by its length so that no two sequences feed the HMAC the same
+        bytes.  Environ values are native strings holding latin-1 text
+        (PEP 3333), so they are fed to the HMAC as latin-1 bytes.
+
+        Keying an HMAC pads and hashes the key into inner and outer
+        digest states; copying an already-keyed object skips that work.
+        The keyed prototypes of the secret keys are built at
+        construction time.  When varying, the vary values are fed into
+        the HMAC ahead of the cookie payload rather than folded into
+        the key, and objects which have absorbed them are kept per
+        distinct vary values in a bounded cache, so a browser sending
+        the same (possibly long) User-Agent on every request has it
+        hashed only once.
+        """
+        prototype = self._key_prototypes.get(secret_key)
+        if prototype is None:
+            prototype = hmac.new(_key_bytes(secret_key),
+                                 digestmod=self._digestmod)
+        if not vary_values:
+            return prototype.copy()
+        prototypes = self._hmac_prototypes
+        cache_key = (secret_key, vary_values)
+        absorbed = prototypes.get(cache_key)
+        if absorbed is None:
+            absorbed = prototype.copy()
+            for value in vary_values:
+                absorbed.update(_latin1('%d:%s' % (len(value), value)))
+            prototypes.set(cache_key, absorbed)
+        return absorbed.copy()
+
+    def _get_vary_values(self, environ):
+        """ Return a tuple of the values of the ``vary`` environ keys. """
+        if not self.vary:
+            return ()
+        return tuple([ environ.get(name, '') for name in self.vary ])
 
     def new(self, when):
         """ Returns opaque 40-character browser id
 
         An example is: e193a01ecf8d30ad0affefd332ce934e32ffce72
         """
+        if self.id_generator is not None:
+            return self.id_generator(when)
+        _check_fork()
         rand = self._get_rand_for(when)
         source = '%s%s%s' % (rand, when, self.pid)
-        browser_id = sha(source).hexdigest()
+        browser_id = sha(_latin1(source)).hexdigest()
         return browser_id
 
+    def _after_fork(self):
+        self.pid = _getpid()
+
     def _get_rand_for(self, when):
         """
         There is a good chance that two simultaneous callers will
@@ -202,9 +876,21 @@ class BrowserIdMiddleware(object):
         """
         period = 1
         this_period = int(when - (when % period))
-        _LOCK.acquire()
+        lock = _LOCK
+        if not lock.acquire(False):
+            metrics = self.metrics
+            if metrics is None:
+                lock.acquire()
+            else:
+                started = default_timer()
+                lock.acquire()
+                waited = default_timer() - started
+                metrics.incr('lock_contended')
+                metrics.incr('lock_wait_us', int(waited * 1000000))
         try:
+            retries = -1
             while 1:
+                retries += 1
                 rand = self.randint(0, 99999999)
                 global _CURRENT_PERIOD
                 if this_period != _CURRENT_PERIOD:
@@ -212,18 +898,692 @@ class BrowserIdMiddleware(object):
                     _RANDS[:] = []
                 if rand not in _RANDS:
                     _RANDS.append(rand)
+                    if retries and self.metrics is not None:
+                        self.metrics.incr('rand_retries', retries)
                     return rand
         finally:
-            _LOCK.release()
+            lock.release()
+
+
+def _get_digestmod(name):
+    if hashlib is None: #pragma NO COVER Python < 2.5
+        if name == 'md5':
+            return None
+    else:
+        digestmod = getattr(hashlib, name, None)
+        if digestmod is not None:
+            return digestmod
+    raise ValueError('Unknown digest %r' % name)
+
+def _pack_browser_id(browser_id):
+    """
+    Return the compact cookie form of ``browser_id``: 40-character hex
+    ids become ``~`` followed by their bytes in URL-safe base64, other
+    ids are returned unchanged.
+    """
+    if len(browser_id) == 40:
+        try:
+            raw = binascii.unhexlify(browser_id)
+        except (TypeError, ValueError):
+            return browser_id
+        if _native(binascii.hexlify(raw)) == browser_id:
+            return '~' + _native(base64.urlsafe_b64encode(raw).rstrip(b'='))
+    return browser_id
+
+def _unpack_browser_id(payload):
+    """ Reverse :func:`_pack_browser_id`. """
+    if payload.startswith('~'):
+        raw = base64.urlsafe_b64decode(_latin1(payload[1:] + '='))
+        return _native(binascii.hexlify(raw))
+    return payload
+
+
+class RandomIdGenerator(object):
+    """ Browser id generator which draws every browser id from the
+    operating system's cryptographically secure random source.
+
+    Each id carries 160 bits of randomness, so collisions are vanishingly
+    unlikely without any bookkeeping: no lock is taken and no record of
+    recently issued ids is kept.
+    """
+    def __init__(self, urandom=os.urandom):
+        self.urandom = urandom # tests override
+
+    def __call__(self, when):
+        return _native(binascii.hexlify(self.urandom(20)))
+
+
+class CounterIdGenerator(object):
+    """ Browser id generator which composes each browser id out of a
+    random per-instance prefix, a serial number assigned to the calling
+    thread and a counter private to that thread.
+
+    No two threads ever share a serial number and no thread ever repeats
+    a counter value, so ids are unique within the process without any
+    lock; the random prefix keeps them unique across processes and
+    hosts, and is drawn again in a forked child.  The components are
+    hashed so the resulting id stays opaque.
+    """
+    def __init__(self, urandom=os.urandom):
+        self.urandom = urandom # tests override
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        self.prefix = _native(binascii.hexlify(self.urandom(16)))
+        self._serials = itertools.count()
+        self._local = threading.local()
+
+    def __call__(self, when):
+        _check_fork()
+        local = self._local
+        try:
+            counter = local.counter
+        except AttributeError:
+            local.serial = next(self._serials)
+            counter = local.counter = itertools.count()
+        source = '%s:%s:%s' % (self.prefix, local.serial, next(counter))
+        return sha(_latin1(source)).hexdigest()
+
+class CompactIdGenerator(object):
+    """ Browser id generator which produces 128-bit ids encoded as 22
+    characters of URL-safe base64, about half the length of the legacy
+    40-character hex ids.
+
+    By default all 128 bits are read from ``os.urandom``.  If
+    ``time_ordered`` is true, the first 48 bits are instead the
+    generation time in milliseconds and the remaining 80 random bits
+    keep ids unique; these ids use a reordering of the URL-safe base64
+    alphabet which follows ASCII order, so they sort by age as strings.
+    """
+    def __init__(self, time_ordered=False, urandom=os.urandom):
+        self.time_ordered = time_ordered
+        self.urandom = urandom # tests override
+
+    def __call__(self, when):
+        if self.time_ordered:
+            millis = struct.pack('>Q', int(when * 1000))[2:]
+            raw = millis + self.urandom(10)
+            encoded = base64.urlsafe_b64encode(raw)
+            return _native(encoded[:22].translate(_ASCII_ORDERED_BASE64))
+        raw = self.urandom(16)
+        return _native(base64.urlsafe_b64encode(raw)[:22])
+
+_ASCII_ORDERED_BASE64 = _maketrans(
+    _latin1(string.ascii_uppercase + string.ascii_lowercase +
+            string.digits + '-_'),
+    _latin1('-' + string.digits + string.ascii_uppercase + '_' +
+            string.ascii_lowercase))
+
+def _OrderedCompactIdGenerator():
+    return CompactIdGenerator(time_ordered=True)
+
+_ID_GENERATORS = {
+    'legacy': None,
+    'random': RandomIdGenerator,
+    'counter': CounterIdGenerator,
+    'compact': CompactIdGenerator,
+    'compact-ordered': _OrderedCompactIdGenerator,
+    }
+
+
+class Metrics(object):
+    """ Counters, and optionally latency histograms, describing the
+    work done by the browser id middleware.
+
+    Each thread updates its own shard of counters without locking; the
+    shards are only summed when :meth:`snapshot` is called.  The shards
+    of threads which have finished are folded into a single total from
+    time to time, so that short-lived threads don't pile up.  The
+    counters are:
+
+    ``no_cookie``
+      requests which carried no browser id cookie
+    ``verified``
+      cookies which passed the tamper check
+    ``tampered``
+      cookies which failed it
+    ``minted``
+      browser ids created
+    ``excluded``
+      requests which bypassed the middleware
+    ``lock_contended``, ``lock_wait_us``
+      how often, and for how many microseconds in total, minting a
+      legacy browser id had to wait for the global lock
+    ``rand_retries``
+      random numbers redrawn by the legacy generator because they had
+      already been issued in the current second
+    ``resigned``
+      valid cookies signed with an old key and sent again signed with
+      the current one
+    ``revoked``
+      cookies which passed the tamper check but carried a browser id
+      revoked in the registry (these are also counted as ``tampered``)
+    ``expired``
+      cookies which passed the tamper check but were issued more than
+      ``cookie_lifetime`` seconds ago (also counted as ``tampered``)
+    ``refreshed``
+      valid cookies sent again because they were about to expire
+    ``bots``
+      requests from bots which were not given a new browser id
+    ``throttled``
+      requests which were not given a new browser id because their
+      client had minted too many
+    ``rejected_cached``
+      cookies turned away by the rejected cache without an HMAC (also
+      counted as ``tampered``)
+
+    If ``timings`` is true, the latency of verifying a cookie and of
+    minting a browser id is recorded in histograms with power-of-two
+    microsecond buckets: bucket ``n`` counts durations of at least
+    ``2 ** (n - 1)`` and less than ``2 ** n`` microseconds.
+    """
+    counter_names = ('no_cookie', 'verified', 'tampered', 'minted',
+                     'excluded', 'lock_contended', 'lock_wait_us',
+                     'rand_retries', 'resigned', 'revoked', 'expired',
+                     'refreshed', 'bots', 'throttled', 'rejected_cached')
+    phases = ('verify', 'mint')
+    buckets = 32
+
+    def __init__(self, timings=False, timer=default_timer):
+        self.timings = timings
+        self.timer = timer # tests override
+        self._indexes = dict([ (name, i) for i, name
+                               in enumerate(self.counter_names) ])
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        # a forked worker counts from zero, and the lock may have been
+        # held by another thread of the parent
+        self._local = threading.local()
+        self._shards = []
+        self._shards_lock = threading.Lock()
+        self._retired = self._new_shard()
+        self._retire_at = 16
+
+    def _new_shard(self):
+        return ([0] * len(self.counter_names),
+                dict([ (phase, [0] * self.buckets)
+                       for phase in self.phases ]))
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._new_shard()
+            thread = weakref.ref(threading.current_thread())
+            self._shards_lock.acquire()
+            try:
+                self._shards.append((thread, shard))
+                if len(self._shards) >= self._retire_at:
+                    self._retire()
+                    self._retire_at = max(len(self._shards) * 2, 16)
+            finally:
+                self._shards_lock.release()
+            return shard
+
+    def _retire(self):
+        """ Fold the shards of threads which have finished into the
+        retired totals, so that a server starting a thread per request
+        doesn't accumulate shards.  Called with the lock held. """
+        live = []
+        for ref, shard in self._shards:
+            thread = ref()
+            if thread is not None and thread.is_alive():
+                live.append((ref, shard))
+            else:
+                _add_shard(self._retired, shard)
+        self._shards = live
+
+    def incr(self, name, amount=1):
+        self._shard()[0][self._indexes[name]] += amount
+
+    def start(self):
+        """ Return a start time for :meth:`stop`, or ``None`` if timings
+        aren't being recorded. """
+        if self.timings:
+            return self.timer()
+        return None
+
+    def stop(self, phase, started):
+        """ Record the time elapsed since ``started`` in the histogram
+        for ``phase``. """
+        if started is not None:
+            micros = int((self.timer() - started) * 1000000)
+            bucket = min(micros.bit_length(), self.buckets - 1)
+            self._shard()[1][phase][bucket] += 1
+
+    def snapshot(self):
+        """ Return the totals across all threads as a dictionary with
+        ``counters`` and ``histograms`` keys. """
+        total = self._new_shard()
+        self._shards_lock.acquire()
+        try:
+            self._retire()
+            _add_shard(total, self._retired)
+            for thread, shard in self._shards:
+                _add_shard(total, shard)
+        finally:
+            self._shards_lock.release()
+        counters, histograms = total
+        result = {'counters': dict(zip(self.counter_names, counters))}
+        if self.timings:
+            result['histograms'] = histograms
+        return result
+
+def _add_shard(total, shard):
+    """ Add the counters and histograms of ``shard`` to ``total``. """
+    counters, histograms = total
+    for i, value in enumerate(shard[0]):
+        counters[i] += value
+    for phase, shard_buckets in shard[1].items():
+        buckets = histograms[phase]
+        for i, value in enumerate(shard_buckets):
+            buckets[i] += value
+
+
+class RequestMatcher(object):
+    """ Decides which requests bypass the browser id middleware.
+
+    All path rules are compiled at construction time into a single
+    regular expression per rule list, prefixes as escaped literals and
+    globs translated to anchored patterns, so each request costs one
+    scan of ``PATH_INFO`` (plus a set lookup for the method and, if
+    configured, one match against the User-Agent).
+    """
+    def __init__(self, exclude_paths=(), include_paths=(),
+                 exclude_methods=(), exclude_user_agents=()):
+        self.exclude_paths = _compile_patterns(exclude_paths)
+        self.include_paths = _compile_patterns(include_paths)
+        self.exclude_methods = frozenset([ x.upper()
+                                           for x in exclude_methods ])
+        self.exclude_user_agents = _compile_patterns(exclude_user_agents,
+                                                     prefixes=False)
+
+    def excluded(self, environ):
+        """ Return ``True`` if the request should bypass the middleware.
+        """
+        if environ.get('REQUEST_METHOD') in self.exclude_methods:
+            return True
+        exclude = self.exclude_paths
+        if exclude is not None:
+            path = environ.get('PATH_INFO', '')
+            if exclude.match(path):
+                include = self.include_paths
+                if include is None or not include.match(path):
+                    return True
+        user_agents = self.exclude_user_agents
+        if user_agents is not None:
+            if user_agents.match(environ.get('HTTP_USER_AGENT', '')):
+                return True
+        return False
+
+def _compile_patterns(patterns, prefixes=True):
+    """
+    Compile ``patterns`` into one regular expression, or return
+    ``None`` if there are none.  Patterns holding glob characters must
+    match the whole string; others, when ``prefixes`` is true, match as
+    prefixes and otherwise as exact strings.
+    """
+    alternatives = []
+    for pattern in patterns:
+        if _GLOB_CHARS.search(pattern):
+            alternatives.append(_translate_glob(pattern) + r'\Z')
+        elif prefixes:
+            alternatives.append(re.escape(pattern))
+        else:
+            alternatives.append(re.escape(pattern) + r'\Z')
+    if not alternatives:
+        return None
+    return re.compile('|'.join([ '(?:%s)' % x for x in alternatives ]),
+                      re.DOTALL)
+
+_GLOB_CHARS = re.compile(r'[*?[]')
+
+def _translate_glob(pattern):
+    """
+    Translate a glob into a regular expression: ``*`` matches any run of
+    characters, ``?`` any single character and ``[...]`` a character
+    class, as with ``fnmatch``.
+    """
+    result = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        i += 1
+        if c == '*':
+            result.append('.*')
+        elif c == '?':
+            result.append('.')
+        elif c == '[':
+            j = pattern.find(']', i + 1)
+            if j == -1:
+                result.append(r'\[')
+            else:
+                stuff = pattern[i:j].replace('\\', '\\\\')
+                if stuff.startswith('!'):
+                    stuff = '^' + stuff[1:]
+                result.append('[%s]' % stuff)
+                i = j + 1
+        else:
+            result.append(re.escape(c))
+    return ''.join(result)
+
+
+class UserAgentClassifier(object):
+    """ Tells bots (crawlers, monitoring agents, HTTP libraries) from
+    browsers by their User-Agent header.
+
+    ``patterns`` is a sequence of lowercase regular expressions searched
+    for anywhere in the lowercased User-Agent; it defaults to
+    :data:`BOT_PATTERNS`.  They are compiled at construction time into a
+    single regular expression, so classifying a User-Agent costs one
+    scan of it.  Lowercasing the User-Agent, rather than ignoring case
+    in the expression, and starting every pattern with a literal
+    character let the regular expression engine skip most positions
+    quickly, which makes the scan about ten times faster.  Requests
+    without a User-Agent are classed as bots.
+
+    Browsers and bots send the same few User-Agents over and over, so
+    the verdicts on the ``cache_size`` most recently seen User-Agents
+    are kept in an :class:`LRUCache`, saving the scan.
+    """
+    def __init__(self, patterns=None, cache_size=1024):
+        if patterns is None:
+            patterns = BOT_PATTERNS
+        self.patterns = tuple(patterns)
+        if self.patterns:
+            self._regex = re.compile(
+                '|'.join([ '(?:%s)' % x for x in self.patterns ]))
+        else:
+            self._regex = None
+        if cache_size:
+            self.cache = LRUCache(cache_size)
+        else:
+            self.cache = None
+
+    def is_bot(self, user_agent):
+        if not user_agent:
+            return True
+        cache = self.cache
+        if cache is not None:
+            verdict = cache.get(user_agent)
+            if verdict is not None:
+                return verdict
+        regex = self._regex
+        verdict = (regex is not None and
+                   regex.search(user_agent.lower()) is not None)
+        if cache is not None:
+            cache.set(user_agent, verdict)
+        return verdict
+
+#: The patterns used by :class:`UserAgentClassifier` by default.
+BOT_PATTERNS = (
+    r'bot(?<!cubot)\b', # but not Cubot phones
+    r'crawl', r'spider', r'slurp', r'archiver', r'scrapy',
+    r'facebookexternalhit', r'embedly', r'bingpreview',
+    r'curl/', r'wget/', r'python-requests', r'python-urllib',
+    r'aiohttp', r'go-http-client', r'okhttp', r'java/', r'libwww-perl',
+    r'apache-httpclient', r'node-fetch', r'axios/',
+    r'headlesschrome', r'phantomjs', r'lighthouse',
+    r'pingdom', r'uptimerobot', r'statuscake', r'site24x7', r'newrelic',
+    r'datadog', r'kube-probe', r'elb-healthchecker', r'googlestackdriver',
+    r'monitor',
+    )
+
+
+class LazyBrowserId(object):
+    """ The value of ``repoze.browserid`` in the environ when the
+    middleware is in lazy mode.
+
+    Calling it (or converting it to a string) returns the browser id,
+    minting one on first use if the browser did not send a valid
+    cookie.  ``set_cookie`` is then the Set-Cookie header value the
+    middleware will send, provided the id was asked for before the
+    application called ``start_response``.  A browser whose cookie was
+    signed with an old key is sent it re-signed whether or not the id is
+    asked for.
+
+    Bots and throttled clients are given no new browser id, so calling
+    it may return ``None`` (or the ``bot_browser_id`` sentinel); the
+    answer is remembered, and converting it to a string then gives an
+    empty string.
+    """
+    def __init__(self, mint, browser_id=None, set_cookie=None):
+        self._mint = mint
+        self.browser_id = browser_id
+        self.set_cookie = set_cookie
+        self._resolved = browser_id is not None
+
+    def __call__(self):
+        if not self._resolved:
+            self.browser_id, self.set_cookie = self._mint()
+            self._resolved = True
+        return self.browser_id
+
+    def __str__(self):
+        browser_id = self()
+        if browser_id is None:
+            return ''
+        return browser_id
+
+
+class LRUCache(object):
+    """ A bounded mapping which approximates least-recently-used
+    eviction, with an optional time-to-live for its entries.
+
+    Entries live in two generations: a young dict receiving new and
+    recently used entries and an old dict.  Once the young generation
+    holds half of ``maxsize`` entries it becomes the old generation and
+    the previous old generation is dropped wholesale; entries found in
+    the old generation are promoted to the young one.  Every operation
+    is a handful of dict operations, which are atomic under the GIL, so
+    the cache can be shared between threads without a lock.  The
+    ``hits`` and ``misses`` counters are informational and may
+    undercount under concurrency.
+    """
+    def __init__(self, maxsize, ttl=None, time=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.time = time # tests override
+        self.hits = 0
+        self.misses = 0
+        self._generation_size = max(maxsize // 2, 1)
+        self._young = {}
+        self._old = {}
+
+    def __len__(self):
+        return len(self._young) + len(self._old)
+
+    def get(self, key, default=None):
+        young = self._young
+        entry = young.get(key)
+        if entry is None:
+            entry = self._old.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            young[key] = entry
+            self._maybe_rotate(young)
+        value, expires = entry
+        if expires is not None and expires <= self.time():
+            young.pop(key, None)
+            self.misses += 1
+            return default
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if self.ttl:
+            expires = self.time() + self.ttl
+        else:
+            expires = None
+        young = self._young
+        young[key] = (value, expires)
+        self._maybe_rotate(young)
+
+    def clear(self):
+        self._young = {}
+        self._old = {}
+
+    def _maybe_rotate(self, young):
+        if len(young) >= self._generation_size and young is self._young:
+            self._old = young
+            self._young = {}
+
+
+class RateLimiter(object):
+    """ Limits how often each client may do something, e.g. be given a
+    new browser id, with a token bucket per client.
+
+    A client is identified by the values of the ``key_names`` environ
+    keys (by default its address).  Its bucket holds up to ``burst``
+    tokens and regains ``rate`` tokens per second; :meth:`allow` takes
+    a token, or returns false if the bucket is empty.
+
+    The buckets are spread over ``shards`` dicts by the hash of the
+    client key, each guarded by its own lock, so that concurrent
+    requests from different clients seldom wait for each other.  Each
+    shard holds the buckets of at most ``max_keys / shards`` clients:
+    when a shard is full, the buckets which have refilled (and so are
+    no different from a new one) are dropped, and if that leaves the
+    shard more than half full it is emptied wholesale, which keeps the
+    cost of making room constant however many addresses an attacker
+    uses.  In a forked child the buckets start afresh.
+    """
+    def __init__(self, rate, burst, key_names=('REMOTE_ADDR',), shards=16,
+                 max_keys=100000, time=time.time):
+        self.rate = float(rate)
+        self.burst = burst
+        self.key_names = tuple(key_names)
+        self.shards = shards
+        self.max_keys = max_keys
+        self.time = time # tests override
+        self._shard_size = max(max_keys // shards, 1)
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        self._shards = [ ({}, threading.Lock()) for i in range(self.shards) ]
+
+    def __len__(self):
+        return sum([ len(buckets) for buckets, lock in self._shards ])
+
+    def key(self, environ):
+        """ Return the key of the client making the request. """
+        key_names = self.key_names
+        if len(key_names) == 1:
+            return environ.get(key_names[0], '')
+        return tuple([ environ.get(name, '') for name in key_names ])
+
+    def allow(self, environ):
+        """ Take a token from the bucket of the client making the
+        request; return false if there was none. """
+        key = self.key(environ)
+        buckets, lock = self._shards[hash(key) % self.shards]
+        now = self.time()
+        lock.acquire()
+        try:
+            bucket = buckets.get(key)
+            if bucket is None:
+                if len(buckets) >= self._shard_size:
+                    self._prune(buckets, now)
+                buckets[key] = [self.burst - 1, now]
+                return self.burst >= 1
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            if tokens > self.burst:
+                tokens = self.burst
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                return False
+            bucket[0] = tokens - 1
+            return True
+        finally:
+            lock.release()
+
+    def _prune(self, buckets, now):
+        rate = self.rate
+        burst = self.burst
+        for key, (tokens, stamp) in list(buckets.items()):
+            if tokens + (now - stamp) * rate >= burst:
+                del buckets[key]
+        if len(buckets) * 2 > self._shard_size:
+            buckets.clear()
+
+
+class IdPool(_BackgroundWorker):
+    """ A pool of pre-minted browser ids refilled by a background
+    thread.
+
+    ``mint`` is called with no arguments to produce each pooled entry.
+    Whenever taking an entry leaves fewer than ``low_watermark``
+    entries, the refill thread is woken (and started, the first time)
+    to mint entries until the pool holds ``high_watermark`` of them.
+    :meth:`get` never blocks: it returns ``None`` when the pool is
+    drained, and the caller mints inline.  In a forked child the pool
+    is emptied, as its entries are shared with the parent, and a new
+    refill thread is started on demand.
+    """
+    def __init__(self, mint, low_watermark, high_watermark):
+        self.mint = mint
+        self.low_watermark = low_watermark
+        self.high_watermark = high_watermark
+        self.hits = 0
+        self.misses = 0
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        self._entries = collections.deque()
+        self._wakeup = threading.Event()
+        self._reset_worker()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self):
+        _check_fork()
+        entries = self._entries
+        try:
+            entry = entries.popleft()
+        except IndexError:
+            entry = None
+            self.misses += 1
+        else:
+            self.hits += 1
+        if len(entries) < self.low_watermark:
+            if self._thread is None:
+                self._start()
+            self._wakeup.set()
+        return entry
+
+    def refill(self):
+        entries = self._entries
+        while len(entries) < self.high_watermark:
+            entries.append(self.mint())
+
+    def _run(self):
+        wakeup = self._wakeup
+        while 1:
+            wakeup.wait()
+            wakeup.clear()
+            self.refill()
 
 
 class StartResponseWrapper(object):
+    """ Buffers a downstream application's response until
+    :meth:`finish_response` is called.  No longer used by
+    :class:`BrowserIdMiddleware`, which passes the response through;
+    kept for backwards compatibility.
+    """
     def __init__(self, start_response):
         self.start_response = start_response
         self.status = None
         self.headers = []
         self.exc_info = None
-        self.buffer = StringIO.StringIO()
+        self.buffer = io.BytesIO()
 
     def wrap_start_response(self, status, headers, exc_info=None):
         self.headers = headers
@@ -256,7 +1616,21 @@ def make_middleware(app, global_conf, secret_key,
                     cookie_name='repoze.browserid',
                     cookie_path='/', cookie_domain=None,
                     cookie_lifetime=None, cookie_secure=False,
-                    vary=None):
+                    vary=None, id_generator=None,
+                    cookie_expiry='expires', verified_cache_size=0,
+                    verified_cache_ttl=None, digest='md5',
+                    digest_size=None, cookie_encoding='hex',
+                    pool_high_watermark=0, pool_low_watermark=None,
+                    lazy=False, exclude_paths=None, include_paths=None,
+                    exclude_methods=None, exclude_user_agents=None,
+                    metrics=False, metrics_timings=False,
+                    metrics_path=None, key_id=None, old_keys=None,
+                    registry=None, events=None, events_queue_size=10000,
+                    events_policy='drop', cookie_refresh=None, bots=False,
+                    bot_user_agents=None, bot_browser_id=None,
+                    bot_cache_size=1024, mint_rate=None, mint_burst=10,
+                    mint_limit_keys='REMOTE_ADDR', mint_limiter=None,
+                    rejected_cache_size=0, rejected_cache_ttl=60):
     """
     Return an object suitable for use as WSGI middleware that
     implements a browser id manager.  Usually used as a PasteDeploy
@@ -295,7 +1669,164 @@ def make_middleware(app, global_conf, secret_key,
 
     ``vary``
        A space-separated string including the header names on which to vary.
-    
+
+    ``id_generator``
+       The name of the browser id generator to use: ``legacy`` (the
+       default; random/time/pid ids guarded by a global lock),
+       ``random`` (ids read from ``os.urandom``, no locking),
+       ``counter`` (per-thread counters under a random per-process
+       prefix, no locking), ``compact`` (128 random bits as 22
+       characters of URL-safe base64) or ``compact-ordered`` (like
+       ``compact`` but starting with a millisecond timestamp).
+
+    ``cookie_expiry``
+       Which attribute(s) express ``cookie_lifetime`` in the Set-Cookie
+       header: ``expires`` (the default), ``max-age`` or ``both``.
+
+    ``verified_cache_size``
+       The number of verified cookie values to remember so that
+       returning browsers skip the HMAC computation.  Defaults to ``0``,
+       meaning don't cache.
+
+    ``verified_cache_ttl``
+       An integer number of seconds after which a remembered cookie
+       value is verified again.  Defaults to ``None`` (no expiry).
+
+    ``digest``
+       The name of the ``hashlib`` hash used for the cookie HMAC, e.g.
+       ``sha256`` or ``blake2b``.  Defaults to ``md5``.
+
+    ``digest_size``
+       An integer number of bytes to which the HMAC is truncated, no
+       fewer than 10 nor than half the digest size.  Defaults to the
+       full digest size.
+
+    ``cookie_encoding``
+       ``hex`` (the default) or ``base64`` (URL-safe, more compact).
+
+    ``pool_high_watermark``
+       If nonzero, the maximum number of pre-minted browser ids kept in
+       a pool refilled by a background thread.  Defaults to ``0``
+       (no pool).
+
+    ``pool_low_watermark``
+       The pool size below which refilling starts.  Defaults to half of
+       ``pool_high_watermark``.
+
+    ``lazy``
+       Boolean.  If ``true``, ``repoze.browserid`` in the environ is a
+       callable returning the browser id, and a browser id is only
+       minted (and its cookie set) if the application calls it.
+
+    ``exclude_paths``
+       A space-separated string of path prefixes or glob patterns;
+       matching requests bypass the middleware.
+
+    ``include_paths``
+       A space-separated string of path prefixes or glob patterns which
+       are handled even though they match ``exclude_paths``.
+
+    ``exclude_methods``
+       A space-separated string of request methods which bypass the
+       middleware, e.g. ``HEAD OPTIONS``.
+
+    ``exclude_user_agents``
+       A newline-separated string of User-Agent glob patterns which
+       bypass the middleware.
+
+    ``metrics``
+       Boolean.  If ``true``, count what the middleware does; the
+       counts are available from the middleware's ``metrics``
+       attribute.
+
+    ``metrics_timings``
+       Boolean.  If ``true``, also record latency histograms.
+
+    ``metrics_path``
+       A path (e.g. ``/_browserid/metrics``) at which the middleware
+       serves a JSON snapshot of its metrics.  Implies ``metrics``.
+
+    ``key_id``
+       A short name for ``secret_key`` (letters, digits, ``_``, ``.``
+       and ``-``), embedded in the cookies it signs so that it can
+       later be rotated.  Defaults to ``None``
+       (no key id).
+
+    ``old_keys``
+       A whitespace-separated string of ``key_id:secret_key`` entries
+       naming retired keys whose cookies are still accepted and
+       re-signed with ``secret_key``.  Cookies carrying no key id are
+       checked against the entry with an empty key id (``:secret``).
+
+    ``registry``
+       Where to record the browser ids handed out and look up revoked
+       ones: ``memory:``, ``sqlite:<path>`` or
+       ``resp://<host>[:<port>][/<key prefix>][?expire=<seconds>]`` (a
+       Redis-protocol server, whose keys expire after ``expire``
+       seconds if given).  Defaults to ``None`` (no registry).
+
+    ``events``
+       Where to record an event for each browser id handed out:
+       ``jsonl:<path>`` (a file of JSON lines) or ``sqlite:<path>``.
+       Defaults to ``None`` (no events).
+
+    ``events_queue_size``
+       The number of events which may wait to be written.  Defaults to
+       ``10000``.
+
+    ``events_policy``
+       What to do with an event when the queue is full: ``drop`` (the
+       default) or ``block`` (wait for room).
+
+    ``cookie_refresh``
+       An integer number of seconds.  With ``cookie_lifetime`` set,
+       cookies carry the time they were issued and are sent again with
+       a fresh lifetime once they are due to expire within this many
+       seconds.  Defaults to ``None`` (never refresh).
+
+    ``bots``
+       Boolean.  If ``true``, requests from bots (recognized by their
+       User-Agent with the built-in patterns) holding no valid cookie
+       are not given a new browser id.
+
+    ``bot_user_agents``
+       A newline-separated string of lowercase regular expressions
+       recognizing bots by their lowercased User-Agent, replacing the
+       built-in patterns.
+       Implies ``bots``.
+
+    ``bot_browser_id``
+       The browser id set for bots and throttled requests, shared by all
+       of them.  Defaults to ``None`` (``repoze.browserid`` is
+       ``None``).
+
+    ``bot_cache_size``
+       The number of User-Agent verdicts remembered.  Defaults to
+       ``1024``.
+
+    ``mint_rate``
+       The number of browser ids per second a client may be given over
+       time.  Requests from a client beyond its allowance are treated
+       like bots.  Defaults to ``None`` (no limit).
+
+    ``mint_burst``
+       The number of browser ids a client may be given in quick
+       succession.  Defaults to ``10``.
+
+    ``mint_limit_keys``
+       A space-separated string of the environ keys identifying a
+       client.  Defaults to ``REMOTE_ADDR``; behind a proxy use a key
+       holding the client's address, e.g. ``HTTP_X_REAL_IP``.
+
+    ``rejected_cache_size``
+       The number of cookie values which failed the tamper check to
+       remember so that they are turned away without an HMAC when sent
+       again.  Defaults to ``0``, meaning don't cache.
+
+    ``rejected_cache_ttl``
+       An integer number of seconds for which a rejected cookie value
+       is remembered.  Defaults to ``60``.
+
     """
     if cookie_lifetime:
         cookie_lifetime = int(cookie_lifetime)
@@ -304,7 +1835,115 @@ def make_middleware(app, global_conf, secret_key,
         vary = tuple([ x.strip() for x in vary.split() ])
     else:
         vary = ()
+    verified_cache_size = int(verified_cache_size or 0)
+    if verified_cache_ttl:
+        verified_cache_ttl = int(verified_cache_ttl)
+    if digest_size:
+        digest_size = int(digest_size)
+    if cookie_refresh:
+        cookie_refresh = int(cookie_refresh)
+    else:
+        cookie_refresh = None
+    if bot_user_agents or asbool(bots):
+        bot_classifier = UserAgentClassifier(
+            _split(bot_user_agents, '\n') or None, int(bot_cache_size))
+    else:
+        bot_classifier = None
+    pool_high_watermark = int(pool_high_watermark or 0)
+    if pool_low_watermark is not None:
+        pool_low_watermark = int(pool_low_watermark)
+    rejected_cache_size = int(rejected_cache_size or 0)
+    if rejected_cache_ttl:
+        rejected_cache_ttl = int(rejected_cache_ttl)
+    old_keys = [ entry.split(':', 1) for entry in _split(old_keys) ]
+    for entry in old_keys:
+        if len(entry) != 2:
+            raise ValueError('Invalid old_keys entry %r' % entry[0])
+    shared = _make_shared(id_generator, metrics, metrics_timings,
+                          metrics_path, registry, events, events_queue_size,
+                          events_policy, mint_rate, mint_burst,
+                          mint_limit_keys, mint_limiter)
     return BrowserIdMiddleware(app, secret_key, cookie_name, cookie_path,
                               cookie_domain, cookie_lifetime, cookie_secure,
-                              vary)
+                              vary, cookie_expiry=cookie_expiry,
+                              verified_cache_size=verified_cache_size,
+                              verified_cache_ttl=verified_cache_ttl,
+                              digest=digest, digest_size=digest_size,
+                              cookie_encoding=cookie_encoding,
+                              pool_high_watermark=pool_high_watermark,
+                              pool_low_watermark=pool_low_watermark,
+                              lazy=asbool(lazy),
+                              exclude_paths=_split(exclude_paths),
+                              include_paths=_split(include_paths),
+                              exclude_methods=_split(exclude_methods),
+                              exclude_user_agents=_split(exclude_user_agents,
+                                                         '\n'),
+                              metrics_path=metrics_path,
+                              key_id=key_id, old_keys=old_keys,
+                              cookie_refresh=cookie_refresh,
+                              bot_classifier=bot_classifier,
+                              bot_browser_id=bot_browser_id,
+                              rejected_cache_size=rejected_cache_size,
+                              rejected_cache_ttl=rejected_cache_ttl,
+                              **shared)
+
+def _make_shared(id_generator=None, metrics=False, metrics_timings=False,
+                 metrics_path=None, registry=None, events=None,
+                 events_queue_size=10000, events_policy='drop',
+                 mint_rate=None, mint_burst=10,
+                 mint_limit_keys='REMOTE_ADDR', mint_limiter=None):
+    """
+    Return a dictionary of the ``id_generator``, ``metrics``,
+    ``registry``, ``events`` and ``mint_limiter`` arguments of
+    :class:`BrowserIdMiddleware` described by the Paste options of the
+    same names (``mint_rate``, ``mint_burst`` and ``mint_limit_keys``
+    for the limiter).  Options which are already objects rather than
+    strings are returned as they are, so that several middleware
+    instances can share them.
+    """
+    if isinstance(metrics, Metrics):
+        pass
+    elif asbool(metrics) or asbool(metrics_timings) or metrics_path:
+        metrics = Metrics(timings=asbool(metrics_timings))
+    else:
+        metrics = None
+    if id_generator is None or _is_text(id_generator):
+        try:
+            factory = _ID_GENERATORS[id_generator or 'legacy']
+        except KeyError:
+            raise ValueError('Unknown id_generator %r' % id_generator)
+        if factory is not None:
+            id_generator = factory()
+        else:
+            id_generator = None
+    if not _is_text(registry):
+        pass
+    elif registry:
+        from repoze.browserid.registry import registry_from_url
+        registry = registry_from_url(registry)
+    else:
+        registry = None
+    if not _is_text(events):
+        pass
+    elif events:
+        from repoze.browserid.events import EventQueue, sink_from_url
+        events = EventQueue(sink_from_url(events), int(events_queue_size),
+                            events_policy)
+    else:
+        events = None
+    if mint_limiter is None and mint_rate:
+        mint_limiter = RateLimiter(float(mint_rate), int(mint_burst),
+                                   _split(mint_limit_keys) or
+                                   ('REMOTE_ADDR',))
+    return {'id_generator': id_generator, 'metrics': metrics,
+            'registry': registry, 'events': events,
+            'mint_limiter': mint_limiter}
+
+def _is_text(value):
+    return isinstance(value, (str, type(u'')))
+
+def _split(value, sep=None):
+    if not value:
+        return ()
+    return tuple([ x.strip() for x in value.split(sep) if x.strip() ])
     
@@ -0,0 +1,460 @@
+##############################################################################
+#
+# Copyright (c) 2008 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+"""
+Registries of issued and revoked browser ids.
+
+A registry records every browser id the middleware hands out and lets
+an application revoke browser ids, e.g. when the session they key is
+invalidated.  The middleware rejects cookies carrying a revoked browser
+id as though they had been tampered with.
+
+The HMAC already proves that a browser id was minted by the middleware,
+so browser ids the registry doesn't know of are accepted: newly minted
+ids are written in batches by a background thread and may not have
+reached a shared store by the time the browser's next request arrives
+at another process.
+"""
+
+import socket
+import threading
+import time
+
+from repoze.browserid._util import _BackgroundWorker
+from repoze.browserid._util import _FORK_SENSITIVE
+from repoze.browserid._util import _check_fork
+from repoze.browserid._util import _latin1
+from repoze.browserid._util import _native
+from repoze.browserid.middleware import LRUCache
+
+LIVE = 'live'
+REVOKED = 'revoked'
+
+
+class RegistryError(Exception):
+    """ Raised when a registry's store reports an error. """
+
+
+class Registry(_BackgroundWorker):
+    """ Base class of the registries.
+
+    Subclasses implement ``_lookup(browser_id)``, returning ``LIVE``,
+    ``REVOKED`` or ``None``; ``_register(browser_ids)``, storing a batch
+    of browser ids as live unless already known; and
+    ``_revoke(browser_id)``.
+
+    :meth:`register` only queues the browser id; queued ids are written
+    in batches of up to ``batch_size`` by a background thread, which
+    wakes when a batch is full or ``flush_interval`` seconds after the
+    first id was queued.  Should the store fall behind, ids beyond
+    ``max_pending`` are dropped and counted in ``dropped``; like ids
+    the store never received, they are still accepted.  Whether a
+    browser id is revoked is remembered for ``cache_ttl`` seconds in a
+    cache of ``cache_size`` entries, so that most requests never reach
+    the store; revocations made through other processes therefore take
+    up to ``cache_ttl`` seconds to be noticed.  Should the store fail
+    while being asked, browser ids are assumed not to be revoked, and
+    the store isn't asked again for ``retry_after`` seconds, so that an
+    unreachable store doesn't hold up every request.
+    """
+    def __init__(self, cache_size=10000, cache_ttl=30, batch_size=100,
+                 flush_interval=1.0, max_pending=10000, retry_after=5.0):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.retry_after = retry_after
+        self.dropped = 0
+        if cache_size:
+            self.cache = LRUCache(cache_size, cache_ttl)
+        else:
+            self.cache = None
+        self.time = time.time # tests override
+        self._retry_at = 0
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        # queued ids belong to the parent, which writes them
+        self._pending = []
+        self._pending_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._reset_worker()
+
+    def register(self, browser_id):
+        """ Queue ``browser_id`` to be recorded as live. """
+        _check_fork()
+        self._pending_lock.acquire()
+        try:
+            pending = self._pending
+            if len(pending) >= self.max_pending:
+                self.dropped += 1
+                return
+            pending.append(browser_id)
+            count = len(pending)
+        finally:
+            self._pending_lock.release()
+        if count == 1 or count == self.batch_size:
+            if self._thread is None:
+                self._start()
+            self._wakeup.set()
+
+    def revoke(self, browser_id):
+        """ Record ``browser_id`` as revoked, immediately. """
+        self._revoke(browser_id)
+        if self.cache is not None:
+            self.cache.set(browser_id, True)
+
+    def is_revoked(self, browser_id):
+        cache = self.cache
+        if cache is not None:
+            revoked = cache.get(browser_id)
+            if revoked is not None:
+                return revoked
+        if self._retry_at and self.time() < self._retry_at:
+            return False
+        try:
+            revoked = self._lookup(browser_id) == REVOKED
+        except (EnvironmentError, RegistryError):
+            self._retry_at = self.time() + self.retry_after
+            return False
+        if cache is not None:
+            cache.set(browser_id, revoked)
+        return revoked
+
+    def lookup(self, browser_id):
+        """ Return ``LIVE``, ``REVOKED`` or ``None`` (unknown) for
+        ``browser_id``, asking the store. """
+        return self._lookup(browser_id)
+
+    def flush(self):
+        """ Write the queued browser ids now. """
+        while 1:
+            self._pending_lock.acquire()
+            try:
+                batch = self._pending[:self.batch_size]
+                del self._pending[:self.batch_size]
+            finally:
+                self._pending_lock.release()
+            if not batch:
+                return
+            self._register(batch)
+
+    def _run(self):
+        wakeup = self._wakeup
+        while 1:
+            wakeup.wait()
+            wakeup.clear()
+            if len(self._pending) < self.batch_size:
+                time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except (EnvironmentError, RegistryError):
+                # the store is unavailable; the ids stay unrecorded,
+                # which doesn't stop them from being accepted
+                pass
+
+
+class MemoryRegistry(Registry):
+    """ A registry kept in memory, private to the process.  As it is
+    as fast as a cache, it caches nothing and writes browser ids as
+    they are registered.  Only the ``live_size`` most recently
+    registered live browser ids are remembered, in an
+    :class:`repoze.browserid.middleware.LRUCache`, so that clients
+    discarding their cookie can't grow it without bound; revoked
+    browser ids are all kept. """
+    def __init__(self, cache_size=0, live_size=10000, **kw):
+        self._live = LRUCache(live_size)
+        self._revoked = {}
+        Registry.__init__(self, cache_size=cache_size, **kw)
+
+    def register(self, browser_id):
+        self._register([browser_id])
+
+    def _lookup(self, browser_id):
+        if browser_id in self._revoked:
+            return REVOKED
+        if self._live.get(browser_id) is not None:
+            return LIVE
+        return None
+
+    def _register(self, browser_ids):
+        live = self._live
+        for browser_id in browser_ids:
+            if browser_id not in self._revoked:
+                live.set(browser_id, True)
+
+    def _revoke(self, browser_id):
+        self._revoked[browser_id] = True
+
+
+class ConnectionPool(object):
+    """ Connections, made by calling ``connect``, kept for reuse.
+
+    :meth:`acquire` hands out an idle connection, making a new one if
+    there is none; :meth:`release` takes it back, closing it if
+    ``max_idle`` connections are already idle.  A connection which
+    failed should be passed to :meth:`discard` instead.  In a forked
+    child the idle connections, which are shared with the parent, are
+    forgotten without being closed.
+    """
+    def __init__(self, connect, max_idle=4):
+        self.connect = connect
+        self.max_idle = max_idle
+        self._after_fork()
+        _FORK_SENSITIVE.add(self)
+
+    def _after_fork(self):
+        self._idle = []
+
+    def acquire(self):
+        _check_fork()
+        try:
+            return self._idle.pop()
+        except IndexError:
+            return self.connect()
+
+    def release(self, connection):
+        if len(self._idle) < self.max_idle:
+            self._idle.append(connection)
+        else:
+            connection.close()
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class SQLiteRegistry(Registry):
+    """ A registry kept in an SQLite database at ``path``, which may be
+    shared by the processes of one host.  Writes wait up to ``timeout``
+    seconds for a lock on the database, but the lookups made while
+    serving a request only ``lookup_timeout`` seconds. """
+    def __init__(self, path, table='browserid_registry', pool_size=4,
+                 timeout=5.0, lookup_timeout=0.1, **kw):
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self.path = path
+        self.table = table
+        self.timeout = timeout
+        self.lookup_timeout = lookup_timeout
+        self.pool = ConnectionPool(self._connect, pool_size)
+        connection = self.pool.acquire()
+        try:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS %s ('
+                'browser_id TEXT PRIMARY KEY, '
+                'revoked INTEGER NOT NULL, '
+                'created REAL NOT NULL)' % table)
+            connection.commit()
+        finally:
+            self.pool.release(connection)
+        Registry.__init__(self, **kw)
+
+    def _connect(self):
+        # pooled connections are used by one thread at a time, but
+        # not always the same one
+        return self._sqlite3.connect(self.path, timeout=self.lookup_timeout,
+                                     check_same_thread=False)
+
+    def _execute(self, sql, params=(), many=False, write=True):
+        connection = self.pool.acquire()
+        try:
+            if write:
+                self._busy_timeout(connection, self.timeout)
+            try:
+                if many:
+                    cursor = connection.executemany(sql, params)
+                else:
+                    cursor = connection.execute(sql, params)
+                rows = cursor.fetchall()
+                connection.commit()
+            finally:
+                if write:
+                    self._busy_timeout(connection, self.lookup_timeout)
+        except self._sqlite3.Error as e:
+            self.pool.discard(connection)
+            raise RegistryError(str(e))
+        self.pool.release(connection)
+        return rows
+
+    def _busy_timeout(self, connection, timeout):
+        connection.execute('PRAGMA busy_timeout = %d' % (timeout * 1000))
+
+    def _lookup(self, browser_id):
+        rows = self._execute('SELECT revoked FROM %s WHERE browser_id = ?'
+                             % self.table, (browser_id,), write=False)
+        if not rows:
+            return None
+        return rows[0][0] and REVOKED or LIVE
+
+    def _register(self, browser_ids):
+        now = time.time()
+        self._execute('INSERT OR IGNORE INTO %s VALUES (?, 0, ?)'
+                      % self.table,
+                      [ (browser_id, now) for browser_id in browser_ids ],
+                      many=True)
+
+    def _revoke(self, browser_id):
+        self._execute('INSERT OR REPLACE INTO %s VALUES (?, 1, ?)'
+                      % self.table, (browser_id, time.time()))
+
+
+class RESPConnection(object):
+    """ A connection to a server speaking the Redis serialization
+    protocol (RESP), e.g. Redis or a compatible store. """
+    def __init__(self, host='localhost', port=6379, timeout=5.0):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.file = self.sock.makefile('rb')
+
+    def settimeout(self, timeout):
+        """ Wait up to ``timeout`` seconds for each reply. """
+        self.sock.settimeout(timeout)
+
+    def execute(self, *commands):
+        """ Send each of ``commands`` (sequences of strings) without
+        waiting for replies, then return the list of replies.  Strings
+        travel as latin-1 bytes. """
+        request = []
+        for command in commands:
+            request.append('*%d\r\n' % len(command))
+            for arg in command:
+                arg = str(arg)
+                request.append('$%d\r\n%s\r\n' % (len(arg), arg))
+        self.sock.sendall(_latin1(''.join(request)))
+        return [ self._read_reply() for command in commands ]
+
+    def _read_reply(self):
+        line = _native(self.file.readline())
+        if not line.endswith('\r\n'):
+            raise EnvironmentError('Connection closed by server')
+        kind, value = line[0], line[1:-2]
+        if kind == '+':
+            return value
+        if kind == '-':
+            raise RegistryError(value)
+        if kind == ':':
+            return int(value)
+        if kind == '$':
+            length = int(value)
+            if length == -1:
+                return None
+            data = self.file.read(length + 2)
+            if len(data) != length + 2:
+                raise EnvironmentError('Connection closed by server')
+            return _native(data[:-2])
+        if kind == '*':
+            length = int(value)
+            if length == -1:
+                return None
+            return [ self._read_reply() for x in range(length) ]
+        raise RegistryError('Unexpected reply %r' % line)
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class RESPRegistry(Registry):
+    """ A registry kept in a Redis-protocol server, shared by every
+    process which can reach it.  Each browser id is stored under
+    ``key_prefix`` plus the browser id, expiring after ``expire``
+    seconds if given, which should be no less than the cookie lifetime
+    lest revocations expire before the cookies they revoke; a batch of
+    newly minted ids is written as one pipeline of commands.  Writes
+    wait up to ``timeout`` seconds for their replies, but connecting and
+    the lookups made while serving a request only ``lookup_timeout``
+    seconds. """
+    def __init__(self, host='localhost', port=6379, key_prefix='browserid:',
+                 expire=None, pool_size=4, timeout=5.0, lookup_timeout=0.1,
+                 **kw):
+        self.host = host
+        self.port = port
+        self.key_prefix = key_prefix
+        self.expire = expire
+        self.timeout = timeout
+        self.lookup_timeout = lookup_timeout
+        self.pool = ConnectionPool(self._connect, pool_size)
+        Registry.__init__(self, **kw)
+
+    def _connect(self):
+        return RESPConnection(self.host, self.port, self.lookup_timeout)
+
+    def _execute(self, *commands):
+        return self._execute_within(self.timeout, commands)
+
+    def _execute_within(self, timeout, commands):
+        connection = self.pool.acquire()
+        try:
+            connection.settimeout(timeout)
+            replies = connection.execute(*commands)
+        except Exception:
+            # an error reply leaves the rest of a pipeline's replies
+            # unread, so the connection can't be reused either
+            self.pool.discard(connection)
+            raise
+        self.pool.release(connection)
+        return replies
+
+    def _set(self, browser_id, value, *options):
+        command = ['SET', self.key_prefix + browser_id, value]
+        if self.expire:
+            command.extend(['EX', self.expire])
+        command.extend(options)
+        return command
+
+    def _lookup(self, browser_id):
+        value = self._execute_within(
+            self.lookup_timeout, [['GET', self.key_prefix + browser_id]])[0]
+        if value is None:
+            return None
+        return value == '0' and REVOKED or LIVE
+
+    def _register(self, browser_ids):
+        self._execute(*[ self._set(browser_id, '1', 'NX')
+                         for browser_id in browser_ids ])
+
+    def _revoke(self, browser_id):
+        self._execute(self._set(browser_id, '0'))
+
+
+def registry_from_url(url):
+    """ Return a registry described by ``url``: ``memory:``,
+    ``sqlite:<path>`` or
+    ``resp://<host>[:<port>][/<key prefix>][?expire=<seconds>]``. """
+    scheme, sep, rest = url.partition(':')
+    if scheme == 'memory':
+        return MemoryRegistry()
+    if scheme == 'sqlite' and rest:
+        return SQLiteRegistry(rest)
+    if scheme in ('resp', 'redis') and rest.startswith('//'):
+        rest, sep, query = rest.partition('?')
+        address, sep, key_prefix = rest[2:].partition('/')
+        host, sep, port = address.partition(':')
+        kw = {}
+        if key_prefix:
+            kw['key_prefix'] = key_prefix
+        for param in query.split('&'):
+            name, sep, value = param.partition('=')
+            if name == 'expire' and value:
+                kw['expire'] = int(value)
+            elif param:
+                raise ValueError('Unknown registry parameter %r' % param)
+        return RESPRegistry(host or 'localhost', int(port or 6379), **kw)
+    raise ValueError('Unknown registry %r' % url)
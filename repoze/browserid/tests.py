@@ -1,3 +1,4 @@
+import sys
 import unittest
 
 _DEFAULT_BID = "e193a01ecf8d30ad0affefd332ce934e32ffce72"
@@ -5,6 +6,24 @@ _DEFAULT_COOKIE = "%s!1f2115dde0ba7312bdc94942e227666c" % _DEFAULT_BID
 # see the "d" at the end?
 _BAD_COOKIE = "%s!1f2115dde0ba7312bdc94942e227666d" % _DEFAULT_BID
 
+try:
+    from StringIO import StringIO as _TextIO
+except ImportError: # Python 3
+    from io import StringIO as _TextIO
+
+def _hmac(key, msg=None, digestmod=None):
+    """ An HMAC (MD5 unless told otherwise) of text arguments. """
+    import hashlib
+    import hmac
+    h = hmac.new(key.encode('latin-1'), digestmod=digestmod or hashlib.md5)
+    if msg is not None:
+        h.update(msg.encode('latin-1'))
+    return h
+
+def _sha(text):
+    from hashlib import sha1
+    return sha1(text.encode('latin-1'))
+
 class TestBrowserIdMiddleware(unittest.TestCase):
     _RANDINT = lambda *arg: 0
     _TIME = lambda *arg: 0
@@ -23,18 +42,13 @@ class TestBrowserIdMiddleware(unittest.TestCase):
         self.exc_info = None
 
     def _assertBrowserId(self, browser_id):
-        try:
-            from hashlib import sha1 as sha
-        except ImportError:
-            from sha import new as sha
         computed = '%s%s%s' % (self._RANDINT(), self._TIME(), self._PID)
-        computed = sha(computed).hexdigest()
+        computed = _sha(computed).hexdigest()
         self.assertEqual(browser_id, computed)
 
     def _assertCookieVal(self, cookie_val, secret='secret'):
         browser_id, provided_hmac = cookie_val.split('!')
-        import hmac
-        computed_hmac = hmac.new(secret, browser_id).hexdigest()
+        computed_hmac = _hmac(secret, browser_id).hexdigest()
         self.assertEqual(cookie_val, '%s!%s' % (browser_id, computed_hmac))
         self._assertBrowserId(browser_id)
 
@@ -125,6 +139,44 @@ class TestBrowserIdMiddleware(unittest.TestCase):
         self.assertEqual(expiresh, 'Expires=%s' % expires)
         self.assertEqual(app_iter, [])
 
+    def test_cookie_lifetime_max_age(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=86400,
+                                   cookie_expiry='max-age')
+        environ = {}
+        middleware(environ, self._start_response)
+        header_name, header_val = self.headers[0]
+        cookie_val, path, max_age = self._get_cookie_components(header_val)
+        self.assertEqual(path, 'Path=/')
+        self.assertEqual(max_age, 'Max-Age=86400')
+
+    def test_cookie_lifetime_both(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=86400,
+                                   cookie_expiry='both')
+        environ = {}
+        middleware(environ, self._start_response)
+        header_name, header_val = self.headers[0]
+        cookie_val, path, expiresh, max_age = self._get_cookie_components(
+            header_val)
+        self.assertEqual(expiresh, 'Expires=Fri 02-Jan-1970 00:00:00 GMT')
+        self.assertEqual(max_age, 'Max-Age=86400')
+
+    def test_cookie_expiry_unknown(self):
+        self.assertRaises(ValueError, self._makeOne, 'secret', 'thecookiename',
+                          cookie_expiry='nonesuch')
+
+    def test_get_expires_cached(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=10)
+        first = middleware._get_expires(0.25)
+        self.assertEqual(first, 'Thu 01-Jan-1970 00:00:10 GMT')
+        self.assertEqual(middleware._expires_cache, (10, first))
+        middleware._expires_cache = (10, 'cached')
+        self.assertEqual(middleware._get_expires(0.75), 'cached')
+        self.assertEqual(middleware._get_expires(1),
+                         'Thu 01-Jan-1970 00:00:11 GMT')
+
     def test_cookie_secure(self):
         middleware = self._makeOne('secret', 'thecookiename',
                                    cookie_secure=True)
@@ -142,6 +194,101 @@ class TestBrowserIdMiddleware(unittest.TestCase):
         self.assertEqual(secure, 'Secure')
         self.assertEqual(app_iter, [])
 
+    def test_nocookie_start_response_not_delayed(self):
+        events = []
+        def start_response(status, headers, exc_info=None):
+            events.append(('start_response', status, headers, exc_info))
+            return events.append
+        def app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            events.append('started')
+            write('written')
+            return ['iterated']
+        middleware = self._makeOne('secret', 'thecookiename')
+        middleware.app = app
+        result = middleware({}, start_response)
+        self.assertEqual(result, ['iterated'])
+        self.assertEqual(len(events), 3)
+        name, status, headers, exc_info = events[0]
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(len(headers), 2)
+        self.assertEqual(headers[0], ('Content-Type', 'text/plain'))
+        self.assertEqual(headers[1][0], 'Set-Cookie')
+        self.assertEqual(exc_info, None)
+        self.assertEqual(events[1:], ['started', 'written'])
+
+    def test_nocookie_start_response_exc_info(self):
+        def app(environ, start_response):
+            start_response('500 Error', [], 'exc_info')
+            return []
+        middleware = self._makeOne('secret', 'thecookiename')
+        middleware.app = app
+        middleware({}, self._start_response)
+        self.assertEqual(self.status, '500 Error')
+        self.assertEqual(self.exc_info, 'exc_info')
+        self.assertEqual(self.headers[0][0], 'Set-Cookie')
+
+    def test_get_cookie_value_noheader(self):
+        middleware = self._makeOne('secret', 'bid')
+        self.assertEqual(middleware._get_cookie_value({}), None)
+        self.assertEqual(middleware._get_cookie_value({'HTTP_COOKIE':''}),
+                         None)
+
+    def test_get_cookie_value_absent(self):
+        middleware = self._makeOne('secret', 'bid')
+        environ = {'HTTP_COOKIE':'a=1; xbid=2; c=bid=3'}
+        self.assertEqual(middleware._get_cookie_value(environ), None)
+
+    def test_get_cookie_value_first(self):
+        middleware = self._makeOne('secret', 'bid')
+        environ = {'HTTP_COOKIE':'bid=abc!def; a=1'}
+        self.assertEqual(middleware._get_cookie_value(environ), 'abc!def')
+
+    def test_get_cookie_value_last(self):
+        middleware = self._makeOne('secret', 'bid')
+        environ = {'HTTP_COOKIE':'a=1;\tbid= abc!def '}
+        self.assertEqual(middleware._get_cookie_value(environ), 'abc!def')
+
+    def test_get_cookie_value_among_many(self):
+        middleware = self._makeOne('secret', 'bid')
+        cookies = [ '_ga%s=GA1.2.%s' % (x, x * 7919) for x in range(30) ]
+        cookies.insert(15, 'bid=abc!def')
+        cookies.append('xbid=other')
+        environ = {'HTTP_COOKIE':'; '.join(cookies)}
+        self.assertEqual(middleware._get_cookie_value(environ), 'abc!def')
+
+    def test_get_cookie_value_duplicate_last_wins(self):
+        middleware = self._makeOne('secret', 'bid')
+        environ = {'HTTP_COOKIE':'bid=first; bid=second; a=1'}
+        self.assertEqual(middleware._get_cookie_value(environ), 'second')
+
+    def test_get_cookie_value_quoted(self):
+        middleware = self._makeOne('secret', 'bid')
+        environ = {'HTTP_COOKIE':'a=1; bid="abc\\"def"'}
+        self.assertEqual(middleware._get_cookie_value(environ), 'abc"def')
+
+    def test_get_cookie_value_quoted_unparseable(self):
+        middleware = self._makeOne('secret', 'bid')
+        environ = {'HTTP_COOKIE':'bid="abc'}
+        self.assertEqual(middleware._get_cookie_value(environ), None)
+
+    def test_set_cookie_template(self):
+        middleware = self._makeOne('secret', 'the%cookie',
+                                   cookie_path='/10%',
+                                   cookie_domain='repoze.org',
+                                   cookie_lifetime=10,
+                                   cookie_secure=True)
+        self.assertEqual(middleware._set_cookie_template,
+                         'the%%cookie=%s; Path=/10%%; Domain=repoze.org; '
+                         'Expires=%s; Secure;')
+        self.assertEqual(middleware._set_cookie_template % ('val', 'exp'),
+                         'the%cookie=val; Path=/10%; Domain=repoze.org; '
+                         'Expires=exp; Secure;')
+
+    def test_set_cookie_template_nopath(self):
+        middleware = self._makeOne('secret', 'thecookiename', cookie_path='')
+        self.assertEqual(middleware._set_cookie_template, 'thecookiename=%s; ')
+
     def test_defaults_withcookie_untampered(self):
         middleware = self._makeOne('secret', 'thecookiename')
         environ = {'HTTP_COOKIE':'thecookiename=%s; Path=/;' % _DEFAULT_COOKIE}
@@ -174,24 +321,394 @@ class TestBrowserIdMiddleware(unittest.TestCase):
         browser_id = middleware.new(0)
         self._assertBrowserId(browser_id)
 
+    def test_new_with_id_generator(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   id_generator=lambda when: 'id%s' % when)
+        self.assertEqual(middleware.new(5), 'id5')
+
+    def test_nocookie_with_id_generator(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   id_generator=lambda when: 'abc')
+        environ = {}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], 'abc')
+        expected = 'abc!%s' % _hmac('secret', 'abc').hexdigest()
+        self.assertTrue(self.headers[0][1].startswith(
+            'thecookiename=%s; ' % expected))
+
     def test_to_cookieval_vary(self):
         middleware = self._makeOne('secret', 'thecookiename')
         middleware.vary = ('REMOTE_ADDR', 'HTTP_USER_AGENT', 'NONEXISTENT')
         environ = {'REMOTE_ADDR':'127.0.0.1', 'HTTP_USER_AGENT':'Fluzbox'}
         browser_id = middleware.new(0)
         cookie_val = middleware.to_cookieval(environ, browser_id)
-        self._assertCookieVal(cookie_val, secret='secret127.0.0.1Fluzbox')
+        h = _hmac('secret', '9:127.0.0.17:Fluzbox0:' + browser_id)
+        self.assertEqual(cookie_val, '%s!%s' % (browser_id, h.hexdigest()))
 
     def test_from_cookieval_vary(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        middleware.vary = ('REMOTE_ADDR', 'HTTP_USER_AGENT', 'NONEXISTENT')
+        environ = {'REMOTE_ADDR':'127.0.0.1', 'HTTP_USER_AGENT':'Fluzbox'}
+        cookieval = middleware.to_cookieval(environ, _DEFAULT_BID)
+        self.assertEqual(middleware._check_cookieval(environ, cookieval),
+                         (_DEFAULT_BID, '', None))
+        environ['HTTP_USER_AGENT'] = 'Fluzbox2'
+        self.assertEqual(middleware.from_cookieval(environ, cookieval), None)
+
+    def test_from_cookieval_vary_values_unambiguous(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   vary=('REMOTE_ADDR', 'HTTP_USER_AGENT'))
+        environ = {'REMOTE_ADDR':'127.0.0.1', 'HTTP_USER_AGENT':'Fluzbox'}
+        cookieval = middleware.to_cookieval(environ, _DEFAULT_BID)
+        environ = {'REMOTE_ADDR':'127.0.0.1Fluz', 'HTTP_USER_AGENT':'box'}
+        self.assertEqual(middleware.from_cookieval(environ, cookieval), None)
+
+    def test_from_cookieval_vary_legacy(self):
+        # cookies signed by earlier versions, with the vary values
+        # appended to the HMAC key, are accepted and re-signed
         middleware = self._makeOne('secret', 'thecookiename')
         middleware.vary = ('REMOTE_ADDR', 'HTTP_USER_AGENT', 'NONEXISTENT')
         environ = {'REMOTE_ADDR':'127.0.0.1', 'HTTP_USER_AGENT':'Fluzbox'}
         tamper_key = 'secret127.0.0.1Fluzbox'
-        import hmac
-        h = hmac.new(tamper_key, _DEFAULT_BID).hexdigest()
+        h = _hmac(tamper_key, _DEFAULT_BID).hexdigest()
         cookieval = '%s!%s' % (_DEFAULT_BID, h)
         browser_id = middleware.from_cookieval(environ, cookieval)
         self._assertBrowserId(browser_id)
+        environ['HTTP_COOKIE'] = 'thecookiename=%s' % cookieval
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(self.headers[0][1], 'thecookiename=%s; Path=/; ' %
+                         middleware.to_cookieval(environ, _DEFAULT_BID))
+        self.assertEqual(middleware.from_cookieval(environ, _BAD_COOKIE),
+                         None)
+
+    def test_digest_sha256(self):
+        import hashlib
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   digest='sha256')
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        expected = _hmac('secret', _DEFAULT_BID, hashlib.sha256)
+        self.assertEqual(cookie_val,
+                         '%s!%s' % (_DEFAULT_BID, expected.hexdigest()))
+        self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                         _DEFAULT_BID)
+        self.assertEqual(middleware.from_cookieval({}, _DEFAULT_COOKIE), None)
+
+    def test_digest_size_truncates(self):
+        import hashlib
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   digest='sha256', digest_size=16)
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        expected = _hmac('secret', _DEFAULT_BID, hashlib.sha256)
+        self.assertEqual(cookie_val,
+                         '%s!%s' % (_DEFAULT_BID, expected.hexdigest()[:32]))
+        self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                         _DEFAULT_BID)
+
+    def test_digest_size_out_of_range(self):
+        for digest_size in (1, 2, 9, 17, 32):
+            self.assertRaises(ValueError, self._makeOne, 'secret',
+                              'thecookiename', digest='md5',
+                              digest_size=digest_size)
+        # at least half of a longer digest is kept
+        self.assertRaises(ValueError, self._makeOne, 'secret',
+                          'thecookiename', digest='sha256', digest_size=15)
+        middleware = self._makeOne('secret', 'thecookiename', digest='md5',
+                                   digest_size=10)
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                         _DEFAULT_BID)
+
+    def test_digest_unknown(self):
+        self.assertRaises(ValueError, self._makeOne, 'secret', 'thecookiename',
+                          digest='nonesuch')
+
+    def test_cookie_encoding_base64(self):
+        import base64
+        import binascii
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_encoding='base64')
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        payload, mac = cookie_val.split('!')
+        self.assertEqual(len(payload), 28)
+        self.assertEqual(payload[0], '~')
+        self.assertEqual(binascii.unhexlify(_DEFAULT_BID),
+                         base64.urlsafe_b64decode(payload[1:] + '='))
+        expected = _hmac('secret', payload).digest()
+        self.assertEqual(mac, base64.urlsafe_b64encode(expected)
+                         .rstrip(b'=').decode('ascii'))
+        self.assertEqual(len(cookie_val), 51)
+        self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                         _DEFAULT_BID)
+
+    def test_cookie_encoding_base64_accepts_hex(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_encoding='base64')
+        self.assertEqual(middleware.from_cookieval({}, _DEFAULT_COOKIE),
+                         _DEFAULT_BID)
+
+    def test_cookie_encoding_base64_nonhex_id(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_encoding='base64')
+        for browser_id in ('abc', 'x' * 40, _DEFAULT_BID.upper()):
+            cookie_val = middleware.to_cookieval({}, browser_id)
+            self.assertTrue(cookie_val.startswith(browser_id + '!'))
+            self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                             browser_id)
+
+    def test_cookie_encoding_hex_accepts_base64(self):
+        encoder = self._makeOne('secret', 'thecookiename',
+                                cookie_encoding='base64')
+        middleware = self._makeOne('secret', 'thecookiename')
+        cookie_val = encoder.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                         _DEFAULT_BID)
+
+    def test_cookie_encoding_base64_tampered(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_encoding='base64')
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware.from_cookieval({}, cookie_val[:-1] + 'x'),
+                         None)
+
+    def test_cookie_encoding_unknown(self):
+        self.assertRaises(ValueError, self._makeOne, 'secret', 'thecookiename',
+                          cookie_encoding='nonesuch')
+
+    def test_nocookie_from_pool(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   pool_high_watermark=4)
+        rands = iter(range(4))
+        middleware.randint = lambda *arg: next(rands)
+        pool = middleware.id_pool
+        self.assertEqual(pool.low_watermark, 2)
+        pool._start = lambda: None
+        pool.refill()
+        self.assertEqual(len(pool), 4)
+        self.assertEqual(pool._entries[0], (_DEFAULT_BID, _DEFAULT_COOKIE))
+        pool._entries[0] = ('pooled', 'pooled!cookie')
+        environ = {}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], 'pooled')
+        self.assertEqual(self.headers[0][1],
+                         'thecookiename=pooled!cookie; Path=/; ')
+        self.assertEqual(len(pool), 3)
+
+    def test_nocookie_from_pool_vary(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   vary=('REMOTE_ADDR',),
+                                   pool_high_watermark=4,
+                                   pool_low_watermark=1)
+        rands = iter(range(4))
+        middleware.randint = lambda *arg: next(rands)
+        pool = middleware.id_pool
+        pool._start = lambda: None
+        pool.refill()
+        self.assertEqual(pool._entries[0], (_DEFAULT_BID, None))
+        environ = {'REMOTE_ADDR':'127.0.0.1'}
+        middleware(environ, self._start_response)
+        mac = _hmac('secret', '9:127.0.0.1' + _DEFAULT_BID).hexdigest()
+        self.assertEqual(self.headers[0][1],
+                         'thecookiename=%s!%s; Path=/; ' % (_DEFAULT_BID, mac))
+
+    def test_nocookie_pool_drained(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   pool_high_watermark=4)
+        pool = middleware.id_pool
+        pool._start = lambda: None
+        environ = {}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(pool.misses, 1)
+
+    def test_lazy_nocookie_untouched(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        minted = []
+        middleware.new = lambda when: minted.append(when)
+        environ = {}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertEqual(minted, [])
+
+    def test_lazy_nocookie_touched(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        browser_ids = []
+        def app(environ, start_response):
+            browser_ids.append(environ['repoze.browserid']())
+            browser_ids.append(str(environ['repoze.browserid']))
+            start_response('200 OK', [('Content-Type', 'text/plain')])
+            return []
+        middleware.app = app
+        middleware({}, self._start_response)
+        self.assertEqual(browser_ids, [_DEFAULT_BID, _DEFAULT_BID])
+        self.assertEqual(self.headers[0], ('Content-Type', 'text/plain'))
+        self.assertEqual(self.headers[1],
+                         ('Set-Cookie',
+                          'thecookiename=%s; Path=/; ' % _DEFAULT_COOKIE))
+
+    def test_lazy_withcookie(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertEqual(environ['repoze.browserid'](), _DEFAULT_BID)
+        self.assertEqual(environ['repoze.browserid'].set_cookie, None)
+
+    def test_lazy_withcookie_tampered(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _BAD_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertEqual(environ['repoze.browserid'](), _DEFAULT_BID)
+
+    def test_excluded_path(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   exclude_paths=('/static/',))
+        environ = {'PATH_INFO':'/static/logo.png'}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertFalse('repoze.browserid' in environ)
+        environ = {'PATH_INFO':'/index.html'}
+        middleware(environ, self._start_response)
+        self.assertEqual(len(self.headers), 1)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+
+    def test_excluded_method(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   exclude_methods=('head',))
+        environ = {'REQUEST_METHOD':'HEAD', 'PATH_INFO':'/'}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertFalse('repoze.browserid' in environ)
+
+    def test_metrics(self):
+        from repoze.browserid.middleware import Metrics
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics,
+                                   exclude_paths=('/static/',))
+        rands = iter([0, 0, 1])
+        middleware.randint = lambda *arg: next(rands)
+        middleware({}, self._start_response)
+        middleware({'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE},
+                   self._start_response)
+        middleware({'HTTP_COOKIE':'thecookiename=%s' % _BAD_COOKIE},
+                   self._start_response)
+        middleware({'PATH_INFO':'/static/a.css'}, self._start_response)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['no_cookie'], 1)
+        self.assertEqual(counters['verified'], 1)
+        self.assertEqual(counters['tampered'], 1)
+        self.assertEqual(counters['minted'], 2)
+        self.assertEqual(counters['excluded'], 1)
+        self.assertEqual(counters['rand_retries'], 1)
+
+    def test_metrics_lock_contention(self):
+        import repoze.browserid.middleware as module
+        metrics = module.Metrics()
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics)
+        class ContendedLock(object):
+            def __init__(self):
+                self.calls = []
+            def acquire(self, blocking=True):
+                self.calls.append(blocking)
+                return blocking
+            def release(self):
+                pass
+        lock = module._LOCK = ContendedLock()
+        try:
+            middleware._get_rand_for(0)
+        finally:
+            module._LOCK = module.threading.Lock()
+        self.assertEqual(lock.calls, [False, True])
+        self.assertEqual(metrics.snapshot()['counters']['lock_contended'], 1)
+
+    def test_lock_contention_without_metrics(self):
+        import repoze.browserid.middleware as module
+        middleware = self._makeOne('secret', 'thecookiename')
+        calls = []
+        class ContendedLock(object):
+            def acquire(self, blocking=True):
+                calls.append(blocking)
+                return blocking
+            def release(self):
+                pass
+        module._LOCK = ContendedLock()
+        try:
+            self.assertEqual(middleware._get_rand_for(0), 0)
+        finally:
+            module._LOCK = module.threading.Lock()
+        self.assertEqual(calls, [False, True])
+
+    def test_metrics_timings(self):
+        from repoze.browserid.middleware import Metrics
+        times = iter([0, 0.000003, 1, 1.0005])
+        metrics = Metrics(timings=True, timer=lambda: next(times))
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics)
+        middleware({'HTTP_COOKIE':'thecookiename=%s' % _BAD_COOKIE},
+                   self._start_response)
+        histograms = metrics.snapshot()['histograms']
+        self.assertEqual(histograms['verify'][2], 1)
+        self.assertEqual(histograms['mint'][9], 1)
+        self.assertEqual(sum(histograms['verify']), 1)
+        self.assertEqual(sum(histograms['mint']), 1)
+
+    def test_metrics_path(self):
+        import json
+        from repoze.browserid.middleware import Metrics
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics,
+                                   metrics_path='/_metrics')
+        middleware({}, self._start_response)
+        environ = {'PATH_INFO':'/_metrics'}
+        body = b''.join(middleware(environ, self._start_response))
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(self.headers[0], ('Content-Type', 'application/json'))
+        body = json.loads(body.decode('utf-8'))
+        self.assertEqual(body['counters']['minted'], 1)
+        self.assertFalse('repoze.browserid' in environ)
+
+    def test_metrics_path_without_metrics(self):
+        import json
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   metrics_path='/_metrics')
+        self.assertNotEqual(middleware.metrics, None)
+        middleware({}, self._start_response)
+        body = b''.join(middleware({'PATH_INFO':'/_metrics'},
+                                   self._start_response))
+        body = json.loads(body.decode('utf-8'))
+        self.assertEqual(body['counters']['minted'], 1)
+
+    def test_new_hmac_novary_uses_prototype(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        h = middleware._new_hmac('secret')
+        self.assertFalse(h is middleware._hmac_prototype)
+        h.update(b'abc')
+        self.assertEqual(h.hexdigest(), _hmac('secret', 'abc').hexdigest())
+        self.assertEqual(len(middleware._hmac_prototypes), 0)
+
+    def test_new_hmac_vary_caches_prototypes(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        middleware.vary = ('REMOTE_ADDR',)
+        first = middleware._new_hmac('secret', ('abc',))
+        second = middleware._new_hmac('secret', ('abc',))
+        self.assertFalse(first is second)
+        self.assertEqual(len(middleware._hmac_prototypes), 1)
+        middleware._new_hmac('secret', ('def',))
+        self.assertEqual(len(middleware._hmac_prototypes), 2)
+        second.update(b'abc')
+        self.assertEqual(second.hexdigest(),
+                         _hmac('secret', '3:abcabc').hexdigest())
+
+    def test_from_cookieval_non_ascii_mac(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        cookieval = '%s!%s' % (_DEFAULT_BID, '\xe9' * 32)
+        self.assertEqual(middleware.from_cookieval({}, cookieval), None)
+
+    def test_secret_key_bytes_or_text(self):
+        text = self._makeOne(u'sekr\xe9t', 'thecookiename')
+        raw = self._makeOne(u'sekr\xe9t'.encode('utf-8'), 'thecookiename')
+        self.assertEqual(text.to_cookieval({}, _DEFAULT_BID),
+                         raw.to_cookieval({}, _DEFAULT_BID))
 
     def test_from_cookieval_bad(self):
         middleware = self._makeOne('secret', 'thecookiename')
@@ -199,6 +716,1727 @@ class TestBrowserIdMiddleware(unittest.TestCase):
         browser_id = middleware.from_cookieval({}, cookieval)
         self.assertEqual(browser_id, None)
 
+    def test_from_cookieval_verified_cache(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   verified_cache_size=10)
+        cache = middleware.verified_cache
+        self.assertEqual(middleware.from_cookieval({}, _DEFAULT_COOKIE),
+                         _DEFAULT_BID)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.get((_DEFAULT_COOKIE, ())), _DEFAULT_BID)
+        cache.set((_DEFAULT_COOKIE, ()), 'cached')
+        self.assertEqual(middleware.from_cookieval({}, _DEFAULT_COOKIE),
+                         'cached')
+
+    def test_from_cookieval_verified_cache_tampered_not_cached(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   verified_cache_size=10)
+        self.assertEqual(middleware.from_cookieval({}, _BAD_COOKIE), None)
+        self.assertEqual(middleware.from_cookieval({}, 'badcookie'), None)
+        self.assertEqual(len(middleware.verified_cache), 0)
+
+    def test_from_cookieval_verified_cache_keyed_on_vary_values(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   verified_cache_size=10)
+        middleware.from_cookieval({}, _DEFAULT_COOKIE)
+        middleware.vary = ('REMOTE_ADDR',)
+        environ = {'REMOTE_ADDR':'127.0.0.1'}
+        self.assertEqual(middleware.from_cookieval(environ, _DEFAULT_COOKIE),
+                         None)
+
+    def test_to_cookieval_key_id(self):
+        middleware = self._makeOne('secret', 'thecookiename', key_id='k2')
+        signed = '%s!k2' % _DEFAULT_BID
+        self.assertEqual(middleware.to_cookieval({}, _DEFAULT_BID),
+                         '%s!%s' % (signed, _hmac('secret', signed)
+                                    .hexdigest()))
+
+    def test_from_cookieval_old_key(self):
+        old = self._makeOne('old', 'thecookiename', key_id='k1')
+        middleware = self._makeOne('new', 'thecookiename', key_id='k2',
+                                   old_keys=[('k1', 'old'), ('', 'legacy')])
+        cookie_val = old.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware._check_cookieval({}, cookie_val),
+                         (_DEFAULT_BID, 'k1', None))
+        legacy = self._makeOne('legacy', 'thecookiename')
+        cookie_val = legacy.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware._check_cookieval({}, cookie_val),
+                         (_DEFAULT_BID, '', None))
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware._check_cookieval({}, cookie_val),
+                         (_DEFAULT_BID, 'k2', None))
+
+    def test_from_cookieval_key_id_not_in_keyring(self):
+        old = self._makeOne('old', 'thecookiename', key_id='k1')
+        middleware = self._makeOne('new', 'thecookiename', key_id='k2')
+        cookie_val = old.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(middleware.from_cookieval({}, cookie_val), None)
+        # the tamper check no longer applies without a key id
+        self.assertEqual(middleware.from_cookieval({}, _DEFAULT_COOKIE), None)
+
+    def test_from_cookieval_key_id_is_signed(self):
+        middleware = self._makeOne('new', 'thecookiename', key_id='k2',
+                                   old_keys={'k1':'old'})
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        forged = cookie_val.replace('!k2!', '!k1!')
+        self.assertEqual(middleware.from_cookieval({}, forged), None)
+
+    def test_keyring_invalid(self):
+        for key_id in ('a!b', 'a;b c', 'a=b', 'a,b', '\u00e9'):
+            self.assertRaises(ValueError, self._makeOne, 'secret', 'name',
+                              key_id=key_id)
+        self.assertRaises(ValueError, self._makeOne, 'secret', 'name',
+                          old_keys={'k;1':'old'})
+        middleware = self._makeOne('secret', 'name', key_id='2024-01_k.1')
+        self.assertEqual(middleware.key_id, '2024-01_k.1')
+        self.assertRaises(ValueError, self._makeOne, 'secret', 'name',
+                          key_id='k1', old_keys={'k1':'old'})
+
+    def test_call_resigns_old_key(self):
+        from repoze.browserid.middleware import Metrics
+        metrics = Metrics()
+        middleware = self._makeOne('new', 'thecookiename', key_id='k2',
+                                   old_keys={'':'secret'}, metrics=metrics)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(self.headers[0],
+                         ('Set-Cookie', 'thecookiename=%s; Path=/; ' %
+                          middleware.to_cookieval({}, _DEFAULT_BID)))
+        self.assertEqual(metrics.snapshot()['counters']['resigned'], 1)
+        cookie = middleware.to_cookieval({}, _DEFAULT_BID)
+        middleware({'HTTP_COOKIE':'thecookiename=%s' % cookie},
+                   self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertEqual(metrics.snapshot()['counters']['resigned'], 1)
+
+    def test_lazy_resigns_old_key(self):
+        middleware = self._makeOne('new', 'thecookiename', key_id='k2',
+                                   old_keys={'':'secret'}, lazy=True)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers,
+                         [('Set-Cookie', 'thecookiename=%s; Path=/; ' %
+                           middleware.to_cookieval({}, _DEFAULT_BID))])
+        self.assertEqual(environ['repoze.browserid'](), _DEFAULT_BID)
+
+    def test_cookie_refresh_requires_lifetime(self):
+        self.assertRaises(ValueError, self._makeOne, 'secret', 'name',
+                          cookie_refresh=10)
+
+    def test_to_cookieval_cookie_refresh(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=100, cookie_refresh=10)
+        middleware.time = lambda: 255.5
+        signed = '%s!!ff' % _DEFAULT_BID
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        self.assertEqual(cookie_val, '%s!%s' % (signed, _hmac(
+            'secret', signed).hexdigest()))
+        self.assertEqual(middleware._check_cookieval({}, cookie_val),
+                         (_DEFAULT_BID, '', 255))
+        middleware.key_id = 'k2'
+        middleware.keyring['k2'] = 'secret'
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        self.assertTrue(cookie_val.startswith('%s!k2!ff!' % _DEFAULT_BID))
+        self.assertEqual(middleware._check_cookieval({}, cookie_val),
+                         (_DEFAULT_BID, 'k2', 255))
+
+    def test_from_cookieval_expired(self):
+        from repoze.browserid.middleware import Metrics
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=100, cookie_refresh=10,
+                                   metrics=metrics)
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        middleware.time = lambda: 99
+        self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                         _DEFAULT_BID)
+        middleware.time = lambda: 100
+        self.assertEqual(middleware.from_cookieval({}, cookie_val), None)
+        # also once verified and cached
+        self.assertEqual(middleware.from_cookieval({}, cookie_val), None)
+        self.assertEqual(metrics.snapshot()['counters']['expired'], 2)
+
+    def test_from_cookieval_issued_is_signed(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=100, cookie_refresh=10)
+        cookie_val = middleware.to_cookieval({}, _DEFAULT_BID)
+        forged = cookie_val.replace('!!0!', '!!ff!')
+        self.assertNotEqual(forged, cookie_val)
+        self.assertEqual(middleware.from_cookieval({}, forged), None)
+
+    def test_call_cookie_refresh(self):
+        from repoze.browserid.middleware import Metrics
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=100, cookie_refresh=10,
+                                   metrics=metrics)
+        cookie = middleware.to_cookieval({}, _DEFAULT_BID)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % cookie}
+        middleware.time = lambda: 89
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(self.headers, [])
+        middleware.time = lambda: 90
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % cookie}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        refreshed = middleware.to_cookieval({}, _DEFAULT_BID)
+        self.assertNotEqual(refreshed, cookie)
+        self.assertEqual(self.headers,
+                         [('Set-Cookie', 'thecookiename=%s; Path=/; '
+                           'Expires=Thu 01-Jan-1970 00:03:10 GMT; ' %
+                           refreshed)])
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['refreshed'], 1)
+        self.assertEqual(counters['resigned'], 0)
+
+    def test_call_cookie_refresh_legacy_cookie(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=100, cookie_refresh=10)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(self.headers,
+                         [('Set-Cookie', 'thecookiename=%s; Path=/; '
+                           'Expires=Thu 01-Jan-1970 00:01:40 GMT; ' %
+                           middleware.to_cookieval({}, _DEFAULT_BID))])
+
+    def test_lazy_cookie_refresh(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   cookie_lifetime=100, cookie_refresh=10,
+                                   lazy=True)
+        cookie = middleware.to_cookieval({}, _DEFAULT_BID)
+        middleware.time = lambda: 95
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % cookie}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'](), _DEFAULT_BID)
+        self.assertEqual(len(self.headers), 1)
+        self.assertNotEqual(self.headers[0][1].find('!!5f!'), -1)
+
+    def test_registry(self):
+        from repoze.browserid.middleware import Metrics
+        from repoze.browserid.registry import MemoryRegistry, LIVE
+        registry = MemoryRegistry()
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   registry=registry, metrics=metrics)
+        middleware({}, self._start_response)
+        self.assertEqual(registry.lookup(_DEFAULT_BID), LIVE)
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        registry.revoke(_DEFAULT_BID)
+        middleware.randint = lambda *arg: 1
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertNotEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(len(self.headers), 1)
+        self.assertEqual(metrics.snapshot()['counters']['revoked'], 1)
+        self.assertEqual(registry.lookup(environ['repoze.browserid']), LIVE)
+
+    def test_bot_not_minted(self):
+        from repoze.browserid.middleware import Metrics
+        from repoze.browserid.middleware import UserAgentClassifier
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   bot_classifier=UserAgentClassifier(),
+                                   metrics=metrics)
+        environ = {'HTTP_USER_AGENT':'Googlebot/2.1'}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], None)
+        self.assertEqual(self.headers, [])
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['bots'], 1)
+        self.assertEqual(counters['minted'], 0)
+        # a bot holding a valid cookie keeps its browser id
+        environ = {'HTTP_USER_AGENT':'Googlebot/2.1',
+                   'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        environ = {'HTTP_USER_AGENT':'Mozilla/5.0 (X11; Linux x86_64)'}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(len(self.headers), 1)
+
+    def test_bot_sentinel(self):
+        from repoze.browserid.middleware import UserAgentClassifier
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   bot_classifier=UserAgentClassifier(),
+                                   bot_browser_id='bot')
+        environ = {}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], 'bot')
+        self.assertEqual(self.headers, [])
+
+    def test_bot_lazy(self):
+        from repoze.browserid.middleware import UserAgentClassifier
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True,
+                                   bot_classifier=UserAgentClassifier(),
+                                   bot_browser_id='bot')
+        environ = {'HTTP_USER_AGENT':'curl/8.4.0'}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'](), 'bot')
+        self.assertEqual(self.headers, [])
+
+    def test_mint_limiter(self):
+        from repoze.browserid.middleware import Metrics
+        from repoze.browserid.middleware import RateLimiter
+        metrics = Metrics()
+        limiter = RateLimiter(1, 2, time=lambda: 0)
+        ids = iter(range(10))
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics,
+                                   id_generator=lambda when: str(next(ids)),
+                                   mint_limiter=limiter, bot_browser_id='bot')
+        for i in range(2):
+            environ = {'REMOTE_ADDR':'10.0.0.1'}
+            middleware(environ, self._start_response)
+            self.assertEqual(environ['repoze.browserid'], str(i))
+            self.assertEqual(len(self.headers), 1)
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], 'bot')
+        self.assertEqual(self.headers, [])
+        # other clients, and browsers holding a valid cookie, are served
+        environ = {'REMOTE_ADDR':'10.0.0.2'}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], '2')
+        environ = {'REMOTE_ADDR':'10.0.0.1',
+                   'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['throttled'], 1)
+        self.assertEqual(counters['minted'], 3)
+
+    def test_rejected_cache(self):
+        from repoze.browserid.middleware import Metrics
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics,
+                                   id_generator=lambda when: 'new',
+                                   rejected_cache_size=10,
+                                   vary=('REMOTE_ADDR',))
+        def fail(*arg):
+            raise AssertionError('cookie value checked')
+        tampered = 'thecookiename=%s!%s' % (_DEFAULT_BID, 'f' * 32)
+        environ = {'REMOTE_ADDR':'10.0.0.1', 'HTTP_COOKIE':tampered}
+        middleware(environ, self._start_response)
+        self.assertEqual(len(middleware.rejected_cache), 1)
+        # the legacy vary check is the last step of a failing check
+        middleware._check_legacy_vary = fail
+        for i in range(2):
+            environ = {'REMOTE_ADDR':'10.0.0.1', 'HTTP_COOKIE':tampered}
+            middleware(environ, self._start_response)
+            self.assertEqual(environ['repoze.browserid'], 'new')
+            self.assertEqual(len(self.headers), 1)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['tampered'], 3)
+        self.assertEqual(counters['rejected_cached'], 2)
+        # the verdict only holds for the vary values it was reached with
+        environ = {'REMOTE_ADDR':'10.0.0.2', 'HTTP_COOKIE':tampered}
+        self.assertRaises(AssertionError, middleware, environ,
+                          self._start_response)
+
+    def test_rejected_cache_ttl(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   id_generator=lambda when: 'new',
+                                   rejected_cache_size=10,
+                                   rejected_cache_ttl=30)
+        cache = middleware.rejected_cache
+        now = [0]
+        cache.time = lambda: now[0]
+        tampered = 'thecookiename=%s!%s' % (_DEFAULT_BID, 'f' * 32)
+        middleware({'HTTP_COOKIE':tampered}, self._start_response)
+        middleware({'HTTP_COOKIE':tampered}, self._start_response)
+        self.assertEqual(cache.hits, 1)
+        now[0] = 30
+        middleware({'HTTP_COOKIE':tampered}, self._start_response)
+        self.assertEqual(cache.hits, 1)
+        # valid cookies are never remembered as rejected
+        environ = {'HTTP_COOKIE':'thecookiename=%s' % _DEFAULT_COOKIE}
+        middleware(environ, self._start_response)
+        self.assertEqual(self.headers, [])
+        self.assertEqual(len(cache), 1)
+
+    def test_bot_lazy_classified_once(self):
+        from repoze.browserid.middleware import Metrics
+        from repoze.browserid.middleware import UserAgentClassifier
+        metrics = Metrics()
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True,
+                                   bot_classifier=UserAgentClassifier(),
+                                   metrics=metrics)
+        environ = {'HTTP_USER_AGENT':'curl/8.4.0'}
+        middleware(environ, self._start_response)
+        lazy = environ['repoze.browserid']
+        for i in range(5):
+            self.assertEqual(lazy(), None)
+        self.assertEqual(str(lazy), '')
+        self.assertEqual(metrics.snapshot()['counters']['bots'], 1)
+
+    def test_mint_limiter_lazy(self):
+        from repoze.browserid.middleware import Metrics
+        from repoze.browserid.middleware import RateLimiter
+        metrics = Metrics()
+        limiter = RateLimiter(1, 2, time=lambda: 0)
+        ids = iter(range(10))
+        middleware = self._makeOne('secret', 'thecookiename', metrics=metrics,
+                                   id_generator=lambda when: str(next(ids)),
+                                   mint_limiter=limiter, lazy=True)
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        middleware(environ, self._start_response)
+        environ['repoze.browserid']()
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        middleware(environ, self._start_response)
+        lazy = environ['repoze.browserid']
+        for i in range(3):
+            self.assertEqual(lazy(), '1')
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        middleware(environ, self._start_response)
+        lazy = environ['repoze.browserid']
+        for i in range(3):
+            self.assertEqual(lazy(), None)
+        self.assertEqual(str(lazy), '')
+        self.assertEqual(len(self.headers), 0)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['throttled'], 1)
+        self.assertEqual(counters['minted'], 2)
+
+    def test_events(self):
+        from repoze.browserid.events import EventQueue
+        events = EventQueue(DummySink())
+        events._start = lambda: None
+        middleware = self._makeOne('secret', 'thecookiename', events=events,
+                                   vary=('REMOTE_ADDR',))
+        middleware({'REMOTE_ADDR':'127.0.0.1'}, self._start_response)
+        cookie = self.headers[0][1].split(';')[0]
+        middleware({'REMOTE_ADDR':'127.0.0.1', 'HTTP_COOKIE':cookie},
+                   self._start_response)
+        events.flush()
+        self.assertEqual(events.sink.batches,
+                         [[{'browser_id':_DEFAULT_BID, 'time':0, 'pid':1,
+                            'vary':{'REMOTE_ADDR':'127.0.0.1'}}]])
+
+class TestForkSafety(unittest.TestCase):
+    def tearDown(self):
+        import repoze.browserid.middleware
+        repoze.browserid.middleware._after_fork()
+
+    def _mintInChildren(self, mint, workers=4, count=20000):
+        import os
+        readers = []
+        for x in range(workers):
+            read_fd, write_fd = os.pipe()
+            pid = os.fork()
+            if pid == 0: # pragma: no cover (child)
+                try:
+                    os.close(read_fd)
+                    pipe = os.fdopen(write_fd, 'w')
+                    pipe.write('\n'.join([ mint(x) for x in range(count) ]))
+                    pipe.close()
+                finally:
+                    os._exit(0)
+            os.close(write_fd)
+            readers.append((pid, read_fd))
+        results = []
+        for pid, read_fd in readers:
+            pipe = os.fdopen(read_fd)
+            results.extend(pipe.read().split('\n'))
+            pipe.close()
+            os.waitpid(pid, 0)
+        return results
+
+    def test_after_fork_resets_globals(self):
+        import repoze.browserid._util as util
+        import repoze.browserid.middleware as module
+        module._RANDS[:] = [1, 2]
+        module._CURRENT_PERIOD = 10
+        lock = module._LOCK
+        util._PID = -1
+        module._after_fork()
+        self.assertEqual(module._RANDS, [])
+        self.assertEqual(module._CURRENT_PERIOD, None)
+        self.assertFalse(module._LOCK is lock)
+        self.assertEqual(util._PID, util._getpid())
+
+    def test_after_fork_notifies_middleware(self):
+        import repoze.browserid.middleware as module
+        middleware = module.BrowserIdMiddleware(None, 'secret', 'bid')
+        middleware.pid = -1
+        module._after_fork()
+        self.assertEqual(middleware.pid, module._getpid())
+
+    def test_after_fork_notifies_counter_generator(self):
+        import repoze.browserid.middleware as module
+        generator = module.CounterIdGenerator()
+        prefix = generator.prefix
+        before = generator(0)
+        module._after_fork()
+        self.assertNotEqual(generator.prefix, prefix)
+        self.assertNotEqual(generator(0), before)
+
+    def test_check_fork_detects_pid_change(self):
+        import os
+        import repoze.browserid._util as util
+        import repoze.browserid.middleware as module
+        if hasattr(os, 'register_at_fork'):
+            return # forks are reported by the platform
+        middleware = module.BrowserIdMiddleware(None, 'secret', 'bid')
+        middleware.pid = -1
+        util._PID = -1
+        module._check_fork()
+        self.assertEqual(util._PID, module._getpid())
+        self.assertEqual(middleware.pid, module._getpid())
+
+    def test_check_fork_before_registry_access(self):
+        import os
+        import repoze.browserid._util as util
+        import repoze.browserid.middleware as module
+        if hasattr(os, 'register_at_fork'):
+            return # forks are reported by the platform
+        from repoze.browserid.registry import ConnectionPool
+        from repoze.browserid.registry import MemoryRegistry
+        pool = ConnectionPool(DummyConnection)
+        connection = pool.acquire()
+        pool.release(connection)
+        registry = MemoryRegistry()
+        registry.is_revoked = lambda browser_id: connection in pool._idle
+        middleware = module.BrowserIdMiddleware(DummyApp(), 'secret', 'bid',
+                                                registry=registry)
+        environ = {'HTTP_COOKIE': 'bid=%s' % middleware.to_cookieval(
+            {}, _DEFAULT_BID)}
+        util._PID = -1
+        middleware(environ, lambda *arg: None)
+        # the parent's pooled connection was forgotten first
+        self.assertEqual(environ['repoze.browserid'], _DEFAULT_BID)
+
+    def test_connection_pool_checks_fork(self):
+        import os
+        import repoze.browserid._util as util
+        import repoze.browserid.middleware as module
+        if hasattr(os, 'register_at_fork'):
+            return # forks are reported by the platform
+        from repoze.browserid.registry import ConnectionPool
+        pool = ConnectionPool(DummyConnection)
+        connection = pool.acquire()
+        pool.release(connection)
+        util._PID = -1
+        self.assertFalse(pool.acquire() is connection)
+
+    def test_legacy_ids_unique_across_forked_workers(self):
+        import os
+        if not hasattr(os, 'fork'):
+            return
+        from repoze.browserid.middleware import BrowserIdMiddleware
+        middleware = BrowserIdMiddleware(None, 'secret', 'bid')
+        middleware.time = lambda: 1000.0
+        mint = lambda x: middleware.new(middleware.time())
+        ids = self._mintInChildren(mint, count=5000)
+        self.assertEqual(len(ids), 20000)
+        self.assertEqual(len(set(ids)), 20000)
+
+    def test_pooled_ids_not_shared_with_forked_workers(self):
+        import os
+        if not hasattr(os, 'fork'):
+            return
+        from repoze.browserid.middleware import BrowserIdMiddleware
+        from repoze.browserid.middleware import RandomIdGenerator
+        middleware = BrowserIdMiddleware(None, 'secret', 'bid',
+                                         id_generator=RandomIdGenerator(),
+                                         pool_high_watermark=10)
+        middleware.id_pool.refill()
+        pooled = set([ browser_id for browser_id, cookie_value
+                       in middleware.id_pool._entries ])
+        mint = lambda x: middleware._mint_set_cookie({})[0]
+        ids = self._mintInChildren(mint, count=10)
+        self.assertEqual(len(set(ids)), 40)
+        self.assertEqual(pooled & set(ids), set())
+
+    def test_counter_ids_unique_across_forked_workers(self):
+        import os
+        if not hasattr(os, 'fork'):
+            return
+        from repoze.browserid.middleware import CounterIdGenerator
+        generator = CounterIdGenerator()
+        generator(0) # prime the parent's thread-local counter
+        ids = self._mintInChildren(generator)
+        self.assertEqual(len(ids), 80000)
+        self.assertEqual(len(set(ids)), 80000)
+
+class _Awaitable(object):
+    """ Awaiting it calls ``func`` and then awaits what that returns,
+    if anything; lets the ASGI tests drive coroutines without ``async``
+    syntax, which Python 2 can't compile. """
+    def __init__(self, func, *arg):
+        self.func = func
+        self.arg = arg
+
+    def __await__(self):
+        result = self.func(*self.arg)
+        if result is not None:
+            for x in result.__await__():
+                yield x
+
+def _drive(awaitable):
+    """ Run an awaitable which never suspends and return its result. """
+    try:
+        awaitable.__await__().send(None)
+    except StopIteration as e:
+        return e.value
+    raise AssertionError('suspended')
+
+_NO_ASGI = sys.version_info < (3, 5)
+
+@unittest.skipIf(_NO_ASGI, 'repoze.browserid.asgi requires Python 3.5')
+class TestBrowserIdASGIMiddleware(unittest.TestCase):
+    def tearDown(self):
+        import repoze.browserid.middleware
+        repoze.browserid.middleware._RANDS[:] = []
+        repoze.browserid.middleware._CURRENT_PERIOD = None
+
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.asgi import BrowserIdASGIMiddleware
+        self.scopes = []
+        self.messages = []
+        def app(scope, receive, send):
+            self.scopes.append(scope)
+            def respond():
+                _drive(send({'type':'http.response.start', 'status':200,
+                             'headers':[(b'content-type', b'text/plain')]}))
+                _drive(send({'type':'http.response.body', 'body':b'body'}))
+            return _Awaitable(respond)
+        mw = BrowserIdASGIMiddleware(app, *arg, **kw)
+        mw.randint = lambda *arg: 0
+        mw.time = lambda *arg: 0
+        mw.pid = 1
+        return mw
+
+    def _send(self, message):
+        return _Awaitable(self.messages.append, message)
+
+    def _call(self, middleware, scope):
+        return _drive(middleware(scope, None, self._send))
+
+    def _scope(self, headers=()):
+        return {'type':'http', 'method':'GET', 'path':'/',
+                'query_string':b'', 'client':('127.0.0.1', 5000),
+                'headers':list(headers)}
+
+    def test_nocookie(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        scope = self._scope()
+        self._call(middleware, scope)
+        self.assertEqual(self.scopes[0]['repoze.browserid'], _DEFAULT_BID)
+        self.assertFalse('repoze.browserid' in scope)
+        start, body = self.messages
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(start['headers'][0], (b'content-type', b'text/plain'))
+        self.assertEqual(start['headers'][1],
+                         (b'set-cookie',
+                          b'thecookiename=' + _DEFAULT_COOKIE.encode('ascii')
+                          + b'; Path=/; '))
+        self.assertEqual(body, {'type':'http.response.body', 'body':b'body'})
+
+    def test_withcookie_untampered(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        cookie = b'a=1; thecookiename=' + _DEFAULT_COOKIE.encode('ascii')
+        scope = self._scope([(b'cookie', cookie)])
+        self._call(middleware, scope)
+        self.assertEqual(self.scopes[0]['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(self.messages[0]['headers'],
+                         [(b'content-type', b'text/plain')])
+
+    def test_withcookie_split_across_headers(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        cookie = b'thecookiename=' + _DEFAULT_COOKIE.encode('ascii')
+        scope = self._scope([(b'cookie', b'a=1'), (b'cookie', cookie)])
+        self._call(middleware, scope)
+        self.assertEqual(self.messages[0]['headers'],
+                         [(b'content-type', b'text/plain')])
+
+    def test_withcookie_tampered(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        cookie = b'thecookiename=' + _BAD_COOKIE.encode('ascii')
+        self._call(middleware, self._scope([(b'cookie', cookie)]))
+        self.assertEqual(len(self.messages[0]['headers']), 2)
+
+    def test_vary(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   vary=('REMOTE_ADDR', 'HTTP_USER_AGENT'))
+        h = _hmac('secret127.0.0.1Fluzbox', _DEFAULT_BID).hexdigest()
+        cookie = 'thecookiename=%s!%s' % (_DEFAULT_BID, h)
+        scope = self._scope([(b'cookie', cookie.encode('ascii')),
+                             (b'user-agent', b'Fluzbox')])
+        self._call(middleware, scope)
+        self.assertEqual(self.scopes[0]['repoze.browserid'], _DEFAULT_BID)
+        # a cookie signed by earlier versions is re-signed
+        self.assertEqual(len(self.messages[0]['headers']), 2)
+        set_cookie = self.messages[0]['headers'][1][1].decode('ascii')
+        cookie = set_cookie.split(';')[0].encode('ascii')
+        scope = self._scope([(b'cookie', cookie),
+                             (b'user-agent', b'Fluzbox')])
+        self._call(middleware, scope)
+        self.assertEqual(self.scopes[1]['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(len(self.messages[2]['headers']), 1)
+
+    def test_lazy_untouched(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        self._call(middleware, self._scope())
+        self.assertEqual(self.messages[0]['headers'],
+                         [(b'content-type', b'text/plain')])
+        self.assertEqual(self.scopes[0]['repoze.browserid'].browser_id, None)
+
+    def test_lazy_touched(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        app = middleware.app
+        def touching_app(scope, receive, send):
+            scope['repoze.browserid']()
+            return app(scope, receive, send)
+        middleware.app = touching_app
+        self._call(middleware, self._scope())
+        self.assertEqual(self.scopes[0]['repoze.browserid'](), _DEFAULT_BID)
+        self.assertEqual(self.messages[0]['headers'][1][0], b'set-cookie')
+
+    def test_lazy_withcookie(self):
+        middleware = self._makeOne('secret', 'thecookiename', lazy=True)
+        cookie = b'thecookiename=' + _DEFAULT_COOKIE.encode('ascii')
+        self._call(middleware, self._scope([(b'cookie', cookie)]))
+        self.assertEqual(self.scopes[0]['repoze.browserid'](), _DEFAULT_BID)
+        self.assertEqual(len(self.messages[0]['headers']), 1)
+
+    def test_lazy_resigns_old_key(self):
+        middleware = self._makeOne('new', 'thecookiename', lazy=True,
+                                   key_id='k2', old_keys={'':'secret'})
+        cookie = b'thecookiename=' + _DEFAULT_COOKIE.encode('ascii')
+        self._call(middleware, self._scope([(b'cookie', cookie)]))
+        self.assertEqual(self.scopes[0]['repoze.browserid'](), _DEFAULT_BID)
+        self.assertEqual(self.messages[0]['headers'][1][0], b'set-cookie')
+
+    def test_excluded(self):
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   exclude_paths=('/healthz',))
+        scope = self._scope()
+        scope['path'] = '/healthz'
+        self._call(middleware, scope)
+        self.assertTrue(self.scopes[0] is scope)
+        self.assertEqual(len(self.messages[0]['headers']), 1)
+
+    def test_metrics_path(self):
+        import json
+        middleware = self._makeOne('secret', 'thecookiename',
+                                   metrics_path='/_metrics')
+        self._call(middleware, self._scope())
+        scope = self._scope()
+        scope['path'] = '/_metrics'
+        self._call(middleware, scope)
+        self.assertEqual(len(self.scopes), 1)
+        start, body = self.messages[2:]
+        self.assertEqual(start['status'], 200)
+        self.assertEqual(start['headers'][0],
+                         (b'content-type', b'application/json'))
+        self.assertEqual(start['headers'][1],
+                         (b'content-length', str(len(body['body'])).encode()))
+        body = json.loads(body['body'].decode('utf-8'))
+        self.assertEqual(body['counters']['minted'], 1)
+
+    def test_under_asyncio(self):
+        import asyncio
+        middleware = self._makeOne('secret', 'thecookiename')
+        # servers pick ASGI 3 by checking for a coroutine function
+        self.assertTrue(asyncio.iscoroutinefunction(middleware.__call__))
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(
+                middleware(self._scope(), None, self._send))
+        finally:
+            loop.close()
+        self.assertEqual(self.scopes[0]['repoze.browserid'], _DEFAULT_BID)
+        self.assertEqual(self.messages[0]['headers'][1][0], b'set-cookie')
+
+    def test_not_http(self):
+        middleware = self._makeOne('secret', 'thecookiename')
+        scope = {'type':'lifespan'}
+        self._call(middleware, scope)
+        self.assertTrue(self.scopes[0] is scope)
+
+@unittest.skipIf(_NO_ASGI, 'repoze.browserid.asgi requires Python 3.5')
+class TestScopeToEnviron(unittest.TestCase):
+    def _callFUT(self, scope):
+        from repoze.browserid.asgi import scope_to_environ
+        return scope_to_environ(scope)
+
+    def test_it(self):
+        environ = self._callFUT({
+            'type':'http', 'method':'POST', 'path':'/a',
+            'query_string':b'b=1', 'client':('10.0.0.1', 80),
+            'headers':[(b'user-agent', b'Fluzbox'),
+                       (b'accept', b'text/html'), (b'accept', b'*/*')]})
+        self.assertEqual(environ, {'REQUEST_METHOD':'POST',
+                                   'PATH_INFO':'/a',
+                                   'QUERY_STRING':'b=1',
+                                   'REMOTE_ADDR':'10.0.0.1',
+                                   'HTTP_USER_AGENT':'Fluzbox',
+                                   'HTTP_ACCEPT':'text/html,*/*'})
+
+    def test_minimal(self):
+        environ = self._callFUT({'type':'http'})
+        self.assertEqual(environ, {'REQUEST_METHOD':'GET', 'PATH_INFO':'',
+                                   'QUERY_STRING':''})
+
+class TestRandomIdGenerator(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import RandomIdGenerator
+        return RandomIdGenerator(*arg, **kw)
+
+    def test_call(self):
+        generator = self._makeOne(urandom=lambda n: b'\x01' * n)
+        self.assertEqual(generator(0), '01' * 20)
+
+    def test_unique(self):
+        generator = self._makeOne()
+        ids = set([ generator(0) for x in range(1000) ])
+        self.assertEqual(len(ids), 1000)
+        for browser_id in ids:
+            self.assertEqual(len(browser_id), 40)
+
+class TestCounterIdGenerator(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import CounterIdGenerator
+        return CounterIdGenerator(*arg, **kw)
+
+    def test_call(self):
+        generator = self._makeOne(urandom=lambda n: b'\x01' * n)
+        prefix = '01' * 16
+        self.assertEqual(generator(0), _sha(prefix + ':0:0').hexdigest())
+        self.assertEqual(generator(0), _sha(prefix + ':0:1').hexdigest())
+
+    def test_unique_across_threads(self):
+        import threading
+        generator = self._makeOne()
+        results = []
+        def mint():
+            results.extend([ generator(0) for x in range(500) ])
+        threads = [ threading.Thread(target=mint) for x in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 2000)
+        self.assertEqual(len(set(results)), 2000)
+
+    def test_distinct_instances_distinct_ids(self):
+        self.assertNotEqual(self._makeOne()(0), self._makeOne()(0))
+
+class TestCompactIdGenerator(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import CompactIdGenerator
+        return CompactIdGenerator(*arg, **kw)
+
+    def test_call(self):
+        generator = self._makeOne(urandom=lambda n: b'\xff' * n)
+        self.assertEqual(generator(0), '_' * 21 + 'w')
+
+    def test_time_ordered(self):
+        generator = self._makeOne(time_ordered=True,
+                                  urandom=lambda n: b'\x00' * n)
+        browser_id = generator(1.5)
+        self.assertEqual(browser_id, '------MR' + '-' * 14)
+
+    def test_time_ordered_sorts(self):
+        generator = self._makeOne(time_ordered=True)
+        ids = [ generator(when) for when in (1.0, 2.0, 3.5, 1000.0, 1e9) ]
+        self.assertEqual(sorted(ids), ids)
+
+    def test_unique(self):
+        generator = self._makeOne()
+        ids = set([ generator(0) for x in range(1000) ])
+        self.assertEqual(len(ids), 1000)
+        for browser_id in ids:
+            self.assertEqual(len(browser_id), 22)
+            self.assertFalse('!' in browser_id)
+
+    def test_roundtrip_through_middleware(self):
+        from repoze.browserid.middleware import BrowserIdMiddleware
+        for encoding in ('hex', 'base64'):
+            middleware = BrowserIdMiddleware(None, 'secret', 'bid',
+                                             id_generator=self._makeOne(),
+                                             cookie_encoding=encoding)
+            browser_id = middleware.new(0)
+            cookie_val = middleware.to_cookieval({}, browser_id)
+            self.assertTrue(cookie_val.startswith(browser_id + '!'))
+            self.assertEqual(middleware.from_cookieval({}, cookie_val),
+                             browser_id)
+            # legacy ids are still accepted
+            self.assertEqual(middleware.from_cookieval({}, _DEFAULT_COOKIE),
+                             _DEFAULT_BID)
+
+class TestMetrics(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import Metrics
+        return Metrics(*arg, **kw)
+
+    def test_snapshot_empty(self):
+        metrics = self._makeOne()
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot, {'counters':dict.fromkeys(
+            metrics.counter_names, 0)})
+
+    def test_incr(self):
+        metrics = self._makeOne()
+        metrics.incr('minted')
+        metrics.incr('lock_wait_us', 25)
+        counters = metrics.snapshot()['counters']
+        self.assertEqual(counters['minted'], 1)
+        self.assertEqual(counters['lock_wait_us'], 25)
+
+    def test_incr_aggregates_threads(self):
+        import threading
+        metrics = self._makeOne()
+        def work():
+            for x in range(1000):
+                metrics.incr('verified')
+        threads = [ threading.Thread(target=work) for x in range(4) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(metrics._shards), 4)
+        self.assertEqual(metrics.snapshot()['counters']['verified'], 4000)
+
+    def test_dead_threads_retired(self):
+        import threading
+        metrics = self._makeOne(timings=True, timer=lambda: 0)
+        def work():
+            metrics.incr('minted')
+            metrics.stop('mint', 0)
+        for x in range(100):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        self.assertTrue(len(metrics._shards) <= 16)
+        snapshot = metrics.snapshot()
+        self.assertEqual(len(metrics._shards), 0)
+        self.assertEqual(snapshot['counters']['minted'], 100)
+        self.assertEqual(snapshot['histograms']['mint'][0], 100)
+        # the live thread's shard is kept
+        metrics.incr('minted')
+        self.assertEqual(metrics.snapshot()['counters']['minted'], 101)
+        self.assertEqual(len(metrics._shards), 1)
+
+    def test_after_fork(self):
+        import repoze.browserid.middleware
+        metrics = self._makeOne()
+        metrics.incr('minted')
+        metrics._shards_lock.acquire() # held by another thread at fork
+        repoze.browserid.middleware._after_fork()
+        self.assertEqual(metrics.snapshot()['counters']['minted'], 0)
+        metrics.incr('minted')
+        self.assertEqual(metrics.snapshot()['counters']['minted'], 1)
+
+    def test_start_without_timings(self):
+        metrics = self._makeOne(timer=lambda: self.fail('timed'))
+        started = metrics.start()
+        self.assertEqual(started, None)
+        metrics.stop('verify', started)
+        self.assertFalse('histograms' in metrics.snapshot())
+
+    def test_stop_buckets(self):
+        now = [0]
+        metrics = self._makeOne(timings=True, timer=lambda: now[0])
+        for elapsed in (0, 0.0000005, 0.000001, 0.000003, 0.000004, 1e6):
+            now[0] = elapsed
+            metrics.stop('mint', 0)
+        buckets = metrics.snapshot()['histograms']['mint']
+        self.assertEqual(buckets[:4], [2, 1, 1, 1])
+        self.assertEqual(buckets[31], 1)
+
+class TestUserAgentClassifier(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import UserAgentClassifier
+        return UserAgentClassifier(*arg, **kw)
+
+    def test_default_patterns(self):
+        classifier = self._makeOne()
+        for user_agent in (
+            'Mozilla/5.0 (compatible; Googlebot/2.1; '
+            '+http://www.google.com/bot.html)',
+            'Mozilla/5.0 (compatible; bingbot/2.0; '
+            '+http://www.bing.com/bingbot.htm)',
+            'Mozilla/5.0 AppleWebKit/537.36 (KHTML, like Gecko; compatible; '
+            'Bytespider; spider-feedback@bytedance.com)',
+            'facebookexternalhit/1.1',
+            'curl/8.4.0',
+            'python-requests/2.31.0',
+            'Go-http-client/1.1',
+            'kube-probe/1.28',
+            'Pingdom.com_bot_version_1.4_(http://www.pingdom.com/)',
+            'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 '
+            '(KHTML, like Gecko) HeadlessChrome/120.0.0.0 Safari/537.36',
+            '',
+            ):
+            self.assertTrue(classifier.is_bot(user_agent), user_agent)
+        for user_agent in (
+            'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+            '(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36',
+            'Mozilla/5.0 (iPhone; CPU iPhone OS 17_1 like Mac OS X) '
+            'AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.1 '
+            'Mobile/15E148 Safari/604.1',
+            'Mozilla/5.0 (Linux; Android 10; CUBOT X30) AppleWebKit/537.36 '
+            '(KHTML, like Gecko) Chrome/119.0.0.0 Mobile Safari/537.36',
+            'Mozilla/5.0 (Macintosh; Intel Mac OS X 10.15; rv:121.0) '
+            'Gecko/20100101 Firefox/121.0',
+            ):
+            self.assertFalse(classifier.is_bot(user_agent), user_agent)
+
+    def test_custom_patterns(self):
+        classifier = self._makeOne([r'^internal-agent/', 'probe'])
+        self.assertTrue(classifier.is_bot('Internal-Agent/1.0'))
+        self.assertTrue(classifier.is_bot('Mozilla/5.0 (probe)'))
+        self.assertFalse(classifier.is_bot('Googlebot/2.1 internal-agent/'))
+        self.assertFalse(self._makeOne(()).is_bot('Googlebot/2.1'))
+
+    def test_cache(self):
+        classifier = self._makeOne()
+        self.assertFalse(classifier.is_bot('Mozilla/5.0'))
+        self.assertTrue(classifier.is_bot('Googlebot/2.1'))
+        self.assertEqual(len(classifier.cache), 2)
+        classifier.cache.set('Mozilla/5.0', True)
+        self.assertTrue(classifier.is_bot('Mozilla/5.0'))
+
+    def test_no_cache(self):
+        classifier = self._makeOne(cache_size=0)
+        self.assertEqual(classifier.cache, None)
+        self.assertTrue(classifier.is_bot('Googlebot/2.1'))
+
+class TestRequestMatcher(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import RequestMatcher
+        return RequestMatcher(*arg, **kw)
+
+    def _excluded(self, matcher, path='/', method='GET', user_agent=None):
+        environ = {'PATH_INFO':path, 'REQUEST_METHOD':method}
+        if user_agent is not None:
+            environ['HTTP_USER_AGENT'] = user_agent
+        return matcher.excluded(environ)
+
+    def test_empty(self):
+        matcher = self._makeOne()
+        self.assertEqual(matcher.exclude_paths, None)
+        self.assertFalse(self._excluded(matcher))
+        self.assertFalse(matcher.excluded({}))
+
+    def test_prefixes(self):
+        matcher = self._makeOne(exclude_paths=('/static/', '/healthz'))
+        self.assertTrue(self._excluded(matcher, '/static/a/b.css'))
+        self.assertTrue(self._excluded(matcher, '/healthz'))
+        self.assertTrue(self._excluded(matcher, '/healthz/deep'))
+        self.assertFalse(self._excluded(matcher, '/stat'))
+        self.assertFalse(self._excluded(matcher, '/app/static/'))
+
+    def test_prefix_is_literal(self):
+        matcher = self._makeOne(exclude_paths=('/a.b+c',))
+        self.assertTrue(self._excluded(matcher, '/a.b+c/d'))
+        self.assertFalse(self._excluded(matcher, '/axbbc'))
+
+    def test_globs(self):
+        matcher = self._makeOne(exclude_paths=('*.png', '/img/?.gif',
+                                               '/v[0-9]/*', '/x[!a]'))
+        self.assertTrue(self._excluded(matcher, '/a/b.png'))
+        self.assertFalse(self._excluded(matcher, '/a/b.png/c'))
+        self.assertTrue(self._excluded(matcher, '/img/a.gif'))
+        self.assertFalse(self._excluded(matcher, '/img/ab.gif'))
+        self.assertTrue(self._excluded(matcher, '/v1/foo'))
+        self.assertFalse(self._excluded(matcher, '/va/foo'))
+        self.assertTrue(self._excluded(matcher, '/xb'))
+        self.assertFalse(self._excluded(matcher, '/xa'))
+
+    def test_unterminated_bracket(self):
+        matcher = self._makeOne(exclude_paths=('/a[*',))
+        self.assertTrue(self._excluded(matcher, '/a[bc'))
+        self.assertFalse(self._excluded(matcher, '/abc'))
+
+    def test_include_overrides_exclude(self):
+        matcher = self._makeOne(exclude_paths=('/static/',),
+                                include_paths=('/static/dynamic/',))
+        self.assertTrue(self._excluded(matcher, '/static/a.css'))
+        self.assertFalse(self._excluded(matcher, '/static/dynamic/a'))
+
+    def test_methods(self):
+        matcher = self._makeOne(exclude_methods=('head', 'OPTIONS'))
+        self.assertTrue(self._excluded(matcher, method='HEAD'))
+        self.assertTrue(self._excluded(matcher, method='OPTIONS'))
+        self.assertFalse(self._excluded(matcher, method='GET'))
+
+    def test_user_agents(self):
+        matcher = self._makeOne(exclude_user_agents=('kube-probe/*',
+                                                     'Pingdom'))
+        self.assertTrue(self._excluded(matcher, user_agent='kube-probe/1.2'))
+        self.assertTrue(self._excluded(matcher, user_agent='Pingdom'))
+        self.assertFalse(self._excluded(matcher, user_agent='Pingdom.com_bot'))
+        self.assertFalse(self._excluded(matcher, user_agent='Mozilla/5.0'))
+        self.assertFalse(self._excluded(matcher))
+
+class TestLRUCache(unittest.TestCase):
+    def _makeOne(self, *arg, **kw):
+        from repoze.browserid.middleware import LRUCache
+        return LRUCache(*arg, **kw)
+
+    def test_get_miss(self):
+        cache = self._makeOne(10)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        self.assertEqual(cache.misses, 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_set_get(self):
+        cache = self._makeOne(10)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(cache), 1)
+
+    def test_bounded(self):
+        cache = self._makeOne(10)
+        for x in range(100):
+            cache.set(x, x)
+            self.assertTrue(len(cache) <= 10)
+        self.assertEqual(cache.get(99), 99)
+        self.assertEqual(cache.get(0), None)
+
+    def test_recently_used_survives(self):
+        cache = self._makeOne(4)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        # 'a' and 'b' are now the old generation
+        self.assertEqual(cache.get('a'), 1)
+        cache.set('c', 3)
+        # 'a' was promoted; 'b' was dropped along with the old generation
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_ttl(self):
+        now = [0]
+        cache = self._makeOne(10, ttl=5, time=lambda: now[0])
+        cache.set('a', 1)
+        now[0] = 4
+        self.assertEqual(cache.get('a'), 1)
+        now[0] = 5
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(len(cache), 0)
+
+    def test_clear(self):
+        cache = self._makeOne(10)
+        cache.set('a', 1)
+        cache.clear()
+        self.assertEqual(cache.get('a'), None)
+
+class TestRateLimiter(unittest.TestCase):
+    def _makeOne(self, rate=1, burst=2, **kw):
+        from repoze.browserid.middleware import RateLimiter
+        self.now = 0
+        return RateLimiter(rate, burst, time=lambda: self.now, **kw)
+
+    def test_burst(self):
+        limiter = self._makeOne(burst=3)
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        self.assertEqual([ limiter.allow(environ) for i in range(4) ],
+                         [True, True, True, False])
+        self.assertTrue(limiter.allow({'REMOTE_ADDR':'10.0.0.2'}))
+        self.assertEqual(len(limiter), 2)
+
+    def test_refill(self):
+        limiter = self._makeOne(rate=0.5)
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        limiter.allow(environ)
+        limiter.allow(environ)
+        self.assertFalse(limiter.allow(environ))
+        self.now = 1
+        self.assertFalse(limiter.allow(environ))
+        self.now = 2
+        self.assertTrue(limiter.allow(environ))
+        self.assertFalse(limiter.allow(environ))
+        # an idle client regains no more than burst tokens
+        self.now = 100
+        self.assertTrue(limiter.allow(environ))
+        self.assertTrue(limiter.allow(environ))
+        self.assertFalse(limiter.allow(environ))
+
+    def test_key_names(self):
+        limiter = self._makeOne(burst=1,
+                                key_names=('REMOTE_ADDR', 'HTTP_USER_AGENT'))
+        self.assertEqual(limiter.key({'REMOTE_ADDR':'10.0.0.1'}),
+                         ('10.0.0.1', ''))
+        self.assertTrue(limiter.allow({'REMOTE_ADDR':'10.0.0.1',
+                                       'HTTP_USER_AGENT':'a'}))
+        self.assertTrue(limiter.allow({'REMOTE_ADDR':'10.0.0.1',
+                                       'HTTP_USER_AGENT':'b'}))
+        self.assertFalse(limiter.allow({'REMOTE_ADDR':'10.0.0.1',
+                                        'HTTP_USER_AGENT':'a'}))
+
+    def test_bounded(self):
+        limiter = self._makeOne(shards=2, max_keys=20)
+        for x in range(100):
+            limiter.allow({'REMOTE_ADDR':str(x)})
+            self.assertTrue(len(limiter) <= 20)
+
+    def test_prune_keeps_active(self):
+        limiter = self._makeOne(rate=0.1, burst=2, shards=1, max_keys=4)
+        active = {'REMOTE_ADDR':'active'}
+        limiter.allow(active)
+        limiter.allow(active)
+        for x in range(3):
+            limiter.allow({'REMOTE_ADDR':str(x)})
+        self.now = 10
+        # the three idle buckets are full again and dropped; the active
+        # one, refilled by a single token, is kept
+        limiter.allow({'REMOTE_ADDR':'new'})
+        limiter.allow(active)
+        self.assertFalse(limiter.allow(active))
+        self.assertEqual(len(limiter), 2)
+
+    def test_after_fork(self):
+        limiter = self._makeOne(burst=1)
+        environ = {'REMOTE_ADDR':'10.0.0.1'}
+        limiter.allow(environ)
+        self.assertFalse(limiter.allow(environ))
+        limiter._after_fork()
+        self.assertTrue(limiter.allow(environ))
+
+class TestIdPool(unittest.TestCase):
+    def _makeOne(self, mint=None, low=2, high=4):
+        from repoze.browserid.middleware import IdPool
+        if mint is None:
+            import functools
+            import itertools
+            mint = functools.partial(next, itertools.count())
+        return IdPool(mint, low, high)
+
+    def test_refill(self):
+        pool = self._makeOne()
+        pool.refill()
+        self.assertEqual(list(pool._entries), [0, 1, 2, 3])
+
+    def test_get_drained(self):
+        pool = self._makeOne()
+        started = []
+        pool._start = lambda: started.append(True)
+        self.assertEqual(pool.get(), None)
+        self.assertEqual(pool.misses, 1)
+        self.assertEqual(started, [True])
+        self.assertTrue(pool._wakeup.is_set())
+
+    def test_get_above_low_watermark(self):
+        pool = self._makeOne()
+        pool._start = lambda: self.fail('started')
+        pool.refill()
+        self.assertEqual(pool.get(), 0)
+        self.assertEqual(pool.get(), 1)
+        self.assertEqual(pool.hits, 2)
+        self.assertFalse(pool._wakeup.is_set())
+
+    def test_background_refill(self):
+        import time
+        pool = self._makeOne(high=100)
+        self.assertEqual(pool.get(), None)
+        for x in range(200):
+            if len(pool) == 100:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(pool), 100)
+        self.assertEqual(pool.get(), 0)
+        thread = pool._thread
+        pool._start()
+        self.assertTrue(pool._thread is thread)
+
+    def test_after_fork_empties(self):
+        pool = self._makeOne()
+        pool.refill()
+        pool._thread = object()
+        pool._after_fork()
+        self.assertEqual(len(pool), 0)
+        self.assertEqual(pool._thread, None)
+
+class TestRegistry(unittest.TestCase):
+    def _makeOne(self, **kw):
+        from repoze.browserid.registry import MemoryRegistry
+        class FailingRegistry(MemoryRegistry):
+            failing = False
+            def _lookup(self, browser_id):
+                if self.failing:
+                    raise IOError('down')
+                return MemoryRegistry._lookup(self, browser_id)
+        return FailingRegistry(**kw)
+
+    def test_register_and_revoke(self):
+        from repoze.browserid.registry import LIVE, REVOKED
+        registry = self._makeOne()
+        self.assertEqual(registry.lookup('a'), None)
+        registry.register('a')
+        self.assertEqual(registry.lookup('a'), LIVE)
+        self.assertFalse(registry.is_revoked('a'))
+        registry.revoke('a')
+        self.assertEqual(registry.lookup('a'), REVOKED)
+        registry.register('a')
+        self.assertTrue(registry.is_revoked('a'))
+        self.assertFalse(registry.is_revoked('unknown'))
+
+    def test_live_bounded(self):
+        from repoze.browserid.registry import REVOKED
+        registry = self._makeOne(live_size=10)
+        registry.revoke('revoked')
+        for x in range(100):
+            registry.register(str(x))
+        self.assertTrue(len(registry._live) <= 10)
+        self.assertEqual(registry.lookup('revoked'), REVOKED)
+
+    def test_cache(self):
+        registry = self._makeOne(cache_size=10)
+        self.assertFalse(registry.is_revoked('a'))
+        registry._revoke('a') # as if revoked by another process
+        self.assertFalse(registry.is_revoked('a'))
+        self.assertEqual(registry.cache.hits, 1)
+        registry.revoke('b')
+        self.assertTrue(registry.is_revoked('b'))
+
+    def test_store_unavailable(self):
+        registry = self._makeOne(cache_size=10)
+        registry.failing = True
+        self.assertFalse(registry.is_revoked('a'))
+        self.assertEqual(len(registry.cache), 0)
+
+    def test_store_unavailable_not_retried_at_once(self):
+        registry = self._makeOne(retry_after=5)
+        now = [100]
+        registry.time = lambda: now[0]
+        registry.failing = True
+        self.assertFalse(registry.is_revoked('a'))
+        registry.failing = False
+        registry.revoke('b')
+        # the store isn't asked until retry_after seconds have passed
+        self.assertFalse(registry.is_revoked('b'))
+        now[0] = 105
+        self.assertTrue(registry.is_revoked('b'))
+
+    def test_pending_bounded(self):
+        from repoze.browserid.registry import Registry
+        registry = self._makeOne(max_pending=2)
+        registry._start = lambda: None
+        for browser_id in 'abc':
+            Registry.register(registry, browser_id)
+        self.assertEqual(registry._pending, ['a', 'b'])
+        self.assertEqual(registry.dropped, 1)
+
+    def test_batched_register(self):
+        from repoze.browserid.registry import Registry
+        registry = self._makeOne(batch_size=3)
+        started = []
+        registry._start = lambda: started.append(True)
+        for browser_id in 'abcd':
+            Registry.register(registry, browser_id)
+        self.assertEqual(started, [True, True])
+        self.assertEqual(registry.lookup('a'), None)
+        batches = []
+        registry._register = batches.append
+        registry.flush()
+        self.assertEqual(batches, [['a', 'b', 'c'], ['d']])
+        self.assertEqual(registry._pending, [])
+
+    def test_background_flush(self):
+        import time
+        from repoze.browserid.registry import Registry, LIVE
+        registry = self._makeOne(flush_interval=0.01)
+        Registry.register(registry, 'a')
+        for x in range(200):
+            if registry.lookup('a'):
+                break
+            time.sleep(0.01)
+        self.assertEqual(registry.lookup('a'), LIVE)
+
+    def test_after_fork_drops_pending(self):
+        from repoze.browserid.registry import Registry
+        registry = self._makeOne()
+        registry._start = lambda: None
+        Registry.register(registry, 'a')
+        registry._after_fork()
+        self.assertEqual(registry._pending, [])
+        self.assertEqual(registry._thread, None)
+
+class TestConnectionPool(unittest.TestCase):
+    def _makeOne(self, max_idle=1):
+        from repoze.browserid.registry import ConnectionPool
+        return ConnectionPool(DummyConnection, max_idle)
+
+    def test_reuse(self):
+        pool = self._makeOne()
+        first = pool.acquire()
+        pool.release(first)
+        self.assertTrue(pool.acquire() is first)
+
+    def test_max_idle(self):
+        pool = self._makeOne()
+        first = pool.acquire()
+        second = pool.acquire()
+        pool.release(first)
+        pool.release(second)
+        self.assertFalse(first.closed)
+        self.assertTrue(second.closed)
+        pool.close()
+        self.assertTrue(first.closed)
+
+    def test_discard(self):
+        pool = self._makeOne()
+        connection = pool.acquire()
+        pool.discard(connection)
+        self.assertTrue(connection.closed)
+        self.assertFalse(pool.acquire() is connection)
+
+    def test_after_fork_forgets_idle(self):
+        pool = self._makeOne()
+        connection = pool.acquire()
+        pool.release(connection)
+        pool._after_fork()
+        self.assertFalse(pool.acquire() is connection)
+        self.assertFalse(connection.closed)
+
+class TestSQLiteRegistry(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _makeOne(self, **kw):
+        import os
+        from repoze.browserid.registry import SQLiteRegistry
+        return SQLiteRegistry(os.path.join(self.tempdir, 'ids.db'), **kw)
+
+    def test_register_and_revoke(self):
+        from repoze.browserid.registry import LIVE, REVOKED
+        registry = self._makeOne()
+        registry._start = lambda: None
+        registry.register('a')
+        registry.register('b')
+        self.assertEqual(registry.lookup('a'), None)
+        registry.flush()
+        self.assertEqual(registry.lookup('a'), LIVE)
+        registry.revoke('b')
+        self.assertEqual(registry.lookup('b'), REVOKED)
+        # a second process sees the same database
+        other = self._makeOne(cache_size=0)
+        self.assertTrue(other.is_revoked('b'))
+        other._register(['b', 'c'])
+        self.assertEqual(other.lookup('b'), REVOKED)
+        self.assertEqual(registry.lookup('c'), LIVE)
+
+    def test_connections_pooled(self):
+        registry = self._makeOne(cache_size=0)
+        registry.is_revoked('a')
+        connection = registry.pool._idle[0]
+        registry.is_revoked('a')
+        self.assertEqual(registry.pool._idle, [connection])
+
+    def test_error(self):
+        from repoze.browserid.registry import RegistryError
+        registry = self._makeOne(cache_size=0, table='ids')
+        registry.table = 'missing'
+        self.assertRaises(RegistryError, registry.lookup, 'a')
+        self.assertFalse(registry.is_revoked('a'))
+        self.assertEqual(registry.pool._idle, [])
+
+    def test_timeouts(self):
+        registry = self._makeOne(cache_size=0, timeout=2.0,
+                                 lookup_timeout=0.05)
+        registry.is_revoked('a')
+        connection = registry.pool._idle[0]
+        busy_timeout = 'PRAGMA busy_timeout'
+        self.assertEqual(connection.execute(busy_timeout).fetchone()[0], 50)
+        writes = []
+        def execute(sql, params=()):
+            if sql.startswith('INSERT'):
+                writes.append(connection.execute(busy_timeout).fetchone()[0])
+            return connection.execute(sql, params)
+        registry.pool._idle[0] = DummySQLiteConnection(connection, execute)
+        registry._revoke('a')
+        self.assertEqual(writes, [2000])
+        self.assertEqual(connection.execute(busy_timeout).fetchone()[0], 50)
+
+class TestRESPRegistry(unittest.TestCase):
+    def setUp(self):
+        self.server = DummyRESPServer()
+        self.registries = []
+
+    def tearDown(self):
+        for registry in self.registries:
+            registry.pool.close()
+        self.server.shutdown()
+        self.server.close_connections()
+        self.server.server_close()
+
+    def _makeOne(self, **kw):
+        from repoze.browserid.registry import RESPRegistry
+        host, port = self.server.server_address
+        registry = RESPRegistry(host, port, **kw)
+        self.registries.append(registry)
+        return registry
+
+    def test_register_and_revoke(self):
+        from repoze.browserid.registry import LIVE, REVOKED
+        registry = self._makeOne(expire=3600)
+        registry._start = lambda: None
+        registry.register('a')
+        registry.register('b')
+        registry.flush()
+        self.assertEqual(self.server.data, {'browserid:a':'1',
+                                            'browserid:b':'1'})
+        self.assertEqual(self.server.commands,
+                         [['SET', 'browserid:a', '1', 'EX', '3600', 'NX'],
+                          ['SET', 'browserid:b', '1', 'EX', '3600', 'NX']])
+        # a batch is sent as one pipeline over one connection
+        self.assertEqual(self.server.connections, 1)
+        registry.revoke('a')
+        self.assertEqual(registry.lookup('a'), REVOKED)
+        self.assertEqual(registry.lookup('b'), LIVE)
+        self.assertEqual(registry.lookup('c'), None)
+        registry.register('a')
+        registry.flush()
+        self.assertEqual(registry.lookup('a'), REVOKED)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_is_revoked_cached(self):
+        registry = self._makeOne()
+        self.assertFalse(registry.is_revoked('a'))
+        self.assertFalse(registry.is_revoked('a'))
+        self.assertEqual(len(self.server.commands), 1)
+
+    def test_error_reply(self):
+        from repoze.browserid.registry import RegistryError
+        registry = self._makeOne()
+        connection = registry.pool.acquire()
+        self.assertRaises(RegistryError, connection.execute, ['BOGUS'])
+        self.assertEqual(connection.execute(['PING']), ['PONG'])
+        self.assertEqual(connection.execute(['ECHO', 'x'], ['ECHO', '']),
+                         ['x', ''])
+        self.assertEqual(connection.execute(['DEL', 'x']), [0])
+        connection.close()
+
+    def test_error_reply_discards_connection(self):
+        from repoze.browserid.registry import RegistryError
+        registry = self._makeOne(cache_size=0)
+        self.assertRaises(RegistryError, registry._execute, ['BOGUS'],
+                          ['PING'])
+        self.assertEqual(registry.pool._idle, [])
+        self.assertEqual(registry.lookup('a'), None)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_server_gone(self):
+        registry = self._makeOne(cache_size=0)
+        self.assertFalse(registry.is_revoked('a'))
+        connection = registry.pool._idle[0]
+        self.server.shutdown()
+        self.server.close_connections()
+        self.assertFalse(registry.is_revoked('a'))
+        self.assertFalse(connection in registry.pool._idle)
+
+    def test_timeouts(self):
+        registry = self._makeOne(cache_size=0, timeout=2.0,
+                                 lookup_timeout=0.05)
+        registry.is_revoked('a')
+        connection = registry.pool._idle[0]
+        self.assertEqual(connection.sock.gettimeout(), 0.05)
+        registry._register(['a'])
+        self.assertEqual(connection.sock.gettimeout(), 2.0)
+
+    def test_unresponsive_server(self):
+        import socket
+        import time
+        from repoze.browserid.registry import RESPRegistry
+        # accepts connections, never replies
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        try:
+            host, port = listener.getsockname()
+            registry = RESPRegistry(host, port, cache_size=0,
+                                    lookup_timeout=0.05)
+            self.registries.append(registry)
+            started = time.time()
+            self.assertFalse(registry.is_revoked('a'))
+            self.assertFalse(registry.is_revoked('b'))
+            self.assertTrue(time.time() - started < 1)
+            self.assertEqual(registry.pool._idle, [])
+        finally:
+            listener.close()
+
+class TestRegistryFromUrl(unittest.TestCase):
+    def _callFUT(self, url):
+        from repoze.browserid.registry import registry_from_url
+        return registry_from_url(url)
+
+    def test_memory(self):
+        from repoze.browserid.registry import MemoryRegistry
+        self.assertTrue(isinstance(self._callFUT('memory:'), MemoryRegistry))
+
+    def test_sqlite(self):
+        import os
+        import shutil
+        import tempfile
+        tempdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tempdir, 'ids.db')
+            registry = self._callFUT('sqlite:' + path)
+            self.assertEqual(registry.path, path)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_resp(self):
+        registry = self._callFUT('resp://example.com:6380/bid:')
+        self.assertEqual((registry.host, registry.port, registry.key_prefix),
+                         ('example.com', 6380, 'bid:'))
+        registry = self._callFUT('redis://')
+        self.assertEqual((registry.host, registry.port, registry.key_prefix),
+                         ('localhost', 6379, 'browserid:'))
+        self.assertEqual(registry.expire, None)
+        registry = self._callFUT('resp://example.com/bid:?expire=3600')
+        self.assertEqual((registry.host, registry.key_prefix,
+                          registry.expire), ('example.com', 'bid:', 3600))
+        self.assertRaises(ValueError, self._callFUT, 'resp://?ttl=1')
+
+    def test_unknown(self):
+        self.assertRaises(ValueError, self._callFUT, 'sqlite:')
+        self.assertRaises(ValueError, self._callFUT, 'postgres://x')
+
+class TestEventQueue(unittest.TestCase):
+    def _makeOne(self, sink=None, **kw):
+        from repoze.browserid.events import EventQueue
+        if sink is None:
+            sink = DummySink()
+        return EventQueue(sink, **kw)
+
+    def test_flush_in_batches(self):
+        queue = self._makeOne(batch_size=2)
+        queue._start = lambda: None
+        for x in range(3):
+            queue.put({'n':x})
+        self.assertEqual(len(queue), 3)
+        queue.flush()
+        self.assertEqual(queue.sink.batches, [[{'n':0}, {'n':1}], [{'n':2}]])
+        self.assertEqual(queue.written, 3)
+        self.assertEqual(len(queue), 0)
+
+    def test_drop_when_full(self):
+        queue = self._makeOne(maxsize=2)
+        queue._start = lambda: None
+        for x in range(3):
+            queue.put({'n':x})
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(len(queue), 2)
+
+    def test_block_when_full(self):
+        import threading
+        queue = self._makeOne(maxsize=1, policy='block')
+        queue._start = lambda: None
+        queue.put({'n':0})
+        thread = threading.Thread(target=queue.put, args=({'n':1},))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.05)
+        self.assertTrue(thread.is_alive())
+        queue.flush()
+        thread.join(1)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(queue.dropped, 0)
+        queue.flush()
+        self.assertEqual(queue.written, 2)
+
+    def test_unknown_policy(self):
+        self.assertRaises(ValueError, self._makeOne, policy='spill')
+
+    def test_failing_sink(self):
+        class FailingSink:
+            def write(self, events):
+                raise IOError('disk full')
+        queue = self._makeOne(FailingSink())
+        queue._start = lambda: None
+        queue.put({})
+        queue.flush()
+        self.assertEqual(queue.errors, 1)
+        self.assertEqual(queue.written, 0)
+
+    def test_background_writes(self):
+        import time
+        queue = self._makeOne(batch_size=10, flush_interval=0.05)
+        for x in range(25):
+            queue.put({'n':x})
+        for x in range(200):
+            if queue.written == 25:
+                break
+            time.sleep(0.01)
+        self.assertEqual(queue.written, 25)
+        self.assertTrue(len(queue.sink.batches) < 25)
+
+    def test_after_fork_empties(self):
+        queue = self._makeOne()
+        queue._start = lambda: None
+        queue.put({})
+        queue._thread = object()
+        queue._after_fork()
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue._thread, None)
+
+class TestEventSinks(unittest.TestCase):
+    _EVENTS = [{'browser_id':'a', 'time':1.5, 'pid':7, 'vary':{}},
+               {'browser_id':'b', 'time':2.0, 'pid':7,
+                'vary':{'REMOTE_ADDR':'127.0.0.1'}}]
+
+    def setUp(self):
+        import tempfile
+        self.tempdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tempdir)
+
+    def _path(self, name):
+        import os
+        return os.path.join(self.tempdir, name)
+
+    def test_jsonl(self):
+        import json
+        from repoze.browserid.events import JSONLinesSink
+        sink = JSONLinesSink(self._path('events.jsonl'))
+        sink.write(self._EVENTS[:1])
+        sink.write(self._EVENTS[1:])
+        sink.close()
+        f = open(self._path('events.jsonl'))
+        lines = f.readlines()
+        f.close()
+        self.assertEqual([ json.loads(line) for line in lines ],
+                         self._EVENTS)
+
+    def test_sqlite(self):
+        import sqlite3
+        from repoze.browserid.events import SQLiteSink
+        sink = SQLiteSink(self._path('events.db'))
+        sink.write(self._EVENTS)
+        sink.close()
+        connection = sqlite3.connect(self._path('events.db'))
+        rows = connection.execute('SELECT * FROM browserid_events').fetchall()
+        connection.close()
+        self.assertEqual(rows, [('a', 1.5, 7, '{}'),
+                                ('b', 2.0, 7, '{"REMOTE_ADDR": "127.0.0.1"}')])
+
+    def test_sink_from_url(self):
+        from repoze.browserid.events import sink_from_url
+        from repoze.browserid.events import JSONLinesSink, SQLiteSink
+        sink = sink_from_url('jsonl:/var/log/ids.jsonl')
+        self.assertTrue(isinstance(sink, JSONLinesSink))
+        self.assertEqual(sink.path, '/var/log/ids.jsonl')
+        self.assertTrue(isinstance(sink_from_url('sqlite:ids.db'), SQLiteSink))
+        self.assertRaises(ValueError, sink_from_url, 'jsonl:')
+        self.assertRaises(ValueError, sink_from_url, 'kafka:topic')
+
 class TestStartResponseWrapper(unittest.TestCase):
     def _getTargetClass(self):
         from repoze.browserid.middleware import StartResponseWrapper
@@ -212,14 +2450,14 @@ class TestStartResponseWrapper(unittest.TestCase):
         wrapper = self._makeOne(None)
         self.assertEqual(wrapper.start_response, None)
         self.assertEqual(wrapper.headers, [])
-        self.failUnless(wrapper.buffer)
+        self.assertTrue(wrapper.buffer)
     
     def test_finish_response_extraheaders(self):
         statuses = []
         headerses = []
         datases = []
         closededs = []
-        from StringIO import StringIO
+        from io import BytesIO
         def write(data):
             datases.append(data)
         def close():
@@ -234,13 +2472,13 @@ class TestStartResponseWrapper(unittest.TestCase):
         wrapper = self._makeOne(start_response)
         wrapper.status = '401 Unauthorized'
         wrapper.headers = [('a', '1')]
-        wrapper.buffer = StringIO('written')
+        wrapper.buffer = BytesIO(b'written')
         extra_headers = [('b', '2')]
         result = wrapper.finish_response(extra_headers)
         self.assertEqual(result, None)
         self.assertEqual(headerses[0], wrapper.headers + extra_headers)
         self.assertEqual(statuses[0], wrapper.status)
-        self.assertEqual(datases[0], 'written')
+        self.assertEqual(datases[0], b'written')
         self.assertEqual(closededs[0], True)
 
     def test_finish_response_noextraheaders(self):
@@ -248,7 +2486,7 @@ class TestStartResponseWrapper(unittest.TestCase):
         headerses = []
         datases = []
         closededs = []
-        from StringIO import StringIO
+        from io import BytesIO
         def write(data):
             datases.append(data)
         def close():
@@ -263,14 +2501,139 @@ class TestStartResponseWrapper(unittest.TestCase):
         wrapper = self._makeOne(start_response)
         wrapper.status = '401 Unauthorized'
         wrapper.headers = [('a', '1')]
-        wrapper.buffer = StringIO('written')
+        wrapper.buffer = BytesIO(b'written')
         result = wrapper.finish_response([])
         self.assertEqual(result, None)
         self.assertEqual(headerses[0], wrapper.headers)
         self.assertEqual(statuses[0], wrapper.status)
-        self.assertEqual(datases[0], 'written')
+        self.assertEqual(datases[0], b'written')
         self.assertEqual(closededs[0], True)
 
+class TestBench(unittest.TestCase):
+    def test_run_every_benchmark(self):
+        from repoze.browserid import bench
+        results = bench.run(number=2, repeat=1, threads=(2,))
+        names = [ name for name, setup in bench._benchmarks ]
+        names.extend([ '%s.2' % name for name, setup
+                       in bench._threaded_benchmarks ])
+        names.extend([ '%s.%s' % (name, x) for name, setup
+                       in bench._latency_benchmarks
+                       for x in ('p50', 'p99', 'p999') ])
+        self.assertEqual(sorted(results), sorted(names))
+        for value in results.values():
+            self.assertTrue(value > 0)
+
+    def test_run_selected(self):
+        from repoze.browserid import bench
+        results = bench.run(['wsgi.cookie_present.metrics',
+                             'threads.new.random.1'],
+                            number=2, repeat=1, threads=(1, 2))
+        self.assertEqual(sorted(results),
+                         ['threads.new.random.1',
+                          'wsgi.cookie_present.metrics',
+                          'wsgi.cookie_present.metrics_timings'])
+
+    def test_run_latency_benchmark(self):
+        from repoze.browserid.bench import run_latency_benchmark
+        calls = []
+        latencies = run_latency_benchmark(lambda: lambda: calls.append(1),
+                                          1000)
+        self.assertEqual(len(calls), 1000)
+        self.assertEqual(sorted(latencies), [50, 99, 99.9])
+        self.assertTrue(latencies[50] <= latencies[99] <= latencies[99.9])
+
+    def test_run_forked(self):
+        from repoze.browserid.bench import run_forked
+        import repoze.browserid.middleware
+        try:
+            minted, distinct, rate = run_forked('legacy', 3, 500)
+        finally:
+            repoze.browserid.middleware._after_fork()
+        self.assertEqual(minted, 1500)
+        self.assertEqual(distinct, 1500)
+        self.assertTrue(rate > 0)
+
+    def test_main_forked(self):
+        from repoze.browserid import bench
+        out = _TextIO()
+        run_forked = bench.run_forked
+        bench.run_forked = lambda generator, workers, count: (
+            workers * count, workers * count - (generator == 'counter'), 1.0)
+        try:
+            status = bench.main(['bench', '--forked', '100', '-w', '2',
+                                 'random', 'counter'], out)
+        finally:
+            bench.run_forked = run_forked
+        self.assertEqual(status, 1)
+        self.assertTrue('forked.new.random' in out.getvalue())
+        self.assertTrue('100 ids, 1 duplicates' in out.getvalue())
+        self.assertFalse('forked.new.legacy' in out.getvalue())
+
+    def test_stream_memory(self):
+        from repoze.browserid.bench import stream_memory
+        peaks = dict(stream_memory())
+        if peaks:
+            # the buffered response holds the whole 8MB body
+            self.assertTrue(peaks['streamed'] < 1024 * 1024)
+            self.assertTrue(peaks['buffered'] > 8 * 1024 * 1024)
+
+    def test_compare(self):
+        from repoze.browserid.bench import compare
+        results = {'a':12.5, 'b':10.0, 'threads.c':70.0, 'threads.d':90.0,
+                   'new':1.0}
+        baseline = {'a':10.0, 'b':10.0, 'threads.c':100.0, 'threads.d':100.0}
+        self.assertEqual(compare(results, baseline, 0.2),
+                         [('a', 12.5, 10.0), ('threads.c', 70.0, 100.0)])
+
+    def test_cookie_sizes(self):
+        from repoze.browserid.bench import cookie_sizes
+        sizes = dict([ (name, (set_cookie, cookie))
+                       for name, set_cookie, cookie in cookie_sizes() ])
+        self.assertEqual(sizes['md5/hex'][1], len('bid=') + 73)
+        self.assertEqual(sizes['md5/base64'][1], len('bid=') + 51)
+
+    def test_main_save_and_compare(self):
+        import json
+        import os
+        import shutil
+        import tempfile
+        from repoze.browserid.bench import main
+        tempdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tempdir, 'baseline.json')
+            out = _TextIO()
+            status = main(['bench', '-n', '2', '-r', '1', '-t', '1',
+                           '--save', filename, 'new.random'], out)
+            self.assertEqual(status, 0)
+            f = open(filename)
+            saved = json.load(f)
+            f.close()
+            self.assertEqual(sorted(saved),
+                             ['new.random', 'threads.new.random.1'])
+            saved['new.random'] = 0.000001
+            f = open(filename, 'w')
+            json.dump(saved, f)
+            f.close()
+            out = _TextIO()
+            status = main(['bench', '-n', '2', '-r', '1', '-t', '1',
+                           '--compare', filename, 'new.random'], out)
+            self.assertEqual(status, 1)
+            self.assertTrue('REGRESSION new.random' in out.getvalue())
+            self.assertTrue('(baseline ' in out.getvalue())
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_main_reports_cookie_sizes(self):
+        from repoze.browserid import bench
+        out = _TextIO()
+        run = bench.run
+        bench.run = lambda *arg: {'new.random':1.0}
+        try:
+            self.assertEqual(bench.main(['bench'], out), 0)
+        finally:
+            bench.run = run
+        self.assertTrue('md5/hex' in out.getvalue())
+
 class TestMakeMiddleware(unittest.TestCase):
     def _getFUT(self):
         from repoze.browserid.middleware import make_middleware
@@ -296,6 +2659,445 @@ class TestMakeMiddleware(unittest.TestCase):
         self.assertEqual(mw.cookie_path, '/foo')
         self.assertEqual(mw.cookie_lifetime, 10)
         self.assertEqual(mw.cookie_secure, True)
+        self.assertEqual(mw.id_generator, None)
+        self.assertEqual(mw.cookie_expiry, 'expires')
+        self.assertEqual(mw.digest, 'md5')
+        self.assertEqual(mw.digest_size, 16)
+        self.assertEqual(mw.cookie_encoding, 'hex')
+
+    def test_cookie_expiry(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', cookie_lifetime='10',
+               cookie_expiry='max-age')
+        self.assertEqual(mw.cookie_expiry, 'max-age')
+        self.assertEqual(mw._set_cookie_template,
+                         'repoze.browserid=%s; Path=/; Max-Age=10; ')
+
+    def test_cookie_refresh(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', cookie_lifetime='100',
+               cookie_refresh='10')
+        self.assertEqual(mw.cookie_refresh, 10)
+
+    def test_cookie_refresh_empty(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', cookie_refresh='')
+        self.assertEqual(mw.cookie_refresh, None)
+
+    def test_bots(self):
+        from repoze.browserid.middleware import BOT_PATTERNS
+        f = self._getFUT()
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.bot_classifier, None)
+        mw = f(None, None, 'secret', bots='true', bot_browser_id='bot',
+               bot_cache_size='10')
+        self.assertEqual(mw.bot_classifier.patterns, BOT_PATTERNS)
+        self.assertEqual(mw.bot_classifier.cache.maxsize, 10)
+        self.assertEqual(mw.bot_browser_id, 'bot')
+        mw = f(None, None, 'secret', bot_user_agents='\nprobe\n^agent/\n')
+        self.assertEqual(mw.bot_classifier.patterns, ('probe', '^agent/'))
+
+    def test_mint_limiter(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.mint_limiter, None)
+        mw = f(None, None, 'secret', mint_rate='0.5', mint_burst='5',
+               mint_limit_keys='HTTP_X_REAL_IP REMOTE_ADDR')
+        self.assertEqual(mw.mint_limiter.rate, 0.5)
+        self.assertEqual(mw.mint_limiter.burst, 5)
+        self.assertEqual(mw.mint_limiter.key_names,
+                         ('HTTP_X_REAL_IP', 'REMOTE_ADDR'))
+        mw = f(None, None, 'secret', mint_rate='1')
+        self.assertEqual(mw.mint_limiter.burst, 10)
+        self.assertEqual(mw.mint_limiter.key_names, ('REMOTE_ADDR',))
+
+    def test_rejected_cache(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.rejected_cache, None)
+        mw = f(None, None, 'secret', rejected_cache_size='100',
+               rejected_cache_ttl='5')
+        self.assertEqual(mw.rejected_cache.maxsize, 100)
+        self.assertEqual(mw.rejected_cache.ttl, 5)
+
+    def test_verified_cache(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', verified_cache_size='100',
+               verified_cache_ttl='60')
+        self.assertEqual(mw.verified_cache.maxsize, 100)
+        self.assertEqual(mw.verified_cache.ttl, 60)
+
+    def test_verified_cache_disabled(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', verified_cache_size='0')
+        self.assertEqual(mw.verified_cache, None)
+
+    def test_digest(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', digest='sha256', digest_size='16',
+               cookie_encoding='base64')
+        self.assertEqual(mw.digest, 'sha256')
+        self.assertEqual(mw.digest_size, 16)
+        self.assertEqual(mw.cookie_encoding, 'base64')
+
+    def test_pool(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', pool_high_watermark='100',
+               pool_low_watermark='10')
+        self.assertEqual(mw.id_pool.high_watermark, 100)
+        self.assertEqual(mw.id_pool.low_watermark, 10)
+
+    def test_lazy(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', lazy='true')
+        self.assertEqual(mw.lazy, True)
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.lazy, False)
+
+    def test_exclusions(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', exclude_paths='/static/ *.png',
+               include_paths='/static/x', exclude_methods='HEAD OPTIONS',
+               exclude_user_agents='kube-probe/*\n Uptime Robot \n')
+        matcher = mw.matcher
+        self.assertTrue(matcher.excluded({'PATH_INFO':'/a.png'}))
+        self.assertFalse(matcher.excluded({'PATH_INFO':'/static/x'}))
+        self.assertEqual(matcher.exclude_methods,
+                         frozenset(['HEAD', 'OPTIONS']))
+        self.assertTrue(matcher.excluded({'HTTP_USER_AGENT':'Uptime Robot'}))
+
+    def test_exclusions_none(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', include_paths='/static/x')
+        self.assertEqual(mw.matcher, None)
+
+    def test_metrics(self):
+        from repoze.browserid.middleware import Metrics
+        f = self._getFUT()
+        mw = f(None, None, 'secret', metrics='true')
+        self.assertTrue(isinstance(mw.metrics, Metrics))
+        self.assertEqual(mw.metrics.timings, False)
+        mw = f(None, None, 'secret', metrics_timings='true')
+        self.assertEqual(mw.metrics.timings, True)
+        mw = f(None, None, 'secret', metrics_path='/_metrics')
+        self.assertTrue(isinstance(mw.metrics, Metrics))
+        self.assertEqual(mw.metrics_path, '/_metrics')
+
+    def test_keyring(self):
+        f = self._getFUT()
+        mw = f(None, None, 'new', key_id='k2',
+               old_keys='k1:old:with:colons\n :legacy')
+        self.assertEqual(mw.key_id, 'k2')
+        self.assertEqual(mw.keyring, {'k2':'new', 'k1':'old:with:colons',
+                                      '':'legacy'})
+        self.assertRaises(ValueError, f, None, None, 'new', old_keys='k1')
+        self.assertRaises(ValueError, f, None, None, 'new',
+                          old_keys='k;1:old')
+
+    def test_registry(self):
+        from repoze.browserid.registry import MemoryRegistry
+        f = self._getFUT()
+        mw = f(None, None, 'secret', registry='memory:')
+        self.assertTrue(isinstance(mw.registry, MemoryRegistry))
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.registry, None)
+
+    def test_events(self):
+        from repoze.browserid.events import JSONLinesSink
+        f = self._getFUT()
+        mw = f(None, None, 'secret', events='jsonl:/tmp/ids.jsonl',
+               events_queue_size='10', events_policy='block')
+        self.assertTrue(isinstance(mw.events.sink, JSONLinesSink))
+        self.assertEqual(mw.events.maxsize, 10)
+        self.assertEqual(mw.events.policy, 'block')
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.events, None)
+
+    def test_metrics_disabled(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.metrics, None)
+
+    def test_pool_disabled(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret')
+        self.assertEqual(mw.id_pool, None)
+
+    def test_id_generator_legacy(self):
+        f = self._getFUT()
+        mw = f(None, None, 'secret', id_generator='legacy')
+        self.assertEqual(mw.id_generator, None)
+
+    def test_id_generator_random(self):
+        from repoze.browserid.middleware import RandomIdGenerator
+        f = self._getFUT()
+        mw = f(None, None, 'secret', id_generator='random')
+        self.assertTrue(isinstance(mw.id_generator, RandomIdGenerator))
+
+    def test_id_generator_counter(self):
+        from repoze.browserid.middleware import CounterIdGenerator
+        f = self._getFUT()
+        mw = f(None, None, 'secret', id_generator='counter')
+        self.assertTrue(isinstance(mw.id_generator, CounterIdGenerator))
+
+    def test_id_generator_compact(self):
+        from repoze.browserid.middleware import CompactIdGenerator
+        f = self._getFUT()
+        mw = f(None, None, 'secret', id_generator='compact')
+        self.assertTrue(isinstance(mw.id_generator, CompactIdGenerator))
+        self.assertEqual(mw.id_generator.time_ordered, False)
+
+    def test_id_generator_compact_ordered(self):
+        from repoze.browserid.middleware import CompactIdGenerator
+        f = self._getFUT()
+        mw = f(None, None, 'secret', id_generator='compact-ordered')
+        self.assertTrue(isinstance(mw.id_generator, CompactIdGenerator))
+        self.assertEqual(mw.id_generator.time_ordered, True)
+
+    def test_id_generator_unknown(self):
+        f = self._getFUT()
+        self.assertRaises(ValueError, f, None, None, 'secret',
+                          id_generator='nonesuch')
+
+class TestHostBrowserIdMiddleware(unittest.TestCase):
+    def _makeOne(self, hosts, **kw):
+        from repoze.browserid.hosts import HostBrowserIdMiddleware
+        return HostBrowserIdMiddleware(DummyApp(), hosts, **kw)
+
+    def _hosts(self):
+        return self._makeOne({
+            'example.com': {'secret_key':'apex', 'cookie_name':'a'},
+            '*.example.com': {'secret_key':'sub', 'cookie_name':'b',
+                              'cookie_domain':'.example.com'},
+            '*.eu.example.com': {'secret_key':'eu', 'cookie_name':'c'},
+            }, vary=('REMOTE_ADDR',))
+
+    def _resolve(self, middleware, host):
+        return middleware.resolve({'HTTP_HOST':host})
+
+    def test_exact(self):
+        middleware = self._hosts()
+        resolved = self._resolve(middleware, 'example.com')
+        self.assertEqual(resolved.secret_key, 'apex')
+        self.assertEqual(resolved.cookie_name, 'a')
+        self.assertEqual(resolved.vary, ('REMOTE_ADDR',))
+        self.assertTrue(resolved.app is middleware.app)
+        self.assertTrue(self._resolve(middleware, 'Example.COM:8080.')
+                        is resolved)
+        self.assertTrue(self._resolve(middleware, 'example.com.')
+                        is resolved)
+
+    def test_wildcard(self):
+        middleware = self._hosts()
+        self.assertEqual(self._resolve(middleware, 'www.example.com')
+                         .secret_key, 'sub')
+        self.assertEqual(self._resolve(middleware, 'a.b.example.com:443')
+                         .secret_key, 'sub')
+        self.assertEqual(self._resolve(middleware, 'www.eu.example.com')
+                         .secret_key, 'eu')
+        self.assertEqual(self._resolve(middleware, 'eu.example.com')
+                         .secret_key, 'sub')
+        self.assertEqual(len(middleware.resolved_cache), 4)
+        middleware.resolved_cache.set('www.example.com', 'cached')
+        self.assertEqual(self._resolve(middleware, 'www.example.com'),
+                         'cached')
+
+    def test_no_match_passes_through(self):
+        middleware = self._hosts()
+        self.assertTrue(self._resolve(middleware, 'example.org')
+                        is middleware.app)
+        self.assertTrue(middleware.resolve({}) is middleware.app)
+        environ = {'HTTP_HOST':'example.org'}
+        middleware(environ, lambda *arg: None)
+        self.assertFalse('repoze.browserid' in environ)
+
+    def test_default_pattern(self):
+        middleware = self._makeOne({'*': {'secret_key':'any',
+                                          'cookie_name':'d'},
+                                    'example.com': {'secret_key':'apex',
+                                                    'cookie_name':'a'}})
+        self.assertEqual(self._resolve(middleware, 'example.org').secret_key,
+                         'any')
+        self.assertEqual(self._resolve(middleware, 'example.com').secret_key,
+                         'apex')
+
+    def test_server_name_and_ipv6(self):
+        middleware = self._makeOne({'[::1]': {'secret_key':'v6',
+                                              'cookie_name':'a'},
+                                    'localhost': {'secret_key':'local',
+                                                  'cookie_name':'a'}})
+        self.assertEqual(middleware.resolve({'SERVER_NAME':'localhost'})
+                         .secret_key, 'local')
+        self.assertEqual(self._resolve(middleware, '[::1]:8080').secret_key,
+                         'v6')
+
+    def test_prebuilt_middleware(self):
+        from repoze.browserid.middleware import BrowserIdMiddleware
+        app = DummyApp()
+        prebuilt = BrowserIdMiddleware(app, 'secret', 'a')
+        middleware = self._makeOne({'example.com': prebuilt})
+        self.assertTrue(self._resolve(middleware, 'example.com') is prebuilt)
+
+    def test_call_sets_cookie_per_host(self):
+        middleware = self._hosts()
+        headers = []
+        def start_response(status, response_headers, exc_info=None):
+            headers.extend(response_headers)
+        environ = {'HTTP_HOST':'shop.example.com', 'REMOTE_ADDR':'10.0.0.1'}
+        middleware(environ, start_response)
+        browser_id = environ['repoze.browserid']
+        resolved = self._resolve(middleware, 'shop.example.com')
+        self.assertEqual(headers[0][1],
+                         'b=%s; Path=/; Domain=.example.com; ' %
+                         resolved.to_cookieval(environ, browser_id))
+        cookie = headers[0][1].split(';')[0]
+        environ = {'HTTP_HOST':'example.com', 'REMOTE_ADDR':'10.0.0.1',
+                   'HTTP_COOKIE':cookie.replace('b=', 'a=')}
+        del headers[:]
+        middleware(environ, start_response)
+        # signed with another host's key
+        self.assertNotEqual(environ['repoze.browserid'], browser_id)
+
+class TestMakeHostMiddleware(unittest.TestCase):
+    def _callFUT(self, *arg, **kw):
+        from repoze.browserid.hosts import make_host_middleware
+        return make_host_middleware(DummyApp(), {}, *arg, **kw)
+
+    def test_at_options(self):
+        middleware = self._callFUT(**{
+            'cookie_lifetime': '10',
+            'metrics': 'true',
+            'secret_key@example.com': 'apex',
+            'secret_key@*.example.org': 'org',
+            'cookie_name@*.example.org': 'org_id',
+            'vary@*.example.org': 'REMOTE_ADDR HTTP_USER_AGENT',
+            })
+        apex = middleware.exact['example.com']
+        org = middleware.wildcards['.example.org']
+        self.assertEqual(apex.secret_key, 'apex')
+        self.assertEqual(apex.cookie_name, 'repoze.browserid')
+        self.assertEqual(apex.cookie_lifetime, 10)
+        self.assertEqual(org.secret_key, 'org')
+        self.assertEqual(org.cookie_name, 'org_id')
+        self.assertEqual(org.vary, ('REMOTE_ADDR', 'HTTP_USER_AGENT'))
+        self.assertTrue(apex.metrics is org.metrics)
+        self.assertTrue(apex.metrics is not None)
+
+    def test_shared_options_per_host(self):
+        middleware = self._callFUT(**{
+            'secret_key': 'common',
+            'metrics': 'true',
+            'registry': 'memory:',
+            'cookie_name@a.example.com': 'a',
+            'metrics_timings@b.example.com': 'true',
+            })
+        a = middleware.exact['a.example.com']
+        b = middleware.exact['b.example.com']
+        self.assertFalse(a.metrics.timings)
+        self.assertTrue(b.metrics.timings)
+        self.assertTrue(a.registry is b.registry)
+
+    def test_events_per_host(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp('.jsonl')
+        os.close(fd)
+        try:
+            middleware = self._callFUT(**{
+                'secret_key': 'common',
+                'events': 'jsonl:%s' % path,
+                'cookie_name@a.example.com': 'a',
+                'cookie_name@b.example.com': 'b',
+                'events_policy@c.example.com': 'block',
+                })
+        finally:
+            os.remove(path)
+        a = middleware.exact['a.example.com']
+        b = middleware.exact['b.example.com']
+        c = middleware.exact['c.example.com']
+        self.assertTrue(a.events is b.events)
+        self.assertEqual(a.events.policy, 'drop')
+        self.assertEqual(c.events.policy, 'block')
+
+    def test_mint_limiter_per_host(self):
+        middleware = self._callFUT(**{
+            'secret_key': 'common',
+            'mint_rate': '100',
+            'cookie_name@a.example.com': 'a',
+            'cookie_name@b.example.com': 'b',
+            'mint_rate@strict.example.com': '0.001',
+            'mint_burst@strict.example.com': '1',
+            })
+        a = middleware.exact['a.example.com']
+        b = middleware.exact['b.example.com']
+        strict = middleware.exact['strict.example.com']
+        self.assertTrue(a.mint_limiter is b.mint_limiter)
+        self.assertEqual(a.mint_limiter.rate, 100)
+        self.assertEqual(strict.mint_limiter.rate, 0.001)
+        self.assertEqual(strict.mint_limiter.burst, 1)
+
+    def test_shared_mint_limiter(self):
+        middleware = self._callFUT(**{
+            'mint_rate': '1',
+            'secret_key@a.example.com': 'a',
+            'secret_key@b.example.com': 'b',
+            })
+        a = middleware.exact['a.example.com']
+        b = middleware.exact['b.example.com']
+        self.assertTrue(a.mint_limiter is b.mint_limiter)
+        self.assertTrue(a.mint_limiter is not None)
+
+    def test_shared_overridden(self):
+        middleware = self._callFUT(**{
+            'secret_key': 'common',
+            'registry': 'memory:',
+            'cookie_name@a.example.com': 'a',
+            'registry@b.example.com': 'memory:',
+            'id_generator@c.example.com': 'random',
+            })
+        a = middleware.exact['a.example.com']
+        b = middleware.exact['b.example.com']
+        c = middleware.exact['c.example.com']
+        self.assertTrue(a.registry is c.registry)
+        self.assertFalse(a.registry is b.registry)
+        self.assertEqual(a.id_generator, None)
+        self.assertFalse(c.id_generator is None)
+
+    def test_hosts_file(self):
+        import os
+        import tempfile
+        fd, path = tempfile.mkstemp('.ini')
+        f = os.fdopen(fd, 'w')
+        f.write('[DEFAULT]\n'
+                'cookie_name = bid\n'
+                '[example.com]\n'
+                'secret_key = apex\n'
+                '[*.example.com]\n'
+                'secret_key = sub\n'
+                'cookie_domain = .example.com\n')
+        f.close()
+        try:
+            middleware = self._callFUT(hosts_file=path,
+                                       **{'secret_key@example.com': 'other'})
+        finally:
+            os.remove(path)
+        apex = middleware.exact['example.com']
+        sub = middleware.wildcards['.example.com']
+        self.assertEqual(apex.secret_key, 'other')
+        self.assertEqual(apex.cookie_name, 'bid')
+        self.assertEqual(sub.secret_key, 'sub')
+        self.assertEqual(sub.cookie_domain, '.example.com')
+
+    def test_hosts_file_missing(self):
+        self.assertRaises(ValueError, self._callFUT,
+                          hosts_file='/nonexistent/hosts.ini')
+
+    def test_no_hosts(self):
+        self.assertRaises(ValueError, self._callFUT, secret_key='secret')
+
+    def test_no_secret_key(self):
+        self.assertRaises(ValueError, self._callFUT,
+                          **{'cookie_name@example.com': 'a'})
 
 class TestAsBool(unittest.TestCase):
     def _callFUT(self, val):
@@ -338,6 +3140,100 @@ class DummyRandom:
     def randint(self, start, end):
         return self._val
         
+class DummyConnection:
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+class DummySQLiteConnection:
+    def __init__(self, connection, execute):
+        self.connection = connection
+        self.execute = execute
+
+    def commit(self):
+        self.connection.commit()
+
+def DummyRESPServer():
+    """ A stand-in for a Redis server, knowing just enough commands to
+    serve a RESPRegistry, running in a thread. """
+    try:
+        import SocketServer as socketserver
+    except ImportError: # Python 3
+        import socketserver
+    import threading
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            self.server.connections += 1
+            self.server.sockets.append(self.request)
+            import socket
+            while 1:
+                try:
+                    line = self.rfile.readline()
+                except socket.error: # reset by close_connections
+                    return
+                if not line:
+                    return
+                args = []
+                for x in range(int(line[1:])):
+                    length = int(self.rfile.readline()[1:])
+                    args.append(self.rfile.read(length + 2)[:-2]
+                                .decode('latin-1'))
+                self.wfile.write(self.reply(args).encode('latin-1'))
+
+        def reply(self, args):
+            server = self.server
+            server.commands.append(args)
+            command = args[0].upper()
+            if command == 'PING':
+                return '+PONG\r\n'
+            if command == 'ECHO':
+                return '$%d\r\n%s\r\n' % (len(args[1]), args[1])
+            if command == 'GET':
+                value = server.data.get(args[1])
+                if value is None:
+                    return '$-1\r\n'
+                return '$%d\r\n%s\r\n' % (len(value), value)
+            if command == 'SET':
+                if 'NX' in args[3:] and args[1] in server.data:
+                    return '$-1\r\n'
+                server.data[args[1]] = args[2]
+                return '+OK\r\n'
+            if command == 'DEL':
+                return ':%d\r\n' % int(server.data.pop(args[1], None)
+                                         is not None)
+            return '-ERR unknown command\r\n'
+
+    class Server(socketserver.ThreadingTCPServer):
+        daemon_threads = True
+        allow_reuse_address = True
+
+        def close_connections(self):
+            import socket
+            for sock in self.sockets:
+                try:
+                    sock.shutdown(socket.SHUT_RDWR)
+                except socket.error:
+                    pass # already closed
+
+    server = Server(('127.0.0.1', 0), Handler)
+    server.data = {}
+    server.commands = []
+    server.connections = 0
+    server.sockets = []
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+class DummySink:
+    def __init__(self):
+        self.batches = []
+
+    def write(self, events):
+        self.batches.append(events)
+
 class DummyApp:
     def __call__(self, environ, start_response):
         start_response('200 OK', [])
@@ -41,6 +41,13 @@ setup(name='repoze.browserid',
         "Programming Language :: Python :: 2.5",
         "Programming Language :: Python :: 2.6",
         "Programming Language :: Python :: 2.7",
+        "Programming Language :: Python :: 3",
+        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "Programming Language :: Python :: Implementation :: CPython",
         "Programming Language :: Python :: Implementation :: PyPy",
         "Topic :: Internet :: WWW/HTTP",
@@ -63,6 +70,7 @@ setup(name='repoze.browserid',
       entry_points = """\
         [paste.filter_app_factory]
         browserid = repoze.browserid.middleware:make_middleware
+        browserid_hosts = repoze.browserid.hosts:make_host_middleware
       """,
       extras_require = {
         'testing': testing_extras,